@@ -0,0 +1,52 @@
+"""Benchmark language detection on synthetic scripts with many functions and variables"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calligraphy_scripting import parser  # pylint: disable=C0413
+
+SIZES = [1000, 5000, 20000, 50000]
+
+
+def generate(size: int) -> str:
+    """Generate a script that defines a new function and variable every few lines
+
+    Args:
+        size (int): Number of lines to generate
+
+    Returns:
+        str: Contents of the generated script
+    """
+
+    lines = []
+    for idx in range(size // 4):
+        lines.append(f"def func_{idx}(arg):")
+        lines.append(f"    var_{idx} = func_{idx - 1}(arg) if arg else []")
+        lines.append(f'    echo "{{var_{idx}}}" | grep -q foo')
+        lines.append(f"var_{idx}.append($(ls -la))")
+    return "\n".join(lines)
+
+
+def bench(size: int) -> dict:
+    """Time language detection of a generated script
+
+    Args:
+        size (int): Number of lines to generate
+
+    Returns:
+        dict: Seconds taken in total and per line
+    """
+
+    contents, _ = parser.handle_line_breaks(generate(size))
+    start = time.perf_counter()
+    parser.determine_language(contents)
+    elapsed = time.perf_counter() - start
+    return {"lines": size, "seconds": elapsed, "per_line": elapsed / size}
+
+
+if __name__ == "__main__":
+    print(json.dumps([bench(size) for size in SIZES], indent=4))
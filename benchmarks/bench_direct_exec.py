@@ -0,0 +1,80 @@
+"""Benchmark the latency of simple commands run through bash and run directly"""
+
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calligraphy_scripting import runtime as runtime_module  # pylint: disable=C0413
+
+CALLS = 200
+
+
+def load_runtime() -> dict:
+    """Get the namespace of the runtime that scripts run on
+
+    Returns:
+        dict: Globals of the runtime module
+    """
+
+    return vars(runtime_module)
+
+
+def time_calls(func, *args, **kwargs) -> float:
+    """Get the mean seconds taken by calls to a function
+
+    Args:
+        func (Callable): Function to call
+        args (Any): Positional arguments to call it with
+        kwargs (Any): Keyword arguments to call it with
+
+    Returns:
+        float: Mean seconds per call
+    """
+
+    func(*args, **kwargs)
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        func(*args, **kwargs)
+    return (time.perf_counter() - start) / CALLS
+
+
+def bench(runtime: dict, cmd: str) -> dict:
+    """Time a command through bash, directly and with a raw subprocess.run
+
+    Args:
+        runtime (dict): Namespace of the runtime
+        cmd (str): Simple command to run
+
+    Returns:
+        dict: Mean seconds per call for each way of running the command
+    """
+
+    encoded = base64.b64encode(cmd.encode("utf-8")).decode("utf-8")
+    return {
+        "command": cmd,
+        "bash": time_calls(runtime["shell"], encoded, silent=True),
+        "direct": time_calls(runtime["shell"], encoded, silent=True, direct=True),
+        "subprocess_run": time_calls(
+            subprocess.run, cmd.split(), stdout=subprocess.PIPE, check=True
+        ),
+    }
+
+
+if __name__ == "__main__":
+    namespace = load_runtime()
+    with tempfile.TemporaryDirectory() as root:
+        target = os.path.join(root, "file")
+        with open(target, "w", encoding="utf-8"):
+            pass
+        commands = [
+            f"mkdir -p {os.path.join(root, 'dist')}",
+            f"chmod +x {target}",
+            f"ls {root}",
+        ]
+        print(json.dumps([bench(namespace, cmd) for cmd in commands], indent=4))
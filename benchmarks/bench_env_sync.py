@@ -0,0 +1,177 @@
+"""Benchmark the cost of syncing the environment after a shell call as it grows
+
+The sync is meant to cost the same however large the environment is, so the benchmark
+fails if the cost per call at the largest size strays too far from the smallest.
+"""
+
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calligraphy_scripting import runtime as runtime_module  # pylint: disable=C0413
+
+SIZES = [10, 100, 300, 1000]
+CALLS = 50
+# External command run by every shell call
+COMMAND = "/bin/true"
+# Ratio of the cost per call at the largest size to the smallest that still counts as
+# flat, which leaves room for noise
+FLAT_RATIO = 1.5
+# Seconds of difference between the sizes that are too small to count as growth, a
+# sync that handles every variable costs several milliseconds at the largest size
+FLAT_SLACK = 0.001
+
+
+def load_runtime() -> dict:
+    """Get the namespace of the runtime that scripts run on
+
+    Returns:
+        dict: Globals of the runtime module
+    """
+
+    return vars(runtime_module)
+
+
+def time_calls(*funcs) -> list:
+    """Get the median seconds taken by functions that are called in turn
+
+    Taking turns spreads noise over all of the functions rather than just one of them,
+    while the median shrugs off the odd slow call.
+
+    Args:
+        funcs (Callable): Functions to call
+
+    Returns:
+        list: Median seconds per call of each function
+    """
+
+    timings = [[] for _ in funcs]
+    for _ in range(CALLS + 1):
+        for func, func_timings in zip(funcs, timings):
+            start = time.perf_counter()
+            func()
+            func_timings.append(time.perf_counter() - start)
+    # the first round warms up caches
+    return [statistics.median(func_timings[1:]) for func_timings in timings]
+
+
+def run_bash(runtime: dict, script: str) -> None:
+    """Run a script in a bash process of its own
+
+    Args:
+        runtime (dict): Namespace of the runtime
+        script (str): Bash to run
+    """
+
+    with runtime["start_process"](["bash", "-c", script], None) as proc:
+        proc.stdout.read()
+        proc.wait()
+
+
+def run_line(loop: subprocess.Popen) -> None:
+    """Have a bash loop run its command once
+
+    Args:
+        loop (subprocess.Popen): Bash loop that runs a command for every line it reads
+    """
+
+    loop.stdin.write(b"\n")
+    loop.stdin.flush()
+    loop.stdout.readline()
+
+
+def bench(runtime: dict, size: int) -> dict:
+    """Time shell calls and environment syncs with a given environment size
+
+    Bash reads its whole environment on start up and hands it to every command it
+    runs, which no sync can avoid, so the time the same command takes in bash without
+    reporting its status is taken off the time of each kind of shell call.
+
+    Args:
+        runtime (dict): Namespace of the runtime
+        size (int): Number of extra environment variables to add
+
+    Returns:
+        dict: Median seconds per call for one-off and session shell calls, what they
+            add to running the command in bash and the seconds to sync a changed
+            variable
+    """
+
+    saved = os.environ.copy()
+    for idx in range(size):
+        os.environ[f"CALLIGRAPHY_BENCH_{idx}"] = f"value={idx}"
+    try:
+        cmd = base64.b64encode(COMMAND.encode("utf-8")).decode("utf-8")
+        wrapped = runtime["wrap_command"](COMMAND)
+        bash_time, shell_time = time_calls(
+            lambda: run_bash(runtime, wrapped), lambda: runtime["shell"](cmd)
+        )
+
+        # a long running bash that runs the command for every line it reads, which is
+        # what a session does without syncing anything
+        with subprocess.Popen(
+            ["bash", "-c", f"while read -r line; do {COMMAND}; echo; done"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        ) as loop:
+            runtime["session"] = runtime["Session"]()
+            loop_time, session_time = time_calls(
+                lambda: run_line(loop), lambda: runtime["shell"](cmd)
+            )
+            runtime["session"].close()
+            runtime["session"] = None
+            loop.stdin.close()
+
+        sent = runtime["environ_snapshot"]()
+        report = b"\0".join(
+            key + b"=" + (b"changed" if key == b"CALLIGRAPHY_BENCH_0" else value)
+            for key, value in sent.items()
+        )
+        sync_time = time_calls(
+            lambda: runtime["EnvironmentSync"]().changes(sent, report)
+        )[0]
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+    return {
+        "env_size": len(sent),
+        "shell": shell_time,
+        "shell_overhead": shell_time - bash_time,
+        "session_shell": session_time,
+        "session_overhead": session_time - loop_time,
+        "changed_sync": sync_time,
+    }
+
+
+def check_flat(results: list, key: str) -> None:
+    """Fail if the cost of a call grew along with the environment
+
+    Args:
+        results (list): Results of each size, smallest first
+        key (str): Timing to check
+
+    Raises:
+        AssertionError: The timing at the largest size isn't close to the smallest
+    """
+
+    smallest = results[0][key]
+    largest = results[-1][key]
+    assert largest <= max(smallest * FLAT_RATIO, smallest + FLAT_SLACK), (
+        f"{key} grew from {smallest * 1000:.2f}ms to {largest * 1000:.2f}ms per call "
+        f"as the environment grew to {results[-1]['env_size']} variables"
+    )
+
+
+if __name__ == "__main__":
+    namespace = load_runtime()
+    results_by_size = [bench(namespace, size) for size in SIZES]
+    print(json.dumps(results_by_size, indent=4))
+    check_flat(results_by_size, "shell_overhead")
+    check_flat(results_by_size, "session_overhead")
@@ -0,0 +1,79 @@
+"""Benchmark the per-call cost of preparing a command as the namespace grows"""
+
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calligraphy_scripting import runtime  # pylint: disable=C0413
+
+CALLS = 20000
+NAMESPACE_SIZES = [10, 1000, 10000]
+# How each kind of command is prepared by the transpiled code, the whole namespace is
+# what every call used to be formatted against
+CALLS_BY_KIND = {
+    "namespace": 'decode_command(formatted, {**globals(), **locals()})',
+    "referenced": 'decode_command(formatted, {"service": service})',
+    "constant": "decode_command(constant)",
+}
+
+
+def encode(cmd: str) -> str:
+    """Encode a command the way the transpiler does
+
+    Args:
+        cmd (str): Command to encode
+
+    Returns:
+        str: Base64 encoded command
+    """
+
+    return base64.b64encode(cmd.encode("utf-8")).decode("utf-8")
+
+
+def time_call(expression: str, size: int) -> float:
+    """Get the mean seconds taken by a call made from a namespace of the given size
+
+    Args:
+        expression (str): Call to time
+        size (int): Number of names in the namespace the call is made from
+
+    Returns:
+        float: Mean seconds per call
+    """
+
+    namespace = {f"name_{idx}": idx for idx in range(size)}
+    namespace.update(
+        decode_command=runtime.decode_command,
+        formatted=encode("systemctl restart {service}"),
+        constant=encode("systemctl daemon-reload"),
+        service="nginx",
+    )
+    code = compile(f"for _ in range({CALLS}):\n    {expression}\n", "<bench>", "exec")
+    exec(code, namespace)  # pylint: disable=W0122
+    start = time.perf_counter()
+    exec(code, namespace)  # pylint: disable=W0122
+    return (time.perf_counter() - start) / CALLS
+
+
+def bench(size: int) -> dict:
+    """Time each kind of command from a namespace of the given size
+
+    Args:
+        size (int): Number of names in the namespace
+
+    Returns:
+        dict: Mean seconds per call for each kind of command
+    """
+
+    results = {"namespace_size": size}
+    for kind, expression in CALLS_BY_KIND.items():
+        results[kind] = time_call(expression, size)
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps([bench(size) for size in NAMESPACE_SIZES], indent=4))
@@ -0,0 +1,122 @@
+"""Benchmark each stage of parsing and transpiling on generated scripts"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from calligraphy_scripting import parser
+from calligraphy_scripting import transpiler
+
+SIZES = [100, 1000, 10000, 100000]
+
+
+def generate_typical(size: int) -> str:
+    """Generate a script mixing Python, Bash and inline Bash like a real script would
+
+    Args:
+        size (int): Number of lines to generate
+
+    Returns:
+        str: Contents of the generated script
+    """
+
+    lines = []
+    for idx in range(size // 10):
+        lines.append(f"def build_{idx}(name):")
+        lines.append(f"    out = $(ls -la dist/{{name}}) + ?(git rev-parse HEAD)")
+        lines.append(f'    if ?(test -f "dist/{{name}}/{idx}.txt"):')
+        lines.append(f'        echo "missing {{name}}" | tee -a build.log')
+        lines.append(f"    return out.split('\\n')")
+        lines.append(f"services_{idx} = [s for s in ['a', 'b'] if s != '{idx}']")
+        lines.append(f"for service in services_{idx}:")
+        lines.append("    docker build -t {service} . &")
+        lines.append("wait")
+        lines.append(f"print(build_{idx}(services_{idx}[0]), $?)")
+    return "\n".join(lines)
+
+
+def generate_pathological(size: int) -> str:
+    """Generate a script of deeply nested calls, quotes and line continuations
+
+    Args:
+        size (int): Number of lines to generate
+
+    Returns:
+        str: Contents of the generated script
+    """
+
+    lines = []
+    for idx in range(size // 5):
+        nested = "$(echo " * 8 + f"'{idx}'" + ")" * 8
+        lines.append(f"x_{idx} = {nested}")
+        lines.append(
+            f'y_{idx} = "it\'s \\"quoted\\" {idx}" + ' + " + ".join(["?(true)"] * 20)
+        )
+        lines.append(f"echo 'a \"b\" c' \"d 'e' f\" $'g\\'h' \"{{x_{idx}}}\" \\")
+        lines.append("    --flag=\"$(printf '%s' \"$(echo ')(')\")\"")
+        lines.append(f"z_{idx} = [[[(1, {{'k': [2, 3]}})]]] if $(echo '[[(') else []")
+    return "\n".join(lines)
+
+
+def time_stage(func, *args) -> float:
+    """Get the seconds taken by a single call to a function
+
+    Args:
+        func (Callable): Function to call
+        args (Any): Arguments to call it with
+
+    Returns:
+        float: Seconds taken by the call
+    """
+
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def get_all_parts(lines: list[str]) -> None:
+    """Split every line of a script into its parts
+
+    Args:
+        lines (list[str]): Lines of the script
+    """
+
+    for line in lines:
+        parser.get_parts(line)
+
+
+def bench(kind: str, size: int) -> dict:
+    """Time each stage of transpiling a generated script
+
+    Args:
+        kind (str): Kind of script to generate, `typical` or `pathological`
+        size (int): Number of lines to generate
+
+    Returns:
+        dict: Seconds taken by each stage and in total per line
+    """
+
+    generate = generate_typical if kind == "typical" else generate_pathological
+    code = generate(size)
+
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    timings = {
+        "handle_line_breaks": time_stage(parser.handle_line_breaks, code),
+        "determine_language": time_stage(parser.determine_language, contents),
+        "get_parts": time_stage(get_all_parts, lines),
+        "transpile": time_stage(transpiler.transpile, lines, langs, inline_indices),
+    }
+    total = sum(timings.values())
+    return {"input": kind, "lines": size, **timings, "per_line": total / size}
+
+
+if __name__ == "__main__":
+    results = [
+        bench(kind, size) for kind in ("typical", "pathological") for size in SIZES
+    ]
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,89 @@
+"""Benchmark the per-call overhead of shell() over a raw subprocess.run"""
+
+import base64
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calligraphy_scripting import runtime as runtime_module  # pylint: disable=C0413
+
+CALLS = 200
+COMMANDS = ["true", "echo hello", "printf '%s\\n' a b c"]
+
+
+def load_runtime() -> dict:
+    """Get the namespace of the runtime that scripts run on
+
+    Returns:
+        dict: Globals of the runtime module
+    """
+
+    return vars(runtime_module)
+
+
+def time_calls(func, *args, **kwargs) -> float:
+    """Get the mean seconds taken by calls to a function
+
+    Args:
+        func (Callable): Function to call
+        args (Any): Positional arguments to call it with
+        kwargs (Any): Keyword arguments to call it with
+
+    Returns:
+        float: Mean seconds per call
+    """
+
+    func(*args, **kwargs)
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        func(*args, **kwargs)
+    return (time.perf_counter() - start) / CALLS
+
+
+def bench(runtime: dict, cmd: str) -> dict:
+    """Time a command through shell() and through bash with a raw subprocess.run
+
+    Args:
+        runtime (dict): Namespace of the runtime
+        cmd (str): Command to run
+
+    Returns:
+        dict: Mean seconds per call for each way of running the command and the
+            overhead of shell() over the baseline
+    """
+
+    encoded = base64.b64encode(cmd.encode("utf-8")).decode("utf-8")
+    baseline = time_calls(
+        subprocess.run, ["bash", "-c", cmd], stdout=subprocess.PIPE, check=True
+    )
+    shell_time = time_calls(runtime["shell"], encoded, silent=True)
+    stdout_time = time_calls(
+        runtime["shell"], encoded, get_stdout=True, silent=True, format_dict={}
+    )
+    direct_time = time_calls(runtime["shell"], encoded, silent=True, direct=True)
+
+    runtime["session"] = runtime["Session"]()
+    try:
+        session_time = time_calls(runtime["shell"], encoded, silent=True)
+    finally:
+        runtime["session"].close()
+        runtime["session"] = None
+
+    return {
+        "command": cmd,
+        "subprocess_run": baseline,
+        "shell": shell_time,
+        "shell_stdout": stdout_time,
+        "shell_direct": direct_time,
+        "shell_session": session_time,
+        "overhead": shell_time - baseline,
+    }
+
+
+if __name__ == "__main__":
+    namespace = load_runtime()
+    print(json.dumps([bench(namespace, cmd) for cmd in COMMANDS], indent=4))
@@ -0,0 +1,65 @@
+"""Benchmark the cold start time of the calligraphy command"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 20
+
+
+def get_command() -> list[str]:
+    """Get the command that starts Calligraphy, preferring the installed entrypoint
+
+    Returns:
+        list[str]: Command to run Calligraphy with
+    """
+
+    installed = shutil.which("calligraphy")
+    if installed is not None:
+        return [installed]
+    return [sys.executable, "-c", "from calligraphy_scripting import cli; cli.cli()"]
+
+
+def time_runs(cmd: list[str], environ: dict) -> dict:
+    """Get the fastest and mean seconds taken to run a command to completion
+
+    Args:
+        cmd (list[str]): Command to run
+        environ (dict): Environment to run the command with
+
+    Returns:
+        dict: Fastest and mean seconds per run
+    """
+
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, env=environ, check=True)
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, env=environ, check=True)
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "mean": sum(timings) / RUNS}
+
+
+if __name__ == "__main__":
+    calligraphy = get_command()
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    with tempfile.TemporaryDirectory() as root:
+        env["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        script = os.path.join(root, "hello.script")
+        with open(script, "w", encoding="utf-8") as script_file:
+            script_file.write('name = "world"\necho "hello {name}"\n')
+        results = {
+            "python": time_runs([sys.executable, "-c", "pass"], env),
+            "version": time_runs(calligraphy + ["-v"], env),
+            "hello_script": time_runs(calligraphy + [script], env),
+            "hello_script_no_cache": time_runs(
+                calligraphy + ["--no-cache", script], env
+            ),
+        }
+    print(json.dumps(results, indent=4))
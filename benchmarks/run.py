@@ -0,0 +1,124 @@
+"""Run every benchmark and write their combined results as JSON
+
+Usage:
+    python benchmarks/run.py [OUTPUT] [--compare PREVIOUS]
+
+Each `bench_*.py` script is run in its own interpreter so that imports and caches
+don't leak between benchmarks. With `--compare`, the timings of a previous run are
+shown next to the new ones as ratios so regressions stand out.
+"""
+
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_commit() -> str:
+    """Get the commit the benchmarks are run against
+
+    Returns:
+        str: Hash of the checked out commit or an empty string outside of git
+    """
+
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=HERE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    return result.stdout.decode("utf-8").strip()
+
+
+def run_benchmarks() -> dict:
+    """Run every benchmark script and collect its results
+
+    Returns:
+        dict: Results of each benchmark keyed by its name
+    """
+
+    results = {}
+    for path in sorted(glob.glob(os.path.join(HERE, "bench_*.py"))):
+        name = os.path.basename(path)[6:-3]
+        print(f"Running {name}...", file=sys.stderr)
+        output = subprocess.run(
+            [sys.executable, path], stdout=subprocess.PIPE, check=True
+        ).stdout
+        results[name] = json.loads(output)
+    return results
+
+
+def flatten(value, prefix: str = "") -> dict:
+    """Flatten nested benchmark results into timings keyed by their path
+
+    Args:
+        value (Any): Results to flatten
+        prefix (str, optional): Path of the value. Defaults to "".
+
+    Returns:
+        dict: Numeric results keyed by a dotted path
+    """
+
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        return {prefix: value} if is_number else {}
+
+    flat = {}
+    for key, item in items:
+        flat.update(flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+    return flat
+
+
+def compare(previous: dict, current: dict) -> None:
+    """Print how each timing changed between two runs
+
+    Args:
+        previous (dict): Results of the earlier run
+        current (dict): Results of the new run
+    """
+
+    before = flatten(previous["results"])
+    after = flatten(current["results"])
+    print(f"{previous['commit'][:10]} -> {current['commit'][:10]}", file=sys.stderr)
+    for key, value in after.items():
+        # counts like the number of lines stay the same, only report the timings
+        if before.get(key) and before[key] != value:
+            print(f"{value / before[key]:8.2f}x  {key}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    previous_path = None
+    if "--compare" in args:
+        idx = args.index("--compare")
+        previous_path = args[idx + 1]
+        del args[idx : idx + 2]
+
+    report = {
+        "commit": get_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": run_benchmarks(),
+    }
+
+    if args:
+        with open(args[0], "w", encoding="utf-8") as out_file:
+            json.dump(report, out_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if previous_path is not None:
+        with open(previous_path, encoding="utf-8") as previous_file:
+            compare(json.load(previous_file), report)
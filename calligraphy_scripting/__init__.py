@@ -1,5 +1,23 @@
 """Calligraphy script runner"""
 
-from calligraphy_scripting import runner
+import importlib
 
 __version__ = "1.1.4"
+
+
+def __getattr__(name: str):
+    """Import the runner the first time it is used, keeping the package cheap to import
+
+    Args:
+        name (str): Name of the attribute being looked up
+
+    Raises:
+        AttributeError: The package has no such attribute
+
+    Returns:
+        ModuleType: The runner module
+    """
+
+    if name == "runner":
+        return importlib.import_module("calligraphy_scripting.runner")
+    raise AttributeError(f"module 'calligraphy_scripting' has no attribute '{name}'")
@@ -0,0 +1,183 @@
+"""Module to cache transpiled Calligraphy scripts and their bytecode on disk"""
+
+from __future__ import annotations
+import os
+import hashlib
+import marshal
+import calligraphy_scripting
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Default cap on the total size of the cache directory in bytes
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+# Number of entries a long running process keeps in memory, such as the server
+MEMORY_ENTRIES = 128
+
+# Entries used by this process keyed by their path, least recently used first
+memory = {}
+
+
+def get_cache_dir() -> str:
+    """Get the directory that cached scripts are stored in
+
+    Returns:
+        str: Path to the cache directory
+    """
+
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "calligraphy")
+
+
+def get_key(contents: str, prelude: str) -> str:
+    """Get the content address of a script
+
+    Args:
+        contents (str): Contents of the Calligraphy script
+        prelude (str): Code the compiled script starts with
+
+    Returns:
+        str: Hash of the script, prelude and Calligraphy version
+    """
+
+    digest = hashlib.sha256()
+    digest.update(calligraphy_scripting.__version__.encode("utf-8"))
+    # Pick up changes to an installed Calligraphy that keep the same version
+    for module in ("parser.py", "transpiler.py", "runtime.py"):
+        stat = os.stat(os.path.join(here, module))
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    digest.update(prelude.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(contents.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    """Get the hash of a file's contents
+
+    Args:
+        path (str): Path of the file to hash
+
+    Returns:
+        str: Hash of the file or an empty string if it can't be read
+    """
+
+    try:
+        with open(path, "rb") as hashed_file:
+            return hashlib.sha256(hashed_file.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def load(key: str) -> tuple:
+    """Load the bytecode of a cached script
+
+    Args:
+        key (str): Content address of the script
+
+    Returns:
+        tuple: The cached code object and the script line of each transpiled line, or
+            None for both if there isn't a valid entry
+    """
+
+    path = os.path.join(get_cache_dir(), f"{key}.bin")
+    entry = memory.pop(path, None)
+    in_memory = entry is not None
+    if not in_memory:
+        try:
+            with open(path, "rb") as cache_file:
+                entry = marshal.load(cache_file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None, None
+        if "line_numbers" not in entry:
+            return None, None
+
+    # Sourced scripts are compiled next to themselves, so make sure they still match
+    for sourced, digest in entry["sourced"].items():
+        directory, script = os.path.split(sourced)
+        compiled = os.path.join(directory, f".{os.path.splitext(script)[0]}.py")
+        if hash_file(sourced) != digest or not os.path.exists(compiled):
+            return None, None
+
+    # Mark the entry as recently used for eviction purposes
+    if not in_memory:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    remember(path, entry)
+    return entry["code"], entry["line_numbers"]
+
+
+def remember(path: str, entry: dict) -> None:
+    """Keep a cache entry in memory, dropping the least recently used ones over the cap
+
+    Args:
+        path (str): Path of the entry in the cache directory
+        entry (dict): Cache entry of the script
+    """
+
+    memory[path] = entry
+    while len(memory) > MEMORY_ENTRIES:
+        del memory[next(iter(memory))]
+
+
+def store(
+    key: str, source: str, code, sourced: list[str], line_numbers: list[int]
+) -> None:
+    """Store a transpiled script and its bytecode in the cache
+
+    Args:
+        key (str): Content address of the script
+        source (str): Transpiled Python source of the script
+        code (code): Code object compiled from the source
+        sourced (list[str]): Paths of the Calligraphy scripts sourced by the script
+        line_numbers (list[int]): Script line each line of the transpiled script was
+            generated from
+    """
+
+    cache_dir = get_cache_dir()
+    entry = {
+        "source": source,
+        "code": code,
+        "sourced": {path: hash_file(path) for path in sourced},
+        "line_numbers": line_numbers,
+    }
+    path = os.path.join(cache_dir, f"{key}.bin")
+    remember(path, entry)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temp_path, "wb") as cache_file:
+            marshal.dump(entry, cache_file)
+        os.replace(temp_path, path)
+    except OSError:
+        return
+    evict()
+
+
+def evict() -> None:
+    """Remove the least recently used entries until the cache fits its size limit"""
+
+    max_size = int(os.getenv("CALLIGRAPHY_CACHE_SIZE", str(DEFAULT_MAX_SIZE)))
+    cache_dir = get_cache_dir()
+
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as scan:
+        for entry in scan:
+            if not entry.name.endswith(".bin"):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total += stat.st_size
+
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
@@ -1,26 +1,22 @@
-# pylint: disable=C0301, R1702, R0912, R0914, W0122, W1401, W0703
-"""Main entrypoint into Calligraphy that handles CLI parsing"""
+# pylint: disable=C0301, R1702, R0912, R0913, R0914, R0915, W0122, W1401, W0703, C0415
+"""Main entrypoint into Calligraphy that handles CLI parsing
+
+Modules other than the package itself are imported by the mode that needs them, so
+that `--version` or running a cached script doesn't pay for importing the parser.
+"""
 
 from __future__ import annotations
 import sys
 import os
-from calligraphy_scripting import parser
-from calligraphy_scripting import runner
-from calligraphy_scripting import transpiler
 from calligraphy_scripting import __version__
 
 # Setup global helper variables
-here = os.path.dirname(os.path.abspath(__file__))
 if "-n" in sys.argv or "--no-ansi" in sys.argv:  # pragma: no cover
     ANSI_BOLD = ""
     ANSI_RED = ""
     ANSI_GREEN = ""
     ANSI_BLUE = ""
     ANSI_RESET = ""
-    transpiler.ANSI_GREEN = ""
-    transpiler.ANSI_CYAN = ""
-    transpiler.ANSI_BLUE = ""
-    transpiler.ANSI_RESET = ""
 else:
     ANSI_BOLD = "\033[1m"
     ANSI_RED = "\033[31m"
@@ -38,6 +34,23 @@ def version() -> None:
     )
 
 
+def load_transpiler():
+    """Import the transpiler with its colors turned off along with those of the CLI
+
+    Returns:
+        ModuleType: The transpiler module
+    """
+
+    from calligraphy_scripting import transpiler
+
+    if not ANSI_RESET:  # pragma: no cover
+        transpiler.ANSI_GREEN = ""
+        transpiler.ANSI_CYAN = ""
+        transpiler.ANSI_BLUE = ""
+        transpiler.ANSI_RESET = ""
+    return transpiler
+
+
 def explain(path: str) -> None:
     """Print out the source code with language annotations
 
@@ -53,6 +66,10 @@ def explain(path: str) -> None:
         with open(path, encoding="utf-8") as code_file:
             contents = code_file.read()
 
+    from calligraphy_scripting import parser
+
+    transpiler = load_transpiler()
+
     # Process the contents
     contents, inline_indices = parser.handle_line_breaks(contents)
     lines, langs = parser.determine_language(contents)
@@ -77,27 +94,48 @@ def intermediate(path: str, args: list) -> None:
         with open(path, encoding="utf-8") as code_file:
             contents = code_file.read()
 
+    from calligraphy_scripting import parser
+    from calligraphy_scripting import sourcemap
+
+    transpiler = load_transpiler()
+
     # Process the contents
+    contents = parser.handle_parallel(contents)
     contents, inline_indices = parser.handle_line_breaks(contents)
     contents = parser.handle_sourcing(contents)
     lines, langs = parser.determine_language(contents)
     transpiled = transpiler.transpile(lines, langs, inline_indices)
 
-    # Add the header to enable functionality
-    with open(os.path.join(here, "data", "header.py"), encoding="utf-8") as header_file:
-        header = header_file.read()
-    header = header.replace('"PROGRAM_ARGS"', str(["calligraphy"] + args))
-    code = f"{header}\n\n{transpiled}"
+    # Import the runtime to enable functionality
+    argv = ["calligraphy"] + args
+    code = f"{sourcemap.RUNTIME_PRELUDE}sys.argv = {argv}\n\n{transpiled}"
 
     print(code)
 
 
-def execute(path: str, args: list) -> None:
+def execute(
+    path: str,
+    args: list,
+    use_cache: bool = True,
+    targets: tuple = (),
+    jobs: int = 1,
+    profile: bool = False,
+    trace: str = "",
+) -> None:
     """Run a Calligraphy script
 
     Args:
         path (str): Path to the Calligraphy script file
         args (list): Command line arguments to pass to the program
+        use_cache (bool, optional): Should the compiled script cache be used.
+            Defaults to True.
+        targets (tuple, optional): Names of tasks to run after the script.
+            Defaults to none.
+        jobs (int, optional): Number of tasks to run at once. Defaults to 1.
+        profile (bool, optional): Should the time spent on each line be reported.
+            Defaults to False.
+        trace (str, optional): Path to write a trace of the shell calls to.
+            Defaults to no trace.
     """
 
     if path == "-":
@@ -108,9 +146,19 @@ def execute(path: str, args: list) -> None:
         with open(path, encoding="utf-8") as code_file:
             contents = code_file.read()
 
+    from calligraphy_scripting import runner
+
     # Run the code
     try:
-        runner.execute(contents, args=[sys.argv[1]] + args)
+        runner.execute(
+            contents,
+            args=[path] + args,
+            use_cache=use_cache,
+            targets=targets,
+            jobs=jobs,
+            profile=profile,
+            trace=trace,
+        )
     except Exception:
         help_prefix = f'Use `calligraphy -i {path} {" ".join(args)}'.strip()
         print(f"{help_prefix}` to see the intermediate Python for debugging")
@@ -127,6 +175,13 @@ def cli() -> None:
         -v, --version         Print out the version of Calligraphy and exit
         -i, --intermediate    Print out the compiled Python code and exit
         -n, --no-ansi         Print without ANSI terminal colors
+        -s, --session         Run all Bash lines in a single persistent shell process
+        --no-cache            Don't read or write the compiled script cache
+        -t, --target TASK     Run a task and its dependencies after the script
+        -j, --jobs N          Number of tasks to run at once, defaults to 1
+        --profile             Report the time spent on each line of the script
+        --trace FILE          Write a Chrome trace of the shell calls to a JSON file
+        --serve               Run scripts for calligraphy-client from a warm process
     {ANSI_BOLD}{ANSI_BLUE}arguments:{ANSI_RESET}
         file                  Program read from script file
         -                     Program read from stdin
@@ -141,11 +196,17 @@ def cli() -> None:
     # Setup variable defaults
     flag_intermediate = False
     flag_explain = False
+    flag_cache = True
+    flag_profile = False
+    trace_path = ""
+    targets = []
+    jobs = 1
     program_path = ""
     program_args = []
 
     # Parse arguments
-    for arg in args:
+    arg_iter = iter(args)
+    for arg in arg_iter:
         if program_path:
             program_args.append(arg)
             continue
@@ -154,6 +215,44 @@ def cli() -> None:
         if arg in ("-h", "--help"):
             print(help_text)
             sys.exit(0)
+        if arg in ("-s", "--session"):
+            os.environ["CALLIGRAPHY_SESSION"] = "1"
+            continue  # pragma: no cover
+        if arg == "--no-cache":
+            flag_cache = False
+            continue  # pragma: no cover
+        if arg == "--profile":
+            flag_profile = True
+            continue  # pragma: no cover
+        if arg == "--serve":
+            from calligraphy_scripting import server
+
+            try:
+                server.serve(sys.modules[__name__])
+            except OSError as error:
+                print(f"{ANSI_RED}{ANSI_BOLD}[ERROR]{ANSI_RESET} :: {error}")
+                sys.exit(1)
+            sys.exit(0)
+        if arg == "--trace":
+            trace_path = next(arg_iter, "")
+            if not trace_path:
+                print(
+                    f"{ANSI_RED}{ANSI_BOLD}[ERROR]{ANSI_RESET} :: The `trace` option requires a file path."
+                )
+                sys.exit(1)
+            continue
+        if arg in ("-t", "--target", "-j", "--jobs"):
+            value = next(arg_iter, "")
+            if arg in ("-t", "--target"):
+                targets.append(value)
+                continue
+            if not value.isdigit() or int(value) < 1:
+                print(
+                    f"{ANSI_RED}{ANSI_BOLD}[ERROR]{ANSI_RESET} :: The `jobs` option requires a positive number of jobs."
+                )
+                sys.exit(1)
+            jobs = int(value)
+            continue
         if arg in ("-v", "--version"):
             version()
             sys.exit(0)
@@ -191,7 +290,15 @@ def cli() -> None:
         sys.exit(0)
 
     # If we did nothing else then run the program
-    execute(program_path, program_args)
+    execute(
+        program_path,
+        program_args,
+        use_cache=flag_cache,
+        targets=tuple(targets),
+        jobs=jobs,
+        profile=flag_profile,
+        trace=trace_path,
+    )
 
 
 if __name__ == "__main__":
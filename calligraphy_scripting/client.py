@@ -0,0 +1,100 @@
+"""Thin client that runs Calligraphy scripts on a server started with `--serve`
+
+The client only imports the standard library it needs so that it starts quickly. It
+passes its own stdin, stdout and stderr to the server, so the script reads and writes
+them directly, and exits with the return code of the script.
+"""
+
+from __future__ import annotations
+import array
+import json
+import os
+import signal
+import socket
+import sys
+from calligraphy_scripting import ipc
+
+# Signals passed on to the script while it runs on the server
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT)
+
+
+def connect() -> socket.socket:
+    """Connect to the server
+
+    Raises:
+        OSError: No server is listening on the socket, or it isn't our own
+
+    Returns:
+        socket.socket: Connection to the server
+    """
+
+    if not os.getenv("CALLIGRAPHY_SOCKET"):
+        ipc.check_private_dir(ipc.get_socket_dir())
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(ipc.get_socket_path())
+        # the environment of the client is sent, so only ever send it to our own user
+        ipc.check_peer(conn)
+    except OSError:
+        conn.close()
+        raise
+    return conn
+
+
+def run(conn: socket.socket, args: list) -> int:
+    """Run the Calligraphy CLI with the given arguments on the server
+
+    Args:
+        conn (socket.socket): Connection to the server
+        args (list): Arguments to the CLI, as given to `calligraphy`
+
+    Returns:
+        int: Return code of the CLI, 1 if the server went away before reporting it
+    """
+
+    request = {"argv": args, "cwd": os.getcwd(), "env": dict(os.environ)}
+    data = json.dumps(request).encode("utf-8") + b"\n"
+    fds = array.array("i", ipc.STREAMS)
+    sent = conn.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    conn.sendall(data[sent:])
+
+    def forward(signum: int, _) -> None:
+        try:
+            os.killpg(pid, signum)
+        except OSError:
+            pass
+
+    pid = None
+    return_code = 1
+    with conn.makefile("rb") as replies:
+        for line in replies:
+            reply = json.loads(line)
+            if "pid" in reply:
+                # the script runs in its own process group, so signals sent by the
+                # terminal to the client have to be passed on
+                pid = reply["pid"]
+                for signum in FORWARDED_SIGNALS:
+                    signal.signal(signum, forward)
+            elif "rc" in reply:
+                return_code = reply["rc"]
+    return return_code
+
+
+def main() -> None:
+    """Run the command line arguments on the server, or in this process without one"""
+
+    args = sys.argv[1:]
+    try:
+        conn = connect()
+    except OSError:
+        from calligraphy_scripting import cli  # pylint: disable=C0415
+
+        cli.cli()
+        return
+    with conn:
+        return_code = run(conn, args)
+    sys.exit(return_code)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,82 @@
+"""Module with what the server and its clients share about the socket between them
+
+Only the standard library is imported here so that clients start quickly.
+"""
+
+from __future__ import annotations
+import os
+import socket
+import stat
+import struct
+
+# Standard streams passed to the server along with a request
+STREAMS = (0, 1, 2)
+
+
+def get_socket_dir() -> str:
+    """Get the directory of the default socket, which only the current user may access
+
+    Returns:
+        str: Directory for the current user in the runtime directory
+    """
+
+    base = os.getenv("XDG_RUNTIME_DIR") or os.getenv("TMPDIR") or "/tmp"
+    return os.path.join(base, f"calligraphy-{os.getuid()}")
+
+
+def get_socket_path() -> str:
+    """Get the path of the socket the server listens on
+
+    Returns:
+        str: Path set by `CALLIGRAPHY_SOCKET` or a socket in the directory of the
+            current user
+    """
+
+    path = os.getenv("CALLIGRAPHY_SOCKET")
+    if path:
+        return path
+    return os.path.join(get_socket_dir(), "server.sock")
+
+
+def check_private_dir(path: str) -> None:
+    """Make sure that a directory belongs to the current user and no one else
+
+    Args:
+        path (str): Path of the directory
+
+    Raises:
+        PermissionError: The directory is a link, belongs to another user or can be
+            used by other users
+    """
+
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise PermissionError(
+            f"{path} has to be a directory that only the current user can access"
+        )
+
+
+def check_peer(conn: socket.socket) -> None:
+    """Make sure that the process at the other end of a connection is our own user
+
+    Platforms without `SO_PEERCRED` rely on the permissions of the socket instead.
+
+    Args:
+        conn (socket.socket): Connection to check
+
+    Raises:
+        PermissionError: The other end runs as a different user
+    """
+
+    if not hasattr(socket, "SO_PEERCRED"):
+        return
+    size = struct.calcsize("3i")
+    _, uid, _ = struct.unpack(
+        "3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size)
+    )
+    if uid != os.getuid():
+        raise PermissionError(f"The other end of the socket runs as user {uid}")
@@ -4,122 +4,24 @@
 from __future__ import annotations
 import re
 import os
+import threading
+from calligraphy_scripting import cache
+from calligraphy_scripting import sourcemap
 from calligraphy_scripting import transpiler
-from calligraphy_scripting import utils
 
 
-def handle_sourcing(contents: str) -> str:
-    """Handle replacing Calligraphy source statements and recursively transpiling other files
+SOURCE_PATTERN = r"^[ \t]*source[ \t]+(?:([a-zA-Z0-9_/]*)\/)*([a-zA-Z0-9_]*)\.([a-zA-Z0-9]*)(?:[ \t]+(?P<lazy>lazy))?[ \t]*$"
+SOURCE_PATTERN_RENAME = r"^[ \t]*source[ \t]+(?:([a-zA-Z0-9_/]*)\/)*([a-zA-Z0-9_]*)\.([a-zA-Z0-9]*)[ \t]as[ \t]([a-zA-Z0-9_]*)(?:[ \t]+(?P<lazy>lazy))?[ \t]*"
 
-    Args:
-        contents (str): Contents of a Calligraphy script
-
-    Returns:
-        str: Contents of the Calligraphy script with the source statements replaced
-    """
-
-    def compile_sourced(matches):
-        for match in matches:
-            with open(
-                os.path.join(match[0], f"{match[1]}.{match[2]}"), encoding="utf-8"
-            ) as code_file:
-                code_contents = code_file.read()
-            code_contents, inline_indices = handle_line_breaks(code_contents)
-            lines, langs = determine_language(code_contents)
-            transpiled = transpiler.transpile(lines, langs, inline_indices)
-
-            # Add the header to enable functionality
-            header = utils.load_header()
-            header = header.replace('sys.argv = "PROGRAM_ARGS"', "")
-            code = f"{header}\n\n{transpiled}"
-            with open(
-                os.path.join(match[0], f".{match[1]}.py"), "w", encoding="utf-8"
-            ) as output_file:
-                output_file.write(code)
-
-    source_pattern = r"^[ \t]*source[ \t]+(?:([a-zA-Z0-9_/]*)\/)*([a-zA-Z0-9_]*)\.([a-zA-Z0-9]*)[ \t]*$"
-    source_pattern_rename = r"^[ \t]*source[ \t]+(?:([a-zA-Z0-9_/]*)\/)*([a-zA-Z0-9_]*)\.([a-zA-Z0-9]*)[ \t]as[ \t]([a-zA-Z0-9_]*)[ \t]*"
-
-    sourced = re.findall(source_pattern, contents, re.MULTILINE)
-    sourced_rename = re.findall(source_pattern_rename, contents, re.MULTILINE)
-
-    compile_sourced(sourced)
-    compile_sourced(sourced_rename)
-
-    contents = re.sub(
-        source_pattern,
-        '\g<2> = source_import(os.path.join("\g<1>", "\g<2>"+"."+"\g<3>"), "\g<2>")',
-        contents,
-        flags=re.MULTILINE,
-    )
-    contents = re.sub(
-        source_pattern_rename,
-        '\g<4> = source_import(os.path.join("\g<1>", "\g<2>"+"."+"\g<3>"), "\g<4>")',
-        contents,
-        flags=re.MULTILINE,
-    )
-
-    return contents
-
-
-def get_imports(contents: str) -> list[str]:
-    """Get all Python imports defined in the text
-
-    Args:
-        contents (str): Text to process
-
-    Returns:
-        list[str]: List of import names/aliases discovered
-    """
-
-    # Define the pattern to look for and search for it
-    import_pattern = r"import\s*(\S*)(?:\s*as\s*(\S*))?"
-    matches = re.findall(import_pattern, contents)
-    output = []
-
-    # Check if each match has an alias or not, record the name/alias
-    for match in matches:
-        if match[1]:
-            output.append(match[1])
-        else:
-            output.append(match[0])
-
-    return output
-
-
-def get_functions(contents: str) -> list[str]:
-    """Get all Python functions defined in the text
-
-    Args:
-        contents (str): Text to process
-
-    Returns:
-        list[str]: List of function names discovered
-    """
-
-    # Define the pattern to look for and search for it
-    function_pattern = r"def\s*([a-zA-Z0-9_]*)\("
-    output = re.findall(function_pattern, contents)
-    return output
-
-
-def determine_language(
-    code: str,
-) -> tuple[list[str], list[str], list[tuple[int, int, int]]]:
-    """Determine the language of each line of Calligraphy code
-
-    Args:
-        code (str): Contents of the Calligraphy script with newlines replaced
-
-    Returns:
-        tuple[list[str], list[str], list[tuple[int, int, int]]]: list of lines, detected
-            languages, and indices for inline Bash as detected in the Calligraphy script
-    """
 
-    keywords = [
+# Python keywords and builtins that mark a line as Python when they start it
+PYTHON_NAMES = frozenset(
+    [
         "and",
         "as",
         "assert",
+        "async",
+        "await",
         "break",
         "class",
         "continue",
@@ -164,23 +66,17 @@ def determine_language(
         "any",
         "ascii",
         "bin",
-        "bool",
-        "bytearray",
-        "bytes",
         "callable",
         "chr",
         "classmethod",
         "compile",
-        "complex",
         "delattr",
-        "dict",
         "dir",
         "divmod",
         "enumerate",
         "eval",
         "exec",
         "filter",
-        "float",
         "format",
         "frozenset",
         "getattr",
@@ -191,12 +87,10 @@ def determine_language(
         "hex",
         "id",
         "input",
-        "int",
         "isinstance",
         "insubclass",
         "iter",
         "len",
-        "list",
         "locals",
         "map",
         "max",
@@ -210,33 +104,299 @@ def determine_language(
         "pow",
         "print",
         "property",
-        "range",
         "repr",
         "reversed",
         "round",
-        "set",
         "setattr",
         "slice",
         "sorted",
         "staticmethod",
-        "str",
         "sum",
         "super",
-        "tuple",
         "type",
         "vars",
         "zip",
     ]
-    inline_bash_pattern = (
-        r'[\$?]\((.*)\)(?=([^"\\]*(\\.|"([^"\\]*\\.)*[^"\\]*"))*[^"]*$)'
+)
+
+IMPORT_PATTERN = re.compile(r"import\s*(\S*)(?:[ \t]+as[ \t]+(\S*))?")
+FUNCTION_PATTERN = re.compile(r"def\s*([a-zA-Z0-9_]*)\(")
+INLINE_BASH_PATTERN = re.compile(
+    r'[\$?]\((.*)\)(?=([^"\\]*(\\.|"([^"\\]*\\.)*[^"\\]*"))*[^"]*$)'
+)
+ASSIGNMENT_PATTERN = re.compile(r"^[ \t]*\(?((?:[a-zA-Z0-9_]+\s*,?\s*)+)\)?[ \t]$")
+PARALLEL_FOR_PATTERN = re.compile(
+    r"^([ \t]*)parallel(?:[ \t]*\([ \t]*jobs[ \t]*=[ \t]*([^()]+?)[ \t]*\))?[ \t]+for[ \t]+(.+?)[ \t]+in[ \t]+(.+?)[ \t]*:[ \t]*$",
+    re.MULTILINE,
+)
+
+# Objects of the runtime that scripts use directly
+RUNTIME_NAMES = frozenset(
+    ["env", "shellopts", "shell_hooks", "on_shell_start", "on_shell_end"]
+)
+
+# Name given to the functions that parallel for loops are turned into
+PARALLEL_FUNCTION_PREFIX = "__calligraphy_parallel_"
+
+
+# Characters that change the state of handle_line_breaks, with inline Bash markers
+# matched together with their opening parenthesis
+LINE_BREAK_TOKEN_PATTERN = re.compile(r"[$?!]\(|[\n'\"()\[\]{}]")
+
+# Index into the depth counters of handle_line_breaks and how each bracket changes it
+DEPTH_CHANGES = {
+    "(": (0, 1),
+    ")": (0, -1),
+    "{": (1, 1),
+    "}": (1, -1),
+    "[": (2, 1),
+    "]": (2, -1),
+}
+
+
+def get_sourced(contents: str) -> list[str]:
+    """Get the paths of all Calligraphy scripts sourced in the text
+
+    Args:
+        contents (str): Contents of a Calligraphy script
+
+    Returns:
+        list[str]: List of sourced script paths
+    """
+
+    matches = re.findall(SOURCE_PATTERN, contents, re.MULTILINE)
+    matches += re.findall(SOURCE_PATTERN_RENAME, contents, re.MULTILINE)
+    return [os.path.join(match[0], f"{match[1]}.{match[2]}") for match in matches]
+
+
+def get_compiled_path(path: str) -> str:
+    """Get the path that a sourced Calligraphy script is compiled to
+
+    Args:
+        path (str): Path of the sourced script
+
+    Returns:
+        str: Path of the compiled Python module next to the script
+    """
+
+    directory, script = os.path.split(path)
+    return os.path.join(directory, f".{os.path.splitext(script)[0]}.py")
+
+
+def load_sourced(paths: list[str]) -> dict[str, str]:
+    """Read sourced Calligraphy scripts along with every script they source in turn
+
+    Args:
+        paths (list[str]): Paths of the sourced scripts
+
+    Raises:
+        ImportError: The scripts source each other in a cycle
+
+    Returns:
+        dict[str, str]: Contents of each script keyed by its path, with scripts coming
+            after the scripts they source
+    """
+
+    sources = {}
+    visiting = []
+
+    def visit(path: str) -> None:
+        path = os.path.normpath(path)
+        if path in sources:
+            return
+        if path in visiting:
+            cycle = " -> ".join(visiting[visiting.index(path) :] + [path])
+            raise ImportError(f"Sourced scripts form a cycle: {cycle}")
+        visiting.append(path)
+        with open(path, encoding="utf-8") as code_file:
+            contents = code_file.read()
+        for sourced in get_sourced(contents):
+            visit(sourced)
+        visiting.pop()
+        sources[path] = contents
+
+    for path in paths:
+        visit(path)
+    return sources
+
+
+def compile_sourced(sources: dict[str, str]) -> None:
+    """Compile sourced Calligraphy scripts to the Python modules that `source` imports
+
+    Each module starts with a comment holding the cache key of the script it was
+    compiled from, so modules that are still up to date are left untouched.
+
+    Args:
+        sources (dict[str, str]): Contents of each script keyed by its path
+    """
+
+    prelude = sourcemap.RUNTIME_PRELUDE
+
+    # Transpiling holds the GIL throughout, so threads wouldn't speed this up. Scripts
+    # are built in the order they were read, after the scripts they source
+    for path, contents in sources.items():
+        stamp = f"# calligraphy: {cache.get_key(contents, prelude)}\n"
+        try:
+            with open(get_compiled_path(path), encoding="utf-8") as compiled_file:
+                if compiled_file.readline() == stamp:
+                    continue
+        except OSError:
+            pass
+
+        code_contents = handle_parallel(contents)
+        code_contents, inline_indices = handle_line_breaks(code_contents)
+        code_contents = replace_sourcing(code_contents)
+        lines, langs = determine_language(code_contents)
+        transpiled = transpiler.transpile(lines, langs, inline_indices)
+
+        # Replace the module in one go so that concurrent runs never see half of it
+        compiled_path = get_compiled_path(path)
+        temp_path = f"{compiled_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as output_file:
+            output_file.write(f"{stamp}{prelude}\n\n{transpiled}")
+        os.replace(temp_path, compiled_path)
+
+
+def handle_sourcing(contents: str, sources: dict[str, str] = None) -> str:
+    """Handle replacing Calligraphy source statements and compiling the sourced files
+
+    Args:
+        contents (str): Contents of a Calligraphy script
+        sources (dict[str, str], optional): Sourced scripts as read by `load_sourced`.
+            Defaults to reading the scripts sourced by the contents.
+
+    Returns:
+        str: Contents of the Calligraphy script with the source statements replaced
+    """
+
+    if sources is None:
+        sources = load_sourced(get_sourced(contents))
+    compile_sourced(sources)
+    return replace_sourcing(contents)
+
+
+def replace_sourcing(contents: str) -> str:
+    """Replace Calligraphy source statements with imports of the compiled scripts
+
+    Args:
+        contents (str): Contents of a Calligraphy script
+
+    Returns:
+        str: Contents of the Calligraphy script with the source statements replaced
+    """
+
+    def replace(match: re.Match, name: str) -> str:
+        directory, script, extension = match.group(1, 2, 3)
+        lazy = ", lazy=True" if match.group("lazy") else ""
+        return (
+            f'{name} = source_import(os.path.join("{directory or ""}", '
+            f'"{script}"+"."+"{extension}"), "{name}"{lazy})'
+        )
+
+    contents = re.sub(
+        SOURCE_PATTERN,
+        lambda match: replace(match, match.group(2)),
+        contents,
+        flags=re.MULTILINE,
     )
-    assignment_pattern = r"^[ \t]*\(?((?:[a-zA-Z0-9_]+\s*,?\s*)+)\)?[ \t]$"
+    contents = re.sub(
+        SOURCE_PATTERN_RENAME,
+        lambda match: replace(match, match.group(4)),
+        contents,
+        flags=re.MULTILINE,
+    )
+
+    return contents
+
+
+def handle_parallel(contents: str) -> str:
+    """Replace Calligraphy parallel for loops with their body run on a thread pool
+
+    The loop header becomes a function definition decorated with `parallel_for`, which
+    runs the body for every item as soon as the definition is complete
+
+    Args:
+        contents (str): Contents of a Calligraphy script
+
+    Returns:
+        str: Contents of the Calligraphy script with the parallel loops replaced
+    """
+
+    count = 0
+
+    def replace_loop(match):
+        nonlocal count
+        count += 1
+        indent, jobs, target, iterable = match.groups()
+        params = target.strip().strip("()")
+        unpack = "," in params
+        return (
+            f"{indent}@parallel_for({iterable}, jobs={jobs or None}, unpack={unpack})\n"
+            f"{indent}def {PARALLEL_FUNCTION_PREFIX}{count}({params}):"
+        )
+
+    return PARALLEL_FOR_PATTERN.sub(replace_loop, contents)
+
+
+def get_imports(contents: str) -> list[str]:
+    """Get all Python imports defined in the text
+
+    Args:
+        contents (str): Text to process
+
+    Returns:
+        list[str]: List of import names/aliases discovered
+    """
+
+    # Search for the pattern
+    matches = IMPORT_PATTERN.findall(contents)
+    output = []
+
+    # Check if each match has an alias or not, record the name/alias
+    for match in matches:
+        if match[1]:
+            output.append(match[1])
+        else:
+            output.append(match[0])
+
+    return output
+
+
+def get_functions(contents: str) -> list[str]:
+    """Get all Python functions defined in the text
+
+    Args:
+        contents (str): Text to process
+
+    Returns:
+        list[str]: List of function names discovered
+    """
+
+    # Search for the pattern
+    output = FUNCTION_PATTERN.findall(contents)
+    return output
+
+
+def determine_language(
+    code: str,
+) -> tuple[list[str], list[str], list[tuple[int, int, int]]]:
+    """Determine the language of each line of Calligraphy code
+
+    Args:
+        code (str): Contents of the Calligraphy script with newlines replaced
+
+    Returns:
+        tuple[list[str], list[str], list[tuple[int, int, int]]]: list of lines, detected
+            languages, and indices for inline Bash as detected in the Calligraphy script
+    """
 
     lines = [line for line in code.split("\n") if len(line.strip()) > 0]
-    variables = ["env", "shellopts"]
     langs = []
-    imports = get_imports(code)
-    functions = get_functions(code)
+
+    # Names that mark a line as Python, variables are added as assignments are found
+    python_names = set(PYTHON_NAMES) | RUNTIME_NAMES
+    python_names.update(get_imports(code))
+    python_names.update(get_functions(code))
 
     for line in lines:
         is_python = False
@@ -246,43 +406,31 @@ def determine_language(
             continue
 
         parts = get_parts(stripped)
-        for keyword in keywords:
-            if parts[0] == keyword:
-                is_python = True
-                break
-        for var in variables:
-            if parts[0] == var:
-                is_python = True
-                break
-        for imp in imports:
-            if parts[0] == imp:
-                is_python = True
-                break
-        for func in functions:
-            if parts[0] == func:
-                is_python = True
-                break
+        if parts[0] in python_names or stripped.startswith("@"):
+            is_python = True
         if not is_python:
-            inline_removed = re.sub(inline_bash_pattern, "<INLINE_BASH>", line)
+            inline_removed = INLINE_BASH_PATTERN.sub("<INLINE_BASH>", line)
             parts = inline_removed.split("=")
             if len(parts) > 1:
-                match = re.search(assignment_pattern, parts[0])
+                match = ASSIGNMENT_PATTERN.search(parts[0])
                 if match:
-                    variables += [var.strip() for var in match.group(1).split(",")]
-                    inline_match = re.search(inline_bash_pattern, line)
+                    python_names.update(
+                        var.strip() for var in match.group(1).split(",")
+                    )
+                    inline_match = INLINE_BASH_PATTERN.search(line)
                     if inline_match:
                         langs.append("MIX")
                         continue
                     langs.append("PYTHON")
                     continue
         else:
-            inline_match = re.search(inline_bash_pattern, line)
+            inline_match = INLINE_BASH_PATTERN.search(line)
             if inline_match:
                 langs.append("MIX")
                 continue
             langs.append("PYTHON")
             continue
-        if line.strip().startswith("source "):
+        if line.strip().startswith("source ") or PARALLEL_FOR_PATTERN.match(line):
             langs.append("CALLIGRAPHY")
             continue
         langs.append("BASH")
@@ -290,6 +438,30 @@ def determine_language(
     return lines, langs
 
 
+def get_line_numbers(code: str) -> list[int]:
+    """Get the line of the original script that each line of Calligraphy code starts on
+
+    Args:
+        code (str): Contents of the Calligraphy script with newlines replaced
+
+    Returns:
+        list[int]: Line number in the script of each line that `determine_language`
+            returns, starting from 1
+    """
+
+    numbers = []
+    number = 0
+    for line in code.split("\n"):
+        # parallel loops become a decorator and a function on the same script line
+        if not line.lstrip().startswith(f"def {PARALLEL_FUNCTION_PREFIX}"):
+            number += 1
+        if len(line.strip()) > 0:
+            numbers.append(number)
+        number += line.count("<CALLIGRAPHY_NEWLINE>")
+
+    return numbers
+
+
 def handle_line_breaks(code: str) -> str:
     """Go through Calligraphy script and replace linebreaks for ease of regex parsing
 
@@ -300,101 +472,64 @@ def handle_line_breaks(code: str) -> str:
         str: Calligraphy script with newlines replace with <CALLIGRAPHY_NEWLINE>
     """
 
-    depths = {"PAREN": 0, "BRACE": 0, "BRACKET": 0}
-    flags = {"SINGLE_QUOTE": False, "DOUBLE_QUOTE": False}
+    depths = [0, 0, 0]
+    single_quote = False
+    double_quote = False
     inline_indices = []
-    output = ""
+    chunks = []
+    chunk_start = 0
     line_idx = 0
-    char_idx = 0
-    in_inline = False
-    inline_paren_depth = 0
-
-    for idx, token in enumerate(code):
-        look_ahead = None
-        look_behind = None
-        if idx > 0:
-            look_behind = code[idx - 1]
-        if idx < len(code) - 1:
-            look_ahead = code[idx + 1]
-
-        if token == "'" and look_behind != "\\" and not flags["DOUBLE_QUOTE"]:
-            flags["SINGLE_QUOTE"] = not flags["SINGLE_QUOTE"]
-
-        if token == '"' and look_behind != "\\" and not flags["SINGLE_QUOTE"]:
-            flags["DOUBLE_QUOTE"] = not flags["DOUBLE_QUOTE"]
-
-        if (
-            token == "("
-            and look_behind != "\\"
-            and not (flags["SINGLE_QUOTE"] or flags["DOUBLE_QUOTE"])
-        ):
-            depths["PAREN"] += 1
-
-        if (
-            token == ")"
-            and look_behind != "\\"
-            and not (flags["SINGLE_QUOTE"] or flags["DOUBLE_QUOTE"])
-        ):
-            depths["PAREN"] -= 1
-            if in_inline:
-                if depths["PAREN"] == inline_paren_depth:
-                    inline_indices[-1][2] = char_idx + 1
-                    in_inline = False
-        if (
-            token == "{"
-            and look_behind != "\\"
-            and not (flags["SINGLE_QUOTE"] or flags["DOUBLE_QUOTE"])
-        ):
-            depths["BRACE"] += 1
-
-        if (
-            token == "}"
-            and look_behind != "\\"
-            and not (flags["SINGLE_QUOTE"] or flags["DOUBLE_QUOTE"])
-        ):
-            depths["BRACE"] -= 1
-
-        if (
-            token == "["
-            and look_behind != "\\"
-            and not (flags["SINGLE_QUOTE"] or flags["DOUBLE_QUOTE"])
-        ):
-            depths["BRACKET"] += 1
-
-        if (
-            token == "]"
-            and look_behind != "\\"
-            and not (flags["SINGLE_QUOTE"] or flags["DOUBLE_QUOTE"])
-        ):
-            depths["BRACKET"] -= 1
+    line_start = 0
+    # Characters added to the current line by replacing its newlines
+    line_shift = 0
+    # Paren depth and inline index of each inline Bash element that is still open
+    open_inlines = []
+
+    # Only characters that can change the parsing state need to be looked at, the
+    # rest of the script is copied over in slices
+    for match in LINE_BREAK_TOKEN_PATTERN.finditer(code):
+        idx = match.start()
+        token = match.group()
+        escaped = idx > 0 and code[idx - 1] == "\\"
 
         if token == "\n":
-            if look_behind != "\\":
-                if (
-                    depths["PAREN"] > 0
-                    or depths["BRACKET"] > 0
-                    or depths["BRACE"] > 0
-                    or flags["DOUBLE_QUOTE"]
-                ):
-                    output += "<CALLIGRAPHY_NEWLINE>"
-                    char_idx += 1
-                    continue
-                if char_idx != 0:
-                    line_idx += 1
-                char_idx = -1
+            if (
+                escaped
+                or depths[0] > 0
+                or depths[1] > 0
+                or depths[2] > 0
+                or double_quote
+            ):
+                chunks.append(code[chunk_start:idx])
+                chunks.append("<CALLIGRAPHY_NEWLINE>")
+                chunk_start = idx + 1
+                line_shift += len("<CALLIGRAPHY_NEWLINE>") - 1
             else:
-                output += "<CALLIGRAPHY_NEWLINE>"
-                char_idx += 1
-                continue
-        if token in ("$", "?", "!"):
-            if look_ahead == "(":
-                inline_paren_depth = depths["PAREN"]
-                in_inline = True
-                inline_indices.append([line_idx, char_idx, None])
-
-        output += token
-        char_idx += 1
-    return output, inline_indices
+                if idx != line_start:
+                    line_idx += 1
+                line_start = idx + 1
+                line_shift = 0
+        elif token == "'":
+            if not escaped and not double_quote:
+                single_quote = not single_quote
+        elif token == '"':
+            if not escaped and not single_quote:
+                double_quote = not double_quote
+        elif len(token) == 2:
+            open_inlines.append((depths[0], len(inline_indices)))
+            inline_indices.append([line_idx, idx - line_start + line_shift, None])
+            if not (single_quote or double_quote):
+                depths[0] += 1
+        elif not escaped and not (single_quote or double_quote):
+            depth_idx, change = DEPTH_CHANGES[token]
+            depths[depth_idx] += change
+            if open_inlines and token == ")" and depths[0] == open_inlines[-1][0]:
+                inline_indices[open_inlines.pop()[1]][2] = (
+                    idx - line_start + line_shift + 1
+                )
+
+    chunks.append(code[chunk_start:])
+    return "".join(chunks), inline_indices
 
 
 def get_in_depths(ignore: str, depths: dict) -> bool:
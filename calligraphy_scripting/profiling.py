@@ -0,0 +1,285 @@
+# pylint: disable=R0903
+"""Module to time the lines of a Calligraphy script while it runs"""
+
+from __future__ import annotations
+import os
+import sys
+import threading
+import time
+from calligraphy_scripting.sourcemap import COMPILED_NAME, SourceMap
+
+# Number of script lines shown in the profile report
+REPORT_LINES = 20
+# Phases of a shell call, split up by the runtime
+SHELL_PHASES = ("spawn", "command", "sync")
+
+
+class LineStats:
+    """Timings collected for a single line of the compiled code"""
+
+    def __init__(self) -> None:
+        """Initialize the LineStats object"""
+
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.phases = dict.fromkeys(SHELL_PHASES, 0.0)
+
+    def merge(self, other: LineStats) -> None:
+        """Add the timings of another line to this one
+
+        Args:
+            other (LineStats): Timings to add
+        """
+
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        for phase, elapsed in other.phases.items():
+            self.phases[phase] += elapsed
+
+
+class ShellTimer:
+    """Times the phases of one shell call and records them against the current line"""
+
+    def __init__(self, stats: LineStats) -> None:
+        """Initialize the ShellTimer object
+
+        Args:
+            stats (LineStats): Timings of the line making the shell call
+        """
+
+        self.stats = stats
+        self.last = time.perf_counter()
+        self.times = os.times()
+
+    def mark(self, phase: str) -> None:
+        """End a phase of the shell call
+
+        Args:
+            phase (str): Name of the phase that just ended
+        """
+
+        now = time.perf_counter()
+        self.stats.phases[phase] += now - self.last
+        self.last = now
+
+    def finish(self) -> None:
+        """End the shell call, the time since the last phase is spent syncing state"""
+
+        self.mark("sync")
+        times = os.times()
+        self.stats.cpu += (
+            times.children_user
+            - self.times.children_user
+            + times.children_system
+            - self.times.children_system
+        )
+
+
+class ThreadState:
+    """Line a thread is currently running and when it started running it"""
+
+    def __init__(self) -> None:
+        """Initialize the ThreadState object"""
+
+        self.stats = {}
+        self.lineno = None
+        self.last = time.perf_counter()
+        self.stack = []
+
+
+class Profiler:
+    """Line tracer for the compiled code of a Calligraphy script
+
+    Time is charged to the line of the script that is running, including the time
+    spent in the runtime on its behalf, so each line gets its wall time without the
+    lines of any script functions it calls. The runtime reports the phases of each
+    shell call through `start_shell`.
+    """
+
+    def __init__(self, source_map: SourceMap) -> None:
+        """Initialize the Profiler object
+
+        Args:
+            source_map (SourceMap): Map from the compiled code to the script
+        """
+
+        self.source_map = source_map
+        self.local = threading.local()
+        self.states = []
+        self.lock = threading.Lock()
+        self.previous = None
+        self.previous_threading = None
+
+    def get_state(self) -> ThreadState:
+        """Get the tracing state of the current thread
+
+        Returns:
+            ThreadState: State of the current thread
+        """
+
+        state = getattr(self.local, "state", None)
+        if state is None:
+            state = ThreadState()
+            self.local.state = state
+            with self.lock:
+                self.states.append(state)
+        return state
+
+    def charge(self, state: ThreadState) -> None:
+        """Charge the time since the last event to the line being run
+
+        Args:
+            state (ThreadState): State of the current thread
+        """
+
+        now = time.perf_counter()
+        if state.lineno is not None:
+            self.get_stats(state, state.lineno).wall += now - state.last
+        state.last = now
+
+    @staticmethod
+    def get_stats(state: ThreadState, lineno: int) -> LineStats:
+        """Get the timings of a line of compiled code in a thread
+
+        Args:
+            state (ThreadState): State of the current thread
+            lineno (int): Line of the compiled code
+
+        Returns:
+            LineStats: Timings of the line
+        """
+
+        stats = state.stats.get(lineno)
+        if stats is None:
+            stats = LineStats()
+            state.stats[lineno] = stats
+        return stats
+
+    def trace(self, frame, _event: str, _):
+        """Start tracing the lines of frames running the transpiled script
+
+        Args:
+            frame (frame): Frame that was entered
+            _event (str): Trace event, always `call`
+
+        Returns:
+            Callable: Local trace function or None to skip the frame
+        """
+
+        # Functions of the runtime are timed as part of the line calling them
+        if frame.f_code.co_filename != COMPILED_NAME:
+            return None
+        state = self.get_state()
+        self.charge(state)
+        state.stack.append(state.lineno)
+        return self.trace_line
+
+    def trace_line(self, frame, event: str, _):
+        """Move the time charged in a traced frame to the line it runs next
+
+        Args:
+            frame (frame): Frame being traced
+            event (str): Trace event
+
+        Returns:
+            Callable: This function to keep tracing the frame
+        """
+
+        if event == "line":
+            state = self.get_state()
+            self.charge(state)
+            lineno = frame.f_lineno
+            number = self.source_map.lookup(lineno)
+            if number is None:
+                state.lineno = None
+            else:
+                # a line is run again when it repeats itself, such as a loop header
+                previous = state.lineno
+                previous_number = None
+                if previous is not None:
+                    previous_number = self.source_map.lookup(previous)
+                if number != previous_number or lineno == previous:
+                    self.get_stats(state, lineno).calls += 1
+                state.lineno = lineno
+        elif event == "return":
+            state = self.get_state()
+            self.charge(state)
+            state.lineno = state.stack.pop() if state.stack else None
+        return self.trace_line
+
+    def start(self) -> None:
+        """Start tracing the current thread and any threads started afterwards"""
+
+        self.previous = sys.gettrace()
+        self.previous_threading = threading.gettrace()
+        self.get_state()
+        threading.settrace(self.trace)
+        sys.settrace(self.trace)
+
+    def stop(self) -> None:
+        """Stop tracing and restore any tracer that was there before"""
+
+        sys.settrace(self.previous)
+        threading.settrace(self.previous_threading)
+        state = self.get_state()
+        self.charge(state)
+
+    def start_shell(self) -> ShellTimer:
+        """Start timing a shell call made by the line being run
+
+        Returns:
+            ShellTimer: Timer for the phases of the call
+        """
+
+        state = self.get_state()
+        return ShellTimer(self.get_stats(state, state.lineno))
+
+    def collect(self) -> dict[int, LineStats]:
+        """Combine the timings of every thread by script line
+
+        Returns:
+            dict[int, LineStats]: Timings keyed by line number in the script
+        """
+
+        totals = {}
+        for state in self.states:
+            for lineno, stats in state.stats.items():
+                # shell calls made outside of the script, such as by the runtime
+                if lineno is None:
+                    continue
+                number = self.source_map.lookup(lineno)
+                if number is None:
+                    continue
+                totals.setdefault(number, LineStats()).merge(stats)
+        return totals
+
+    def report(self, limit: int = REPORT_LINES) -> str:
+        """Format the lines that took the most time as a table
+
+        Args:
+            limit (int, optional): Number of lines to show. Defaults to REPORT_LINES.
+
+        Returns:
+            str: Table of the slowest lines of the script
+        """
+
+        totals = self.collect()
+        ranked = sorted(totals.items(), key=lambda item: item[1].wall, reverse=True)
+        rows = [
+            f"Profile of {self.source_map.path}, top {min(limit, len(ranked))} of "
+            f"{len(ranked)} lines by wall time in seconds:",
+            f"{'Line':>6} {'Calls':>7} {'Wall':>9} {'Python':>9} {'Spawn':>9} "
+            f"{'Command':>9} {'Sync':>9} {'ChildCPU':>9}  Source",
+        ]
+        for number, stats in ranked[:limit]:
+            shell_time = sum(stats.phases.values())
+            rows.append(
+                f"{number:>6} {stats.calls:>7} {stats.wall:>9.4f} "
+                f"{max(stats.wall - shell_time, 0.0):>9.4f} "
+                f"{stats.phases['spawn']:>9.4f} {stats.phases['command']:>9.4f} "
+                f"{stats.phases['sync']:>9.4f} {stats.cpu:>9.4f}  "
+                f"{self.source_map.get_text(number)}"
+            )
+        return "\n".join(rows)
@@ -1,48 +1,144 @@
-# pylint: disable=R0801, W0703, W0122
-"""Module to allow for running Calligraphy scripts from other Python programs"""
+# pylint: disable=R0801, R0913, R0914, W0703, W0122, C0415
+"""Module to allow for running Calligraphy scripts from other Python programs
+
+The parser and transpiler are only imported when a script isn't in the cache yet, and
+the profiler and trace recorder only when they are asked for.
+"""
 import os
 import sys
-import traceback
-from calligraphy_scripting import parser
-from calligraphy_scripting import transpiler
-from calligraphy_scripting import utils
+from calligraphy_scripting import cache
+from calligraphy_scripting import runtime
+from calligraphy_scripting import sourcemap
 
 here = os.path.dirname(os.path.abspath(__file__))
+# Lines of compiled code before the transpiled script, the prelude and two blank lines
+PRELUDE_OFFSET = sourcemap.RUNTIME_PRELUDE.count("\n") + 2
+
+
+def compile_script(
+    contents: str, use_cache: bool = True, path: str = sourcemap.COMPILED_NAME
+) -> tuple:
+    """Transpile and compile Calligraphy code, going through the cache if allowed
+
+    Args:
+        contents (str): The Calligraphy code to compile
+        use_cache (bool, optional): Should the compiled script be read from and
+            written to the cache. Defaults to True.
+        path (str, optional): Path of the script to show in syntax errors. Defaults
+            to the name of the compiled code.
+
+    Raises:
+        SyntaxError: The transpiled script isn't valid Python, pointing at the line of
+            the script it came from
+
+    Returns:
+        tuple: The compiled code object and the script line of each transpiled line
+    """
+
+    prelude = sourcemap.RUNTIME_PRELUDE
+
+    code = None
+    if use_cache:
+        key = cache.get_key(contents, prelude)
+        code, numbers = cache.load(key)
 
+    if code is None:
+        from calligraphy_scripting import parser
+        from calligraphy_scripting import transpiler
 
-def execute(contents: str, args: list) -> None:
+        # Process the contents
+        processed = parser.handle_parallel(contents)
+        processed, inline_indices = parser.handle_line_breaks(processed)
+        line_numbers = parser.get_line_numbers(processed)
+        sources = parser.load_sourced(parser.get_sourced(processed))
+        processed = parser.handle_sourcing(processed, sources)
+        lines, langs = parser.determine_language(processed)
+        transpiled, line_map = transpiler.transpile_with_map(
+            lines, langs, inline_indices
+        )
+        numbers = [line_numbers[idx] for idx in line_map]
+
+        # Import the runtime to enable functionality
+        source = f"{prelude}\n\n{transpiled}"
+        try:
+            code = compile(source, sourcemap.COMPILED_NAME, "exec")
+        except SyntaxError as error:
+            source_map = sourcemap.SourceMap(PRELUDE_OFFSET, numbers, path, contents)
+            raise source_map.map_syntax_error(error) from None
+        if use_cache:
+            cache.store(key, source, code, list(sources), numbers)
+
+    return code, numbers
+
+
+def execute(
+    contents: str,
+    args: list,
+    use_cache: bool = True,
+    targets: tuple = (),
+    jobs: int = 1,
+    profile: bool = False,
+    trace: str = "",
+) -> None:
     """Run Calligraphy code from another program
 
     Args:
         contents (str): The Calligraphy code to run
-        args: (list): The arguments to pass to the script
+        args: (list): The arguments to pass to the script, the first of which is shown
+            as the path of the script in tracebacks
+        use_cache (bool, optional): Should the compiled script be read from and
+            written to the cache. Defaults to True.
+        targets (tuple, optional): Names of tasks to run once the script has been run.
+            Defaults to none.
+        jobs (int, optional): Number of tasks to run at once. Defaults to 1.
+        profile (bool, optional): Should the time spent on each line of the script be
+            reported on stderr once it is done. Defaults to False.
+        trace (str, optional): Path to write a Chrome trace of the shell calls of the
+            script to once it is done. Defaults to no trace.
     """
 
-    # Process the contents
-    contents, inline_indices = parser.handle_line_breaks(contents)
-    contents = parser.handle_sourcing(contents)
-    lines, langs = parser.determine_language(contents)
-    transpiled = transpiler.transpile(lines, langs, inline_indices)
+    path = args[0] if args else sourcemap.COMPILED_NAME
+    if path == "-":
+        path = "<stdin>"
+    try:
+        code, numbers = compile_script(contents, use_cache, path)
+    except SyntaxError as exception:
+        import traceback
 
-    # Add the header to enable functionality
-    header = utils.load_header()
-    header = header.replace('"PROGRAM_ARGS"', str(args))
-    code = f"{header}\n\n{transpiled}"
+        print("".join(traceback.format_exception_only(type(exception), exception)))
+        raise exception
+    source_map = sourcemap.SourceMap(PRELUDE_OFFSET, numbers, path, contents)
+
+    sys.argv = list(args)
+    runtime.reset()
 
     # Run the code
+    active_profiler = None
+    if profile:
+        from calligraphy_scripting import profiling
+
+        active_profiler = profiling.Profiler(source_map)
+        runtime.profiler = active_profiler
+        active_profiler.start()
+    recorder = None
+    if trace:
+        from calligraphy_scripting import tracing
+
+        recorder = tracing.TraceRecorder(path)
+        runtime.shell_hooks["end"].append(recorder.record)
     try:
-        exec(code, globals())
+        exec(code, {"__name__": "__main__"})
+        if targets:
+            runtime.run_tasks(*targets, jobs=jobs)
     except KeyboardInterrupt:
         sys.exit()
     except Exception as exception:
-        trace = traceback.format_exc()
-        parts = trace.split("\n")
-        idx = 1
-        exception_out = [parts[0]]
-        while not parts[idx].startswith('  File "<string>"') and idx < len(parts):
-            idx += 1
-        while idx < len(parts):
-            exception_out.append(parts[idx])
-            idx += 1
-        print("\n".join(exception_out))
+        print(source_map.format_exception(exception))
         raise exception
+    finally:
+        if active_profiler is not None:
+            active_profiler.stop()
+            runtime.profiler = None
+            print(active_profiler.report(), file=sys.stderr)
+        if recorder is not None:
+            recorder.write(trace)
@@ -0,0 +1,2879 @@
+# pylint: disable=W0603, C0103, C0302, R0902, R0903, R0911, R0912, R0913, R0914, R1732, W0621
+
+"""
+The runtime that transpiled calligraphy scripts import in order to run, shared by a
+script and every script it sources
+"""
+
+from __future__ import annotations
+import subprocess
+import os
+import sys
+import re
+import atexit
+import base64
+import shlex
+import threading
+import types
+import time
+import json
+import glob
+import hashlib
+import functools
+import shutil
+from typing import Iterator, Union
+import importlib.util
+
+# Names that transpiled scripts get from `from calligraphy_scripting.runtime import *`
+__all__ = [
+    "os",
+    "sys",
+    "RC",
+    "env",
+    "shellopts",
+    "attach",
+    "shell",
+    "ashell",
+    "shell_async",
+    "wait",
+    "jobs",
+    "Job",
+    "ShellPipe",
+    "CapturedOutput",
+    "parallel_for",
+    "source_import",
+    "task",
+    "run_tasks",
+    "shell_hooks",
+    "on_shell_start",
+    "on_shell_end",
+]
+
+
+class Environment:
+    """A class to act as a convenient method to access environment variables"""
+
+    def __init__(self) -> None:
+        """Initialize the Environment object"""
+
+    def __getattribute__(self, name: str) -> str:
+        """Retrieve an environment variable by name
+
+        Args:
+            name (str): Name of the environment variable to get
+
+        Returns:
+            str: Value of the environment variable accessed
+        """
+
+        return os.getenv(name)
+
+    def __setattr__(self, name: str, value: str) -> None:
+        """Set and environment variable to the given value
+
+        Args:
+            name (str): Name of the environment variable to set
+            value (str): Value to set the environment variable to
+        """
+
+        os.environ[name] = value
+
+
+class Options:
+    """A class to make setting of bash shell options more convenient"""
+
+    def __init__(self) -> None:
+        """Initialize the Options object and set all shell options to default values"""
+
+        # set command for the current values, built when it's first needed
+        self._bash_string = None
+
+        # ignores:
+        # * -n
+        # * -o noexec
+        # * -o emacs
+        # * -o vi
+        self.a = False
+        self.b = False
+        self.e = True  # non-default
+        self.f = False
+        self.h = True
+        self.k = False
+        self.m = False
+        self.p = False
+        self.t = False
+        self.u = False
+        self.v = False
+        self.x = False
+        self.B = True
+        self.C = False
+        self.E = False
+        self.H = True
+        self.P = False
+        self.T = False
+        self.history = True
+        self.ignoreeof = False
+        self.pipefail = True  # non-default
+        self.posix = False
+
+        self.keys = [
+            "a",
+            "b",
+            "e",
+            "f",
+            "h",
+            "k",
+            "m",
+            "p",
+            "t",
+            "u",
+            "v",
+            "x",
+            "B",
+            "C",
+            "E",
+            "H",
+            "P",
+            "T",
+            "history",
+            "ignoreeof",
+            "pipefail",
+            "posix",
+        ]
+
+    def __setattr__(self, name: str, value) -> None:
+        """Set an option and drop the set command built for the previous values
+
+        Args:
+            name (str): Name of the option
+            value (Any): Value to set it to
+        """
+
+        super().__setattr__(name, value)
+        if name != "_bash_string":
+            super().__setattr__("_bash_string", None)
+
+    def bash_string(self) -> None:
+        """Construct the set command for all the options and their values, the command is
+        kept until an option changes"""
+
+        if self._bash_string is not None:
+            return self._bash_string
+
+        true_single_opts = [
+            key for key in self.keys if bool(getattr(self, key)) and len(key) == 1
+        ]
+        false_single_opts = [
+            key for key in self.keys if not getattr(self, key) and len(key) == 1
+        ]
+        true_multiple_opts = [
+            key for key in self.keys if bool(getattr(self, key)) and len(key) > 1
+        ]
+        false_multiple_opts = [
+            key for key in self.keys if not getattr(self, key) and len(key) > 1
+        ]
+
+        string = "set "
+        if len(true_single_opts) > 0:
+            string += "-"
+            for opt in true_single_opts:
+                string += opt
+            string += " "
+        if len(false_single_opts) > 0:
+            string += "+"
+            for opt in false_single_opts:
+                string += opt
+            string += " "
+        for opt in true_multiple_opts:
+            string += f"-o {opt} "
+        for opt in false_multiple_opts:
+            string += f"+o {opt} "
+
+        self._bash_string = string
+        return string
+
+    def restore_string(self) -> str:
+        """Construct the set command that turns back on the options every command turns
+        off once it is done
+
+        Returns:
+            str: The set command, or a no-op if none of the options are on
+        """
+
+        enabled = "".join(key for key in RESET_OPTIONS if getattr(self, key))
+        return f"set -{enabled}" if enabled else ":"
+
+
+NAME_PATTERN = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+# Options that `wrap_command` turns off after every command
+RESET_OPTIONS = ("e", "u", "x", "v")
+STATUS_TOKEN = f"~~~~CALLIGRAPHY_STATUS_{os.urandom(8).hex()}~~~~"
+
+# Bash that reports the return code, working directory and, unless
+# `__calligraphy_report` is empty, the exported environment of a command as
+# NUL-delimited records
+STATUS_SCRIPT = f"""
+printf '\\n%s\\n%s\\0%s\\0' {STATUS_TOKEN} "$__calligraphy_rc" "$PWD"
+[[ -z $__calligraphy_report ]] || /usr/bin/env -0
+printf '\\0'
+"""
+# Anything in a command that could change the exported environment of the one-off bash
+# running it: assignments, arithmetic and the builtins that set or unset variables
+ENVIRON_CHANGE_PATTERN = re.compile(
+    r"=|\(\(|\$\[|\[[^]]*(?:\+\+|--)|(?:^|[\s;&|(])\.\s|(?<![\w-])(?:cd|coproc|"
+    r"declare|eval|export|for|getopts|let|local|mapfile|popd|printf|pushd|read|"
+    r"readarray|readonly|select|source|typeset|unset)(?![\w-])"
+)
+# Anything in a command that could leave code behind in a session that runs along with
+# later commands: functions, aliases, traps and the builtins that run other code
+DEFINITION_PATTERN = re.compile(
+    r"\(\s*\)|(?:^|[\s;&|(])\.\s|"
+    r"(?<![\w-])(?:alias|eval|function|source|trap)(?![\w-])"
+)
+
+
+# Bash builtins and keywords, commands starting with these always run in bash
+BASH_BUILTINS = frozenset(
+    """
+    . : [ [[ ]] { } ! alias bg bind break builtin caller case cd command compgen
+    complete compopt continue coproc declare dirs disown do done echo elif else enable
+    esac eval exec exit export false fc fg fi for function getopts hash help history if
+    in jobs kill let local logout mapfile popd printf pushd pwd read readarray readonly
+    return select set shift shopt source suspend test then time times trap true type
+    typeset ulimit umask unalias unset until wait while
+    """.split()
+)
+# Commands made only of plain words and quoted strings without any expansions, the
+# transpiler matches commands with their format fields replaced by a plain word
+SIMPLE_COMMAND_PATTERN = re.compile(
+    r"""(?:[\w@%+=:,./-]|[ \t]|'[^']*'|"[^"$`\\!]*")*"""
+)
+# Options of echo, which can be combined into a single argument
+ECHO_OPTION_PATTERN = re.compile(r"-[neE]+")
+# Variables bash refuses to unset
+READONLY_NAMES = frozenset(
+    ["BASHOPTS", "BASH_VERSINFO", "EUID", "PPID", "SHELLOPTS", "UID"]
+)
+# Variables that bash changes on every shell call, which are never synced
+UNSYNCED_NAMES = frozenset(["_", "SHLVL"])
+# Variables that bash or the runtime change on every shell call, left out of hooks
+UNREPORTED_NAMES = frozenset(["_", "SHLVL", "CALLIGRAPHY_RC"])
+# Paths of commands that have been run directly, keyed by name and PATH
+command_paths = {}
+
+# Size of the reads made when feeding a file object to the stdin of a command
+STDIN_CHUNK_SIZE = 1 << 16
+
+
+def wrap_command(cmd: str, options: str = None) -> str:
+    """Wrap a command with the current shell options and grab its return code
+
+    Args:
+        cmd (str): The command to wrap
+        options (str, optional): Set command to run before the command. Defaults to
+            setting every shell option.
+
+    Returns:
+        str: Bash that runs the command and stores its return code
+    """
+
+    # the trailing `&& :` keeps `set -e` from ending the shell when the command
+    # itself fails, then the options the status report relies on are reset without
+    # tracing it
+    return (
+        f"{options or shellopts.bash_string()} && {cmd} && :\n"
+        "{ __calligraphy_rc=$?; set +e +u +x +v; } 2>/dev/null"
+    )
+
+
+def iter_output(stream, silent: bool = False):
+    """Yield and print the lines of stdout of a command as they arrive
+
+    Args:
+        stream (BufferedReader): Stdout of the bash process
+        silent (bool, optional): Should the output to stdout be suppressed when
+            printing to the terminal. Defaults to False.
+
+    Yields:
+        str: Lines of stdout up to the status report
+
+    Returns:
+        bool: Whether the status report was reached
+    """
+
+    # only an empty last line can belong to the status report, so hold back empty
+    # lines until the next line shows whether they are output
+    empty = 0
+    finished = False
+    for raw in iter(stream.readline, b""):
+        if raw.endswith(b"\n"):
+            raw = raw[:-1]
+        if not raw:
+            empty += 1
+            continue
+        str_line = raw.decode("utf-8")
+        if str_line == STATUS_TOKEN:
+            finished = True
+            break
+        for _ in range(empty):
+            if not silent:
+                print("")
+            yield ""
+        empty = 0
+        if not silent:
+            print(str_line)
+        yield str_line
+
+    # the status report starts with a newline, so an empty last line is ours
+    if finished and empty:
+        empty -= 1
+    for _ in range(empty):
+        if not silent:
+            print("")
+        yield ""
+
+    return finished
+
+
+class CapturedOutput:
+    """Captured output too large to keep in memory, backed by a memory mapped file
+
+    Lengths and slices are in bytes like the `mmap` it wraps, while lines and reads are
+    decoded to str. `read` lets the output be passed to functions that take a file such
+    as `json.load`.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the CapturedOutput object with an empty temporary file"""
+
+        # only scripts capturing very large outputs need these
+        import tempfile  # pylint: disable=C0415
+
+        self.file = tempfile.TemporaryFile()
+        self.mmap = None
+        self.position = 0
+        self.empty = True
+
+    def write(self, line: str) -> None:
+        """Add a line of output to the file
+
+        Args:
+            line (str): Line without its newline
+        """
+
+        if not self.empty:
+            self.file.write(b"\n")
+        self.file.write(line.encode("utf-8"))
+        self.empty = False
+
+    def finish(self) -> CapturedOutput:
+        """Map the file into memory once all of the output has been written
+
+        Returns:
+            CapturedOutput: The object itself
+        """
+
+        import mmap  # pylint: disable=C0415
+
+        self.file.flush()
+        if not self.empty:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __len__(self) -> int:
+        return 0 if self.mmap is None else len(self.mmap)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[int, bytes]:
+        return (self.mmap or b"")[key]
+
+    def __bytes__(self) -> bytes:
+        return self[:]
+
+    def __str__(self) -> str:
+        return self[:].decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        return self.splitlines()
+
+    def splitlines(self) -> Iterator[str]:
+        """Yield the lines of the output without reading all of it into memory
+
+        Yields:
+            str: Lines of the output
+        """
+
+        start = 0
+        size = len(self)
+        while start < size:
+            end = self.mmap.find(b"\n", start)
+            if end == -1:
+                end = size
+            yield self.mmap[start:end].decode("utf-8")
+            start = end + 1
+
+    def read(self, size: int = -1) -> str:
+        """Read the output from the current position like a file
+
+        Args:
+            size (int, optional): Number of bytes to read. Defaults to the rest.
+
+        Returns:
+            str: Output that was read
+        """
+
+        end = len(self) if size < 0 else min(len(self), self.position + size)
+        data = self[self.position : end]
+        self.position = end
+        return data.decode("utf-8")
+
+    def close(self) -> None:
+        """Unmap and remove the file"""
+
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+    def __enter__(self) -> CapturedOutput:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def get_spill_size() -> Union[None, int]:
+    """Get the size past which captured output is kept in a temporary file
+
+    Returns:
+        Union[None, int]: Size in bytes from `CALLIGRAPHY_SPILL_SIZE` or None to keep
+            all output in memory when it isn't set
+    """
+
+    spill_size = os.getenv("CALLIGRAPHY_SPILL_SIZE")
+    return int(spill_size) if spill_size else None
+
+
+def read_output(stream, silent: bool = False, spill_size: int = None) -> tuple:
+    """Read and print the stdout of a command up to its status report
+
+    Args:
+        stream (BufferedReader): Stdout of the bash process
+        silent (bool, optional): Should the output to stdout be suppressed when
+            printing to the terminal. Defaults to False.
+        spill_size (int, optional): Size of output past which it is moved into a
+            `CapturedOutput`. Defaults to keeping it all in memory.
+
+    Returns:
+        tuple: Lines of stdout, or a `CapturedOutput` once it grew past `spill_size`,
+            and whether the status report was reached
+    """
+
+    stdout = []
+    size = 0
+    spilled = None
+    lines = iter_output(stream, silent)
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration as stop:
+            finished = bool(stop.value)
+            if spilled is not None:
+                return spilled.finish(), finished
+            return stdout, finished
+
+        if spilled is not None:
+            spilled.write(line)
+            continue
+        stdout.append(line)
+        # counting characters rather than bytes only spills multibyte output later
+        size += len(line) + 1
+        if spill_size is not None and size > spill_size:
+            spilled = CapturedOutput()
+            for held in stdout:
+                spilled.write(held)
+            stdout = []
+
+
+def join_output(stdout: Union[list, CapturedOutput]) -> Union[str, CapturedOutput]:
+    """Join the lines read by `read_output` into the captured output
+
+    Args:
+        stdout (Union[list, CapturedOutput]): Lines of stdout or the spilled output
+
+    Returns:
+        Union[str, CapturedOutput]: The output as a string unless it was spilled
+    """
+
+    if isinstance(stdout, CapturedOutput):
+        return stdout
+    return "\n".join(stdout)
+
+
+def split_status(status: bytes) -> tuple:
+    """Split a status report into its records
+
+    Args:
+        status (bytes): Status report up to and including the NUL that ends it
+
+    Returns:
+        tuple: Return code, working directory and the raw `env -0` output of the shell,
+            None if it wasn't reported
+    """
+
+    records = bytes(status[:-2]).split(b"\0", 2)
+    report = records[2] if len(records) > 2 else None
+    return int(records[0]), os.fsdecode(records[1]), report
+
+
+def read_status(stream) -> tuple:
+    """Read the status report of a command
+
+    Args:
+        stream (BufferedReader): Stdout of the bash process positioned after the
+            status token
+
+    Returns:
+        tuple: Return code, working directory and the raw `env -0` output of the shell,
+            None if it wasn't reported
+    """
+
+    status = bytearray()
+    while not status.endswith(b"\0\0"):
+        chunk = stream.read1(65536)
+        if not chunk:
+            break
+        status += chunk
+    return split_status(status)
+
+
+async def aread_output(stream, silent: bool = False) -> tuple:
+    """Read and print the stdout of a command up to its status report without blocking
+
+    Args:
+        stream (StreamReader): Stdout of the bash process
+        silent (bool, optional): Should the output to stdout be suppressed when
+            printing to the terminal. Defaults to False.
+
+    Returns:
+        tuple: Lines of stdout and whether the status report was reached
+    """
+
+    stdout = []
+    empty = 0
+    finished = False
+    while True:
+        raw = await stream.readline()
+        if not raw:
+            break
+        if raw.endswith(b"\n"):
+            raw = raw[:-1]
+        if not raw:
+            empty += 1
+            continue
+        str_line = raw.decode("utf-8")
+        if str_line == STATUS_TOKEN:
+            finished = True
+            break
+        for line in [""] * empty + [str_line]:
+            if not silent:
+                print(line)
+            stdout.append(line)
+        empty = 0
+
+    # the status report starts with a newline, so an empty last line is ours
+    if finished and empty:
+        empty -= 1
+    for line in [""] * empty:
+        if not silent:
+            print(line)
+        stdout.append(line)
+
+    return stdout, finished
+
+
+async def aread_status(stream) -> tuple:
+    """Read the status report of a command without blocking
+
+    Args:
+        stream (StreamReader): Stdout of the bash process positioned after the
+            status token
+
+    Returns:
+        tuple: Return code, working directory and the raw `env -0` output of the shell,
+            None if it wasn't reported
+    """
+
+    status = bytearray()
+    while not status.endswith(b"\0\0"):
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        status += chunk
+    return split_status(status)
+
+
+def environ_snapshot() -> dict:
+    """Get a copy of the environment that is cheap to take and to compare
+
+    Returns:
+        dict: Encoded names and values of the environment variables
+    """
+
+    # the encoded mapping behind os.environ copies and compares without decoding
+    # every variable, which keeps shell calls cheap in large environments
+    return os.environ._data.copy()  # pylint: disable=W0212
+
+
+def diff_environ(before: dict, after: dict) -> dict:
+    """Get the changes between two snapshots of the environment that are synced
+
+    Args:
+        before (dict): Encoded environment before
+        after (dict): Encoded environment after
+
+    Returns:
+        dict: Values of the changed variables, None for the ones that were unset
+    """
+
+    changes = {}
+    for key, value in after.items():
+        if before.get(key) != value:
+            changes[os.fsdecode(key)] = os.fsdecode(value)
+    for key in before:
+        if key not in after:
+            changes[os.fsdecode(key)] = None
+    # bash only reports variables with valid names, so leave any others alone
+    return {
+        name: value
+        for name, value in changes.items()
+        if name not in UNSYNCED_NAMES and NAME_PATTERN.match(name)
+    }
+
+
+class EnvironmentSync:
+    """Reads the environment changes out of the status reports of a kind of bash call
+
+    Most commands leave the environment alone, so the last report that didn't change
+    anything is kept along with the environment it was compared against. A report
+    that matches it byte for byte is known not to change anything without parsing it,
+    which keeps the cost of a shell call flat as the environment grows.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the EnvironmentSync object without a known report"""
+
+        self.unchanged = (None, None)
+
+    def clear(self) -> None:
+        """Forget the last report that didn't change anything"""
+
+        self.unchanged = (None, None)
+
+    def changes(self, sent: dict, report: bytes) -> dict:
+        """Get the changes a command made to the environment it was started with
+
+        Args:
+            sent (dict): Snapshot of the environment the command was started with
+            report (bytes): Raw `env -0` output of the shell after the command, None if
+                the command couldn't change the environment so it wasn't reported
+
+        Returns:
+            dict: Values of the changed variables, None for the ones that were unset
+        """
+
+        if report is None or self.unchanged == (sent, report):
+            return {}
+        after = {}
+        if report:
+            after = dict(record.split(b"=", 1) for record in report.split(b"\0"))
+        changes = diff_environ(sent, after)
+        if not changes:
+            self.unchanged = (sent, report)
+        return changes
+
+
+# Environment changes reported by one-off bash processes
+environ_sync = EnvironmentSync()
+
+
+def apply_environment(changes: dict) -> None:
+    """Apply the environment changes made by a shell command
+
+    Args:
+        changes (dict): Values of the changed variables, None for the ones that were
+            unset
+    """
+
+    for name, value in changes.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+def may_change_environ(cmd: str, sent: dict) -> bool:
+    """Check if a one-off bash process could change its exported environment
+
+    Args:
+        cmd (str): The command the process runs
+        sent (dict): Snapshot of the environment the process is started with
+
+    Returns:
+        bool: Could the command change the environment, which is only reported by
+            the process when it could
+    """
+
+    if ENVIRON_CHANGE_PATTERN.search(cmd):
+        return True
+    # exported functions and BASH_ENV run code that isn't part of the command
+    return b"BASH_ENV" in sent or b"\0BASH_FUNC_" in b"\0".join([b"", *sent])
+
+
+def get_call_environ() -> tuple:
+    """Get the environment a shell call is started with
+
+    Returns:
+        tuple: Snapshot of the environment to compare the report of the call with and
+            the environment to start its process with, None to inherit ours
+    """
+
+    sent = environ_snapshot()
+    # iterations of parallel loops keep their own RC
+    namespace = getattr(thread_state, "namespace", None)
+    if namespace is None:
+        return sent, None
+    sent[b"CALLIGRAPHY_RC"] = str(namespace["RC"]).encode("utf-8")
+    return sent, sent
+
+
+def feed_stdin(pipe, data) -> None:
+    """Write Python data to the stdin of a command, blocking while the pipe is full
+
+    Args:
+        pipe (BufferedWriter): Stdin of the command
+        data (Union[str, bytes, Iterable, IO]): Data to write. Strings are encoded as
+            UTF-8, file objects are read in chunks and other iterables are written one
+            item per line.
+
+    Raises:
+        Exception: Reading the data failed, the pipe is closed regardless
+    """
+
+    try:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            # large writes go straight to the pipe without being copied
+            pipe.write(memoryview(data))
+        elif hasattr(data, "read"):
+            while True:
+                chunk = data.read(STDIN_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                pipe.write(chunk)
+        else:
+            for item in data:
+                if not isinstance(item, (bytes, bytearray)):
+                    item = str(item).encode("utf-8")
+                pipe.write(item)
+                if not item.endswith(b"\n"):
+                    pipe.write(b"\n")
+    except BrokenPipeError:
+        # the command stopped reading (e.g. `head`)
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def check_stdin(data) -> None:
+    """Make sure data can be fed to the stdin of a command before starting it
+
+    Args:
+        data (Any): Data piped into the command
+
+    Raises:
+        TypeError: The data isn't a string, bytes, a file object or an iterable
+    """
+
+    if isinstance(data, (str, bytes, bytearray, memoryview)) or hasattr(data, "read"):
+        return
+    try:
+        iter(data)
+    except TypeError:
+        raise TypeError(
+            f"Can't pipe a '{type(data).__name__}' into a shell call"
+        ) from None
+
+
+class StdinFeeder:
+    """Thread that writes Python data to the stdin of a command as it reads it"""
+
+    def __init__(self, pipe, data) -> None:
+        """Start writing the data
+
+        Args:
+            pipe (BufferedWriter): Stdin of the command
+            data (Any): Data to write, see `feed_stdin`
+        """
+
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(pipe, data), daemon=True)
+        self.thread.start()
+
+    def run(self, pipe, data) -> None:
+        """Write the data and keep the error hit while reading it for `join`
+
+        Args:
+            pipe (BufferedWriter): Stdin of the command
+            data (Any): Data to write, see `feed_stdin`
+        """
+
+        try:
+            feed_stdin(pipe, data)
+        except Exception as exc:  # pylint: disable=W0703
+            self.error = exc
+
+    def join(self) -> None:
+        """Wait for the data to be written
+
+        Raises:
+            Exception: The error hit while reading the data
+        """
+
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def join_stdin(proc: subprocess.Popen) -> None:
+    """Wait for the data fed to a finished command and raise the error it hit if any
+
+    Args:
+        proc (subprocess.Popen): Process started by `start_process`
+
+    Raises:
+        Exception: The error hit while reading the data piped into the command
+    """
+
+    if proc.feeder is not None:
+        proc.feeder.join()
+
+
+def get_stdin_fd(data) -> Union[None, int]:
+    """Get a file descriptor the command can read data from directly
+
+    Args:
+        data (Any): Data piped into the command
+
+    Returns:
+        Union[None, int]: Descriptor of a seekable file positioned where the data starts
+            or None if the data has to be fed through a pipe
+    """
+
+    try:
+        if not data.seekable():
+            return None
+        # sync the descriptor offset with whatever the file object has buffered
+        data.seek(data.tell())
+        return data.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def start_process(
+    argv: list, environ: dict, stdin=None, executable: str = None
+) -> subprocess.Popen:
+    """Start a process with its stdout piped and data fed to its stdin
+
+    Args:
+        argv (list): Program and arguments to run
+        environ (dict): Environment to start the process with, None to inherit ours
+        stdin (Any, optional): Data to feed to the stdin of the process, see
+            `feed_stdin`. Defaults to no input.
+        executable (str, optional): Path of the program to run when it differs from
+            the first argument. Defaults to the first argument.
+
+    Returns:
+        subprocess.Popen: The started process
+    """
+
+    if stdin is None:
+        proc_stdin = subprocess.DEVNULL
+    else:
+        check_stdin(stdin)
+        proc_stdin = get_stdin_fd(stdin)
+        if proc_stdin is None:
+            proc_stdin = subprocess.PIPE
+
+    proc = subprocess.Popen(
+        argv,
+        executable=executable,
+        stdin=proc_stdin,
+        stdout=subprocess.PIPE,
+        env=environ,
+    )
+    proc.feeder = None
+    if proc_stdin == subprocess.PIPE:
+        # the feeder owns the pipe from here on and closes it once the data is written
+        proc.feeder = StdinFeeder(proc.stdin, stdin)
+        proc.stdin = None
+    return proc
+
+
+def get_script(cmd: str, report: bool = True) -> str:
+    """Get the bash that a one-off process runs for a command
+
+    Args:
+        cmd (str): The command to run
+        report (bool, optional): Should the exported environment be reported along
+            with the status of the command. Defaults to True.
+
+    Returns:
+        str: The command wrapped with the current shell options and its status report
+    """
+
+    flag = "1" if report else ""
+    return (
+        f"__calligraphy_report={flag}\n{wrap_command(cmd)}\n{STATUS_SCRIPT}\n"
+        'exit "$__calligraphy_rc"'
+    )
+
+
+def spawn(cmd: str, environ: dict, stdin=None, report: bool = True) -> subprocess.Popen:
+    """Start a one-off bash process that runs a command and reports its status
+
+    Args:
+        cmd (str): The command to run
+        environ (dict): Environment to start the process with, None to inherit ours
+        stdin (Any, optional): Data to feed to the stdin of the command, see
+            `feed_stdin`. Defaults to no input.
+        report (bool, optional): Should the exported environment be reported along
+            with the status of the command. Defaults to True.
+
+    Returns:
+        subprocess.Popen: The started process with its stdout piped
+    """
+
+    return start_process(["bash", "-c", get_script(cmd, report)], environ, stdin)
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_base64(cmd: str) -> str:
+    """Decode a command as it was encoded by the transpiler
+
+    Args:
+        cmd (str): Base64 encoded command
+
+    Returns:
+        str: The decoded command
+    """
+
+    return base64.b64decode(cmd.encode("utf-8")).decode("utf-8")
+
+
+def decode_command(cmd: str, format_dict: dict = None) -> str:
+    """Decode a command and fill in its format fields
+
+    Args:
+        cmd (str): Base64 encoded command
+        format_dict (dict, optional): Values of the names used by the format fields
+            of the command. Defaults to using the command as it is.
+
+    Returns:
+        str: The command to run
+    """
+
+    decoded = decode_base64(cmd)
+    if format_dict is None:
+        return decoded
+    return decoded.format(**format_dict)
+
+
+@functools.lru_cache(maxsize=1024)
+def split_simple_command(cmd: str) -> Union[None, tuple]:
+    """Get the argv of a command that needs nothing from bash beyond word splitting
+
+    A command qualifies when it is a list of words made of plain characters and quoted
+    strings without expansions, and doesn't start with a variable assignment.
+
+    Args:
+        cmd (str): The formatted command
+
+    Returns:
+        Union[None, tuple]: Program and arguments or None if bash is needed
+    """
+
+    if not SIMPLE_COMMAND_PATTERN.fullmatch(cmd):
+        return None
+    argv = shlex.split(cmd)
+    if not argv or not argv[0] or "=" in argv[0]:
+        return None
+    return tuple(argv)
+
+
+def get_logical_cwd() -> str:
+    """Get the working directory the way bash tracks it, keeping symlinks in the path
+
+    Returns:
+        str: Value of PWD if it still points at the working directory, else the
+            physical working directory
+    """
+
+    pwd = os.environ.get("PWD", "")
+    try:
+        if os.path.isabs(pwd) and os.path.samefile(pwd, "."):
+            return pwd
+    except OSError:
+        pass
+    return os.getcwd()
+
+
+def builtin_cd(args: tuple) -> Union[None, tuple]:
+    """Change directory like `cd` and update PWD and OLDPWD"""
+
+    # `set -P` makes cd resolve symlinks, which only bash does
+    if len(args) > 1 or (args and args[0].startswith("-")) or shellopts.P:
+        return None
+    target = args[0] if args else os.environ.get("HOME")
+    if not target or ("CDPATH" in os.environ and not target.startswith(("/", "."))):
+        return None
+    old_pwd = get_logical_cwd()
+    new_pwd = os.path.normpath(os.path.join(old_pwd, target))
+    if not os.path.isdir(new_pwd):
+        return None
+    try:
+        os.chdir(new_pwd)
+    except OSError:
+        # let bash fail the same way, with its message and return code
+        return None
+    os.environ["OLDPWD"] = old_pwd
+    os.environ["PWD"] = new_pwd
+    return "", 0
+
+
+def builtin_export(args: tuple) -> Union[None, tuple]:
+    """Set environment variables like `export NAME=value`"""
+
+    assignments = [arg.split("=", 1) if "=" in arg else [arg, None] for arg in args]
+    if not args or any(not NAME_PATTERN.match(name) for name, _ in assignments):
+        return None
+    for name, value in assignments:
+        # exporting a variable without a value leaves a one-off shell unchanged
+        if value is not None:
+            os.environ[name] = value
+    return "", 0
+
+
+def builtin_unset(args: tuple) -> Union[None, tuple]:
+    """Remove environment variables like `unset NAME`"""
+
+    if any(not NAME_PATTERN.match(name) or name in READONLY_NAMES for name in args):
+        return None
+    for name in args:
+        os.environ.pop(name, None)
+    return "", 0
+
+
+def builtin_echo(args: tuple) -> Union[None, tuple]:
+    """Write arguments like `echo`, leaving escapes and backslashes to bash"""
+
+    newline = "\n"
+    while args and ECHO_OPTION_PATTERN.fullmatch(args[0]):
+        if "e" in args[0]:
+            return None
+        if "n" in args[0]:
+            newline = ""
+        args = args[1:]
+    if any("\\" in arg for arg in args):
+        return None
+    return " ".join(args) + newline, 0
+
+
+def builtin_mkdir(args: tuple) -> Union[None, tuple]:
+    """Create directories like `mkdir -p`"""
+
+    paths = [arg for arg in args if arg != "-p"]
+    if len(paths) == len(args) or not paths or any(p.startswith("-") for p in paths):
+        return None
+    try:
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return "", 0
+
+
+def builtin_rm(args: tuple) -> Union[None, tuple]:
+    """Remove files and directories like `rm -r`"""
+
+    options = "".join(arg[1:] for arg in args if arg.startswith("-"))
+    paths = [arg for arg in args if not arg.startswith("-")]
+    if not paths or options.strip("rRf") or not options.strip("f"):
+        return None
+    for path in paths:
+        if os.path.basename(path.rstrip("/")) in ("", ".", ".."):
+            return None
+        if not os.path.lexists(path) and "f" not in options:
+            return None
+    try:
+        for path in paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+    except OSError:
+        return None
+    return "", 0
+
+
+def builtin_cp(args: tuple) -> Union[None, tuple]:
+    """Copy files and directories like `cp -r`"""
+
+    options = "".join(arg[1:] for arg in args if arg.startswith("-"))
+    paths = [arg for arg in args if not arg.startswith("-")]
+    if not options or options.strip("rR") or len(paths) < 2:
+        return None
+    *sources, dest = paths
+    into = os.path.isdir(dest)
+    if len(sources) > 1 and not into:
+        return None
+    targets = []
+    for source in sources:
+        target = dest
+        if into:
+            target = os.path.join(dest, os.path.basename(source.rstrip("/")))
+        real_source = os.path.realpath(source)
+        if os.path.islink(source) or not os.path.exists(source):
+            return None
+        if os.path.realpath(target).startswith(real_source + os.sep):
+            return None
+        if os.path.isdir(target) != os.path.isdir(source) and os.path.exists(target):
+            return None
+        targets.append((source, target))
+    try:
+        for source, target in targets:
+            if os.path.isdir(source):
+                shutil.copytree(source, target, symlinks=True, dirs_exist_ok=True)
+            else:
+                shutil.copy(source, target)
+    except (OSError, shutil.Error):
+        return None
+    return "", 0
+
+
+def builtin_mv(args: tuple) -> Union[None, tuple]:
+    """Move files and directories like `mv`"""
+
+    if len(args) < 2 or any(arg.startswith("-") for arg in args):
+        return None
+    *sources, dest = args
+    into = os.path.isdir(dest)
+    if len(sources) > 1 and not into:
+        return None
+    targets = []
+    for source in sources:
+        target = dest
+        if into:
+            target = os.path.join(dest, os.path.basename(source.rstrip("/")))
+        if not os.path.lexists(source) or os.path.isdir(target):
+            return None
+        targets.append((source, target))
+    try:
+        for source, target in targets:
+            shutil.move(source, target)
+    except OSError:
+        return None
+    return "", 0
+
+
+# Commands run in-process when used on their own, each returns its output and return
+# code or None when the command has to run in bash to get its exact behavior
+BUILTIN_COMMANDS = {
+    "cd": builtin_cd,
+    "export": builtin_export,
+    "unset": builtin_unset,
+    "true": lambda args: ("", 0),
+    "false": lambda args: ("", 1),
+    "echo": builtin_echo,
+    "mkdir": builtin_mkdir,
+    "rm": builtin_rm,
+    "cp": builtin_cp,
+    "mv": builtin_mv,
+}
+# Bash builtins the runtime can run in-process instead
+IN_PROCESS_BUILTINS = BASH_BUILTINS.intersection(BUILTIN_COMMANDS)
+
+
+def find_command(name: str, search_path: str) -> Union[None, str]:
+    """Find the executable of a command, remembering where it was like `hash` does
+
+    Args:
+        name (str): Name or path of the command
+        search_path (str): Value of PATH to search
+
+    Returns:
+        Union[None, str]: Path of the executable or None if it can't be found
+    """
+
+    if "/" in name:
+        if os.path.isfile(name) and os.access(name, os.X_OK):
+            return name
+        return None
+
+    key = (name, search_path)
+    path = command_paths.get(key)
+    if path is not None and os.access(path, os.X_OK):
+        return path
+    path = shutil.which(name, path=search_path)
+    if path is None:
+        command_paths.pop(key, None)
+    else:
+        command_paths[key] = path
+    return path
+
+
+class Session:
+    """A long-lived bash process that runs every shell command of a script
+
+    Commands are written one per line to a dedicated pipe and each one is followed by
+    a status report on stdout, so bash functions, aliases and shell state persist from
+    one Bash line to the next.
+    """
+
+    # mapfile reads the line whatever IFS is set to, where `IFS= read` would pass a
+    # temporary variable that makes bash rebuild the environment of every command
+    driver = """
+shopt -s expand_aliases
+while mapfile -t -n 1 -u FD __calligraphy_lines && ((${#__calligraphy_lines[@]})); do
+    printf -v __calligraphy_line '%b' "${__calligraphy_lines[0]}"
+    eval "$__calligraphy_line"
+    STATUS
+done
+"""
+
+    def __init__(self) -> None:
+        """Initialize the Session object, the bash process is started on first use"""
+
+        self.proc = None
+        self.commands = None
+        self.synced = {}
+        self.sync = EnvironmentSync()
+        self.defined = False
+        self.cwd = ""
+        self.options = ""
+
+    def start(self) -> None:
+        """Start the bash process and remember the state it was started with"""
+
+        read_fd, write_fd = os.pipe()
+        driver = self.driver.replace("FD", str(read_fd)).replace(
+            "STATUS", STATUS_SCRIPT
+        )
+        self.proc = subprocess.Popen(
+            ["bash", "--noprofile", "--norc", "-c", driver],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            pass_fds=(read_fd,),
+        )
+        os.close(read_fd)
+        self.commands = os.fdopen(write_fd, "wb")
+        self.synced = environ_snapshot()
+        self.defined = may_change_environ("", self.synced)
+        self.cwd = os.getcwd()
+        self.options = ""
+
+    def close(self) -> None:
+        """Stop the bash process if it is running"""
+
+        if self.proc is None:
+            return
+        try:
+            self.commands.close()
+        except BrokenPipeError:
+            pass
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.proc = None
+
+    def prelude(self) -> list:
+        """Get the commands that bring the bash process in line with the Python side
+
+        Returns:
+            list: Commands to sync the environment and working directory
+        """
+
+        lines = ["set +e"]
+        current = environ_snapshot()
+        if current != self.synced:
+            for name, value in diff_environ(self.synced, current).items():
+                if value is None:
+                    lines.append(f"unset {name} 2>/dev/null")
+                else:
+                    lines.append(f"export {name}={shlex.quote(value)} 2>/dev/null")
+            self.synced = current
+        cwd = os.getcwd()
+        if cwd != self.cwd:
+            lines.append(f"cd -- {shlex.quote(cwd)}")
+        return lines
+
+    def get_script(self, cmd: str) -> str:
+        """Get the bash that syncs the bash process and then runs a command in it
+
+        Args:
+            cmd (str): The command to run
+
+        Returns:
+            str: The command wrapped with its prelude and shell options
+        """
+
+        # the bash process keeps the options it was last given apart from the ones
+        # every command turns off, so only those are turned back on until they change
+        options = shellopts.bash_string()
+        if options == self.options:
+            options = shellopts.restore_string()
+        else:
+            self.options = options
+        prelude = self.prelude()
+        # only commands that could change the environment report it, unless the
+        # session may have picked up code that runs along with every command
+        if DEFINITION_PATTERN.search(cmd):
+            self.defined = True
+        reported = self.defined or ENVIRON_CHANGE_PATTERN.search(
+            "\n".join(prelude + [cmd])
+        )
+        flag = f"__calligraphy_report={'1' if reported else ''}"
+        return "\n".join([flag] + prelude + [wrap_command(cmd, options)])
+
+    def run(self, cmd: str, silent: bool = False, spill_size: int = None) -> tuple:
+        """Run a command in the bash process, starting it if needed
+
+        Args:
+            cmd (str): The command to run
+            silent (bool, optional): Should the output to stdout be suppressed when
+                printing to the terminal. Defaults to False.
+            spill_size (int, optional): Size of output past which it is moved into a
+                `CapturedOutput`. Defaults to keeping it all in memory.
+
+        Returns:
+            tuple: Lines of stdout, return code, environment changes and working
+                directory after the command. The environment changes and working
+                directory are None if the command terminated the bash process.
+        """
+
+        if self.proc is None:
+            self.start()
+
+        line = self.get_script(cmd).replace("\\", "\\\\").replace("\n", "\\n")
+        try:
+            self.commands.write(line.encode("utf-8") + b"\n")
+            self.commands.flush()
+        except BrokenPipeError:
+            pass
+
+        stdout, finished = read_output(self.proc.stdout, silent, spill_size)
+
+        if not finished:
+            # the command ended the bash process (e.g. `exit` or `set -e`), so the
+            # shell state is gone and a fresh process is started for the next command
+            self.commands.close()
+            self.proc.stdout.close()
+            return_code = self.proc.wait()
+            self.proc = None
+            return stdout, return_code, None, None
+
+        return_code, self.cwd, report = read_status(self.proc.stdout)
+        changes = self.sync.changes(self.synced, report)
+        if changes:
+            self.synced = dict(self.synced)
+            for name, value in changes.items():
+                if value is None:
+                    self.synced.pop(os.fsencode(name), None)
+                else:
+                    self.synced[os.fsencode(name)] = os.fsencode(value)
+        return stdout, return_code, changes, self.cwd
+
+
+class ProcessSlots:
+    """Cap on the number of processes running at once, shared by threads and coroutines
+
+    Threads block on the slots like on a semaphore, while coroutines wait to be woken
+    up by the next release so that they don't block their event loop.
+    """
+
+    def __init__(self, count: int) -> None:
+        """Initialize the ProcessSlots object
+
+        Args:
+            count (int): Number of processes that may run at once
+        """
+
+        self.count = count
+        self.semaphore = threading.BoundedSemaphore(count)
+        self.lock = threading.Lock()
+        # event loops and futures of the coroutines waiting for a slot
+        self.waiters = []
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take a slot, waiting for one to be released if there are none left
+
+        Args:
+            blocking (bool, optional): Should the call wait for a slot. Defaults to
+                True.
+
+        Returns:
+            bool: Was a slot taken
+        """
+
+        return self.semaphore.acquire(blocking)
+
+    async def acquire_async(self) -> None:
+        """Take a slot, waiting for one to be released without blocking the event loop
+
+        Cancelling the wait leaves the slots as they were.
+        """
+
+        # asyncio is only loaded by scripts that await shell calls
+        import asyncio  # pylint: disable=C0415
+
+        loop = asyncio.get_running_loop()
+        while not self.acquire(blocking=False):
+            waiter = (loop, loop.create_future())
+            with self.lock:
+                self.waiters.append(waiter)
+            try:
+                # a slot may have been released before the waiter was added
+                if self.acquire(blocking=False):
+                    return
+                await waiter[1]
+            finally:
+                with self.lock:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+
+    def release(self) -> None:
+        """Give back a slot and wake up the coroutines waiting for one"""
+
+        self.semaphore.release()
+        with self.lock:
+            waiters = self.waiters
+            self.waiters = []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(wake_future, future)
+            except RuntimeError:
+                # the event loop of the waiter has already been closed
+                pass
+
+    def __enter__(self) -> ProcessSlots:
+        self.acquire()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.release()
+
+
+def wake_future(future) -> None:
+    """Mark a future as done unless it has already been cancelled
+
+    Args:
+        future (asyncio.Future): Future a coroutine is waiting on
+    """
+
+    if not future.done():
+        future.set_result(None)
+
+
+class LazyModule(types.ModuleType):
+    """A sourced module that is only run once a name is first looked up on it"""
+
+    def __getattr__(self, name: str):
+        """Run the module to look up a name it doesn't have yet
+
+        Args:
+            name (str): Name being looked up
+
+        Raises:
+            AttributeError: The module doesn't define the name or is still running
+
+        Returns:
+            Any: Value of the name once the module has run
+        """
+
+        load_lazy_module(self)
+        # the module looked itself up while running, as with a partially run import
+        if isinstance(self, LazyModule):
+            raise AttributeError(
+                f"partially initialized module '{self.__name__}' has no attribute "
+                f"'{name}'"
+            )
+        return getattr(self, name)
+
+
+def load_lazy_module(module: types.ModuleType) -> None:
+    """Run a lazily sourced module if it hasn't been run yet
+
+    Args:
+        module (types.ModuleType): Module returned by `source_import`
+    """
+
+    lock = getattr(module, "__calligraphy_lock__", None)
+    if lock is None:
+        return
+    with lock:
+        if not module.__calligraphy_pending__:
+            return
+        module.__calligraphy_pending__ = False
+        try:
+            module.__spec__.loader.exec_module(module)
+        except BaseException:
+            if sys.modules.get(module.__name__) is module:
+                del sys.modules[module.__name__]
+            raise
+        finally:
+            module.__class__ = types.ModuleType
+
+
+def source_import(calligraphy_path, module_name, lazy=False):
+    """Import the compiled module of a sourced script, reusing it if it was already run
+
+    Args:
+        calligraphy_path (str): Path to the sourced script
+        module_name (str): Name to import the module under
+        lazy (bool, optional): Should running the module be put off until one of its
+            names is first used. Defaults to False.
+
+    Raises:
+        ImportError: The path doesn't end with the `.script` extension
+        FileNotFoundError: The sourced script doesn't exist
+
+    Returns:
+        ModuleType: The module of the sourced script
+    """
+
+    if not calligraphy_path.endswith(".script"):
+        raise ImportError(
+            "Calligraphy only support sourcing other scripts that end with the '.script' extension"
+        )
+    if not os.path.exists(calligraphy_path):
+        raise FileNotFoundError(
+            f"Sourced script of '{calligraphy_path}' does not exist"
+        )
+
+    directory, script = os.path.split(calligraphy_path)
+    python_path = os.path.abspath(os.path.join(directory, f".{script[:-7]}.py"))
+
+    # Reuse the module if it was already run and hasn't been recompiled since
+    mtime = os.stat(python_path).st_mtime_ns
+    module = sys.modules.get(module_name)
+    if (
+        getattr(module, "__file__", None) == python_path
+        and getattr(module, "__calligraphy_mtime__", None) == mtime
+    ):
+        if not lazy:
+            load_lazy_module(module)
+        return module
+
+    spec = importlib.util.spec_from_file_location(module_name, python_path)
+    module = importlib.util.module_from_spec(spec)
+    module.__calligraphy_mtime__ = mtime
+    sys.modules[module_name] = module
+    if lazy:
+        module.__calligraphy_lock__ = threading.RLock()
+        module.__calligraphy_pending__ = True
+        module.__class__ = LazyModule
+        return module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        sys.modules.pop(module_name, None)
+        raise
+    return module
+
+
+def get_max_procs() -> int:
+    """Get the number of shell calls that may run at once
+
+    Returns:
+        int: Value of `CALLIGRAPHY_MAX_PROCS`, or four per CPU when it isn't set
+    """
+
+    return int(os.getenv("CALLIGRAPHY_MAX_PROCS", str(4 * (os.cpu_count() or 1))))
+
+
+RC = 0
+env = Environment()
+shellopts = Options()
+session = Session() if os.getenv("CALLIGRAPHY_SESSION") == "1" else None
+# Globals of the scripts being run, which read `RC` as one of their own names
+namespaces = []
+# Cap on the number of shell calls running at once so large loops can't fork storm
+process_slots = ProcessSlots(get_max_procs())
+# Namespace and output buffer of the `parallel for` iteration running on a thread
+thread_state = threading.local()
+# Times the phases of shell calls when the runner profiles the script
+profiler = None
+# Functions called around every shell call, see `on_shell_start` and `on_shell_end`
+shell_hooks = {"start": [], "end": []}
+
+
+def attach(namespace: dict) -> None:
+    """Keep the `RC` of a script's globals in step with the runtime
+
+    Args:
+        namespace (dict): Globals of the script
+    """
+
+    namespace["RC"] = RC
+    namespaces.append(namespace)
+
+
+def set_rc(return_code: int) -> None:
+    """Set the return code of the last shell call for every script being run
+
+    Args:
+        return_code (int): Return code of the call
+    """
+
+    global RC
+
+    RC = return_code
+    for namespace in namespaces:
+        namespace["RC"] = return_code
+    os.environ["CALLIGRAPHY_RC"] = str(return_code)
+
+
+def close_session() -> None:
+    """Stop the bash process of session mode if there is one"""
+
+    if session is not None:
+        session.close()
+
+
+atexit.register(close_session)
+
+
+class ShellCall:
+    """A shell call as seen by the functions registered as shell hooks
+
+    Start hooks get the call once its process is running, with `cmd`, `kind` (one of
+    `shell`, `stream`, `async` or `background`), `pid` (None for commands run
+    in-process), `thread` and the `start` time since the epoch set. End hooks also get
+    `rc`, `duration` in seconds, `stdout_bytes`, the names of the environment variables
+    the call changed in `env_changed` and the new working directory in `new_cwd`, or
+    None if it didn't change. Hooks of background calls are run on another thread.
+    """
+
+    def __init__(self, cmd: str, kind: str) -> None:
+        """Initialize the ShellCall object before its process is started
+
+        Args:
+            cmd (str): The formatted command
+            kind (str): How the call is run
+        """
+
+        self.cmd = cmd
+        self.kind = kind
+        self.pid = None
+        self.thread = threading.get_ident()
+        self.start = time.time()
+        self.rc = None
+        self.duration = None
+        self.stdout_bytes = 0
+        self.env_changed = []
+        self.cwd = os.getcwd()
+        self.new_cwd = None
+        self.started = time.perf_counter()
+
+    def begin(self, pid: Union[None, int] = None) -> None:
+        """Run the start hooks now that the process of the call is running
+
+        Args:
+            pid (Union[None, int], optional): Process id of the call. Defaults to None.
+        """
+
+        self.pid = pid
+        for hook in shell_hooks["start"]:
+            hook(self)
+
+    def end(
+        self,
+        return_code: int,
+        stdout: Union[None, str, list, CapturedOutput],
+        changes: dict,
+        applied: bool = True,
+    ) -> None:
+        """Run the end hooks once the status of the call has been applied
+
+        Args:
+            return_code (int): Return code of the call
+            stdout (Union[None, str, list, CapturedOutput]): Output of the call, or
+                None if its size was counted as it was read
+            changes (dict): Environment changes made by the call
+            applied (bool, optional): Were the changes applied to the script, when
+                they aren't the working directory is left alone too. Defaults to True.
+        """
+
+        self.rc = return_code
+        self.duration = time.perf_counter() - self.started
+        if isinstance(stdout, list):
+            stdout = "\n".join(stdout)
+        if isinstance(stdout, CapturedOutput):
+            self.stdout_bytes = len(stdout)
+        elif stdout is not None:
+            self.stdout_bytes = len(stdout.encode("utf-8"))
+        if applied:
+            cwd = os.getcwd()
+            self.new_cwd = cwd if cwd != self.cwd else None
+        self.env_changed = sorted(
+            name for name in changes if name not in UNREPORTED_NAMES
+        )
+        for hook in shell_hooks["end"]:
+            hook(self)
+
+
+def new_call(cmd: str, kind: str) -> Union[None, ShellCall]:
+    """Get a ShellCall for the hooks to see, if there are any
+
+    Args:
+        cmd (str): The formatted command
+        kind (str): How the call is run
+
+    Returns:
+        Union[None, ShellCall]: The call or None when no hooks are registered
+    """
+
+    if not (shell_hooks["start"] or shell_hooks["end"]):
+        return None
+    return ShellCall(cmd, kind)
+
+
+def count_output(lines: Iterator[str], call: ShellCall) -> Iterator[str]:
+    """Count the bytes of output of a streamed call as its lines are read
+
+    Args:
+        lines (Iterator[str]): Lines read from the call, see `iter_output`
+        call (ShellCall): Call to count the output for
+
+    Yields:
+        str: The lines read from the call
+    """
+
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration as stop:
+            return stop.value
+        call.stdout_bytes += len(line.encode("utf-8")) + 1
+        yield line
+
+
+def on_shell_start(func: types.FunctionType) -> types.FunctionType:
+    """Register a function to be called with a ShellCall as each shell call starts
+
+    Args:
+        func (types.FunctionType): Function to register, it can be used as a decorator
+
+    Returns:
+        types.FunctionType: The registered function
+    """
+
+    shell_hooks["start"].append(func)
+    return func
+
+
+def on_shell_end(func: types.FunctionType) -> types.FunctionType:
+    """Register a function to be called with a ShellCall as each shell call ends
+
+    Args:
+        func (types.FunctionType): Function to register, it can be used as a decorator
+
+    Returns:
+        types.FunctionType: The registered function
+    """
+
+    shell_hooks["end"].append(func)
+    return func
+
+
+def apply_status(
+    return_code: int, changes: dict, cwd_path: str, check: bool = True
+) -> None:
+    """Apply the return code, environment and directory of a finished shell call
+
+    Args:
+        return_code (int): Return code of the call
+        changes (dict): Environment changes made by the call, None if unknown
+        cwd_path (str): Directory the shell exited in, None if unknown
+        check (bool, optional): Should a non-zero return code raise while
+            `shellopts.e` is set. Defaults to True.
+
+    Raises:
+        RuntimeError: The shell command exited with a non-zero return code
+    """
+
+    # iterations of parallel loops keep their own RC and leave the directory alone
+    namespace = getattr(thread_state, "namespace", None)
+    if namespace is not None:
+        namespace["RC"] = return_code
+    else:
+        set_rc(return_code)
+
+        # change our directory to where the shell command took us
+        if cwd_path is not None:
+            os.chdir(cwd_path)
+
+    # update environment with what was modified by the shell command
+    if changes is not None:
+        apply_environment(changes)
+
+    # we don't want to raise exceptions if a user is checking for the return code
+    # explicitly
+    if check and shellopts.e and return_code != 0:
+        raise RuntimeError(f"The shell command failed with return code {return_code}")
+
+
+def get_direct_command(cmd: str, stdin, namespace: Union[None, dict]) -> tuple:
+    """Find out how a command that may skip bash can be run without it
+
+    Args:
+        cmd (str): The formatted command
+        stdin (Any): Data to feed to the stdin of the command, see `feed_stdin`
+        namespace (Union[None, dict]): Globals of the `parallel for` iteration
+            running the command, None outside of parallel loops
+
+    Returns:
+        tuple: Arguments of the command if it is a simple one, the output and return
+            code of running it in-process if it could be, and the path of its program
+            if it can be run directly, each None otherwise
+    """
+
+    argv = split_simple_command(cmd)
+    if argv is None:
+        return None, None, None
+    builtin = None
+    if stdin is None and argv[0] in BUILTIN_COMMANDS:
+        # parallel iterations share the working directory, so they can't cd in-process
+        if argv[0] != "cd" or namespace is None:
+            builtin = BUILTIN_COMMANDS[argv[0]](argv[1:])
+    executable = None
+    if builtin is None and argv[0] not in BASH_BUILTINS:
+        executable = find_command(argv[0], os.environ.get("PATH", os.defpath))
+    return argv, builtin, executable
+
+
+def start_call(timer, call: Union[None, ShellCall], pid: int) -> None:
+    """Mark a shell call as started once its process has been spawned
+
+    Args:
+        timer (ShellTimer): Profiler timer of the call, None when not profiling
+        call (Union[None, ShellCall]): Hook details of the call, None without hooks
+        pid (int): Process ID of the command
+    """
+
+    if timer is not None:
+        timer.mark("spawn")
+    if call is not None:
+        call.begin(pid)
+
+
+def run_builtin(result: tuple, silent: bool, call: Union[None, ShellCall]) -> tuple:
+    """Print the output of a command that was run in-process by `BUILTIN_COMMANDS`
+
+    Args:
+        result (tuple): Output and return code of the command
+        silent (bool): Should the output to stdout be suppressed
+        call (Union[None, ShellCall]): Hook details of the call, None without hooks
+
+    Returns:
+        tuple: Lines of stdout, return code, environment changes and new working
+            directory, the last two being None as the command applied them itself
+    """
+
+    text, return_code = result
+    if call is not None:
+        call.begin()
+    if text.endswith("\n"):
+        stdout = text[:-1].split("\n")
+    else:
+        stdout = text.split("\n") if text else []
+    if not silent:
+        for line in stdout:
+            print(line)
+    return stdout, return_code, None, None
+
+
+def run_direct(
+    argv: tuple,
+    executable: str,
+    environ: dict,
+    stdin,
+    silent: bool,
+    spill_size: int,
+    timer,
+    call: Union[None, ShellCall],
+) -> tuple:
+    """Run a simple command straight from its executable without bash
+
+    Args:
+        argv (tuple): Arguments of the command
+        executable (str): Path of the program to run
+        environ (dict): Environment to start the process with, None to inherit ours
+        stdin (Any): Data to feed to the stdin of the command, see `feed_stdin`
+        silent (bool): Should the output to stdout be suppressed
+        spill_size (int): Size of output past which it is moved into a
+            `CapturedOutput`, None to keep it all in memory
+        timer (ShellTimer): Profiler timer of the call, None when not profiling
+        call (Union[None, ShellCall]): Hook details of the call, None without hooks
+
+    Returns:
+        tuple: Output of stdout, return code, environment changes and new working
+            directory, the last two being None as a program can't change them
+    """
+
+    with process_slots, start_process(argv, environ, stdin, executable) as proc:
+        start_call(timer, call, proc.pid)
+        stdout, _ = read_output(proc.stdout, silent, spill_size)
+        proc.stdout.close()
+        return_code = proc.wait()
+        join_stdin(proc)
+    # report signals the way bash does
+    if return_code < 0:
+        return_code = 128 - return_code
+    return stdout, return_code, None, None
+
+
+def run_spawned(
+    cmd: str,
+    sent: dict,
+    environ: dict,
+    stdin,
+    silent: bool,
+    spill_size: int,
+    timer,
+    call: Union[None, ShellCall],
+) -> tuple:
+    """Run a command in a bash process of its own
+
+    Args:
+        cmd (str): The formatted command to run
+        sent (dict): Snapshot of the environment the command is started with
+        environ (dict): Environment to start the process with, None to inherit ours
+        stdin (Any): Data to feed to the stdin of the command, see `feed_stdin`
+        silent (bool): Should the output to stdout be suppressed
+        spill_size (int): Size of output past which it is moved into a
+            `CapturedOutput`, None to keep it all in memory
+        timer (ShellTimer): Profiler timer of the call, None when not profiling
+        call (Union[None, ShellCall]): Hook details of the call, None without hooks
+
+    Returns:
+        tuple: Output of stdout, return code, environment changes and new working
+            directory, the last two being None if the shell didn't report them
+    """
+
+    changes = None
+    cwd_path = None
+
+    report = may_change_environ(cmd, sent)
+    with process_slots, spawn(cmd, environ, stdin, report) as proc:
+        start_call(timer, call, proc.pid)
+        stdout, finished = read_output(proc.stdout, silent, spill_size)
+        if finished:
+            _, cwd_path, report = read_status(proc.stdout)
+            changes = environ_sync.changes(sent, report)
+        proc.stdout.close()
+        proc.wait()
+        return_code = proc.poll()
+        join_stdin(proc)
+    return stdout, return_code, changes, cwd_path
+
+
+def run_in_session(
+    cmd: str, silent: bool, spill_size: int, call: Union[None, ShellCall]
+) -> tuple:
+    """Run a command in the bash process of session mode
+
+    Args:
+        cmd (str): The formatted command to run
+        silent (bool): Should the output to stdout be suppressed
+        spill_size (int): Size of output past which it is moved into a
+            `CapturedOutput`, None to keep it all in memory
+        call (Union[None, ShellCall]): Hook details of the call, None without hooks
+
+    Returns:
+        tuple: Output of stdout, return code, environment changes and new working
+            directory of the session
+    """
+
+    if call is not None:
+        call.begin(getattr(session.proc, "pid", None))
+    return session.run(cmd, silent, spill_size)
+
+
+def end_call(
+    timer,
+    call: Union[None, ShellCall],
+    return_code: int,
+    stdout: Union[list, CapturedOutput],
+    changes: Union[None, dict],
+) -> None:
+    """Stop the profiler timer of a shell call and run its end hooks
+
+    Args:
+        timer (ShellTimer): Profiler timer of the call, None when not profiling
+        call (Union[None, ShellCall]): Hook details of the call, None without hooks
+        return_code (int): Return code of the command
+        stdout (Union[list, CapturedOutput]): Output of stdout
+        changes (Union[None, dict]): Environment changes made by the command
+    """
+
+    if timer is not None:
+        timer.finish()
+    if call is not None:
+        call.end(return_code, stdout, changes or {})
+
+
+def shell(
+    cmd: str,
+    get_rc: bool = False,
+    get_stdout: bool = False,
+    silent: bool = False,
+    format_dict: dict = None,
+    stream: bool = False,
+    stdin=None,
+    direct: bool = False,
+) -> Union[None, str, int, Iterator[str]]:
+    """Perform a shell call and update the environment with any env variable changes
+
+    Args:
+        cmd (str): The command to run
+        get_rc (bool, optional): Should the return code of the call be returned.
+            Defaults to False.
+        get_stdout (bool, optional): Should the contents of stdout of the call be
+            returned. Defaults to False.
+        silent (bool, optional): Should the output to stdout be suppressed when printing
+            to the terminal. Defaults to False.
+        format_dict (dict, optional): Values of the names used by the format fields
+            of the command. Defaults to using the command as it is.
+        stream (bool, optional): Should the lines of stdout be returned as an iterator
+            that yields them as they arrive. Defaults to False.
+        stdin (Any, optional): Data to feed to the stdin of the command, see
+            `feed_stdin`. Defaults to no input.
+        direct (bool, optional): May the command be run without bash when it turns
+            out to be a simple command once formatted. Defaults to False.
+
+    Raises:
+        RuntimeError: The shell command exited with a non-zero return code when not in
+            an if statement where the RC is being explicitly checked
+
+    Returns:
+        Union[None, str, int, Iterator[str]]: Default None, stdout contents if
+            get_stdout is True, return code if get_rc is True and an iterator over the
+            lines of stdout if stream is True
+    """
+
+    decoded = decode_command(cmd, format_dict)
+
+    # iterations of parallel loops keep their own RC and leave the directory alone
+    namespace = getattr(thread_state, "namespace", None)
+    sent, environ = get_call_environ()
+
+    if stream:
+        return stream_shell(decoded, sent, environ, silent, stdin)
+
+    timer = None if profiler is None else profiler.start_shell()
+    call = new_call(decoded, "shell")
+    spill_size = get_spill_size() if get_stdout else None
+
+    # bash functions and aliases can shadow commands in a session, so always use it
+    in_session = session is not None and namespace is None and stdin is None
+    argv = None
+    builtin = None
+    executable = None
+    if direct and not in_session and not (shellopts.x or shellopts.v):
+        argv, builtin, executable = get_direct_command(decoded, stdin, namespace)
+
+    if builtin is not None:
+        result = run_builtin(builtin, silent, call)
+    elif executable is not None:
+        result = run_direct(
+            argv, executable, environ, stdin, silent, spill_size, timer, call
+        )
+    elif in_session:
+        result = run_in_session(decoded, silent, spill_size, call)
+    else:
+        result = run_spawned(
+            decoded, sent, environ, stdin, silent, spill_size, timer, call
+        )
+    stdout, return_code, changes, cwd_path = result
+
+    if timer is not None:
+        timer.mark("command")
+    try:
+        apply_status(return_code, changes, cwd_path, check=not get_rc)
+    finally:
+        # builtins run in-process and change the environment directly
+        if builtin is not None and call is not None:
+            changes = diff_environ(sent, environ_snapshot())
+        end_call(timer, call, return_code, stdout, changes)
+
+    if get_stdout:
+        return join_output(stdout)
+    if get_rc:
+        return return_code
+    return None
+
+
+def stream_shell(
+    cmd: str, sent: dict, environ: dict, silent: bool = False, stdin=None
+) -> Iterator[str]:
+    """Run a shell call and yield the lines of its stdout as they arrive
+
+    The return code, environment and working directory of the call are applied once
+    all of its output has been read. Stopping early kills the command instead.
+
+    Args:
+        cmd (str): The formatted command to run
+        sent (dict): Snapshot of the environment the command is started with
+        environ (dict): Environment to start the process with, None to inherit ours
+        silent (bool, optional): Should the output to stdout be suppressed when printing
+            to the terminal. Defaults to False.
+        stdin (Any, optional): Data to feed to the stdin of the command, see
+            `feed_stdin`. Defaults to no input.
+
+    Raises:
+        RuntimeError: The shell command exited with a non-zero return code
+
+    Yields:
+        str: Lines of stdout of the command
+    """
+
+    changes = None
+    cwd_path = None
+    call = new_call(cmd, "stream")
+
+    report = may_change_environ(cmd, sent)
+    # the loop over the output may run other commands, so only hold a slot to start
+    with process_slots:
+        proc = spawn(cmd, environ, stdin, report)
+    with proc:
+        output = iter_output(proc.stdout, silent)
+        if call is not None:
+            call.begin(proc.pid)
+            output = count_output(output, call)
+        try:
+            finished = yield from output
+        except GeneratorExit:
+            proc.kill()
+            raise
+        if finished:
+            _, cwd_path, report = read_status(proc.stdout)
+            changes = environ_sync.changes(sent, report)
+        proc.stdout.close()
+        return_code = proc.wait()
+        join_stdin(proc)
+
+    try:
+        apply_status(return_code, changes, cwd_path)
+    finally:
+        if call is not None:
+            call.end(return_code, None, changes or {})
+
+
+class ShellPipe:
+    """An inline Bash call that reads the Python value piped into it as stdin
+
+    `data | ShellPipe(cmd)` runs `shell(cmd, stdin=data)`, which lets Python data be
+    handed to a command without formatting it into the command text.
+    """
+
+    def __init__(self, cmd: str, **kwargs) -> None:
+        """Store the call until data is piped into it
+
+        Args:
+            cmd (str): The command to run
+            kwargs (Any): Keyword arguments to pass on to `shell`
+        """
+
+        self.cmd = cmd
+        self.kwargs = kwargs
+
+    def __ror__(self, data) -> Union[None, str, int, Iterator[str]]:
+        return shell(self.cmd, stdin=data, **self.kwargs)
+
+
+async def ashell(
+    cmd: str,
+    get_rc: bool = False,
+    get_stdout: bool = False,
+    silent: bool = False,
+    format_dict: dict = None,
+) -> Union[None, str, int]:
+    """Perform a shell call from a coroutine without blocking the event loop
+
+    Behaves like `shell`, except that the command always runs in its own bash process
+    even in session mode.
+
+    Args:
+        cmd (str): The command to run
+        get_rc (bool, optional): Should the return code of the call be returned.
+            Defaults to False.
+        get_stdout (bool, optional): Should the contents of stdout of the call be
+            returned. Defaults to False.
+        silent (bool, optional): Should the output to stdout be suppressed when printing
+            to the terminal. Defaults to False.
+        format_dict (dict, optional): Values of the names used by the format fields
+            of the command. Defaults to using the command as it is.
+
+    Raises:
+        RuntimeError: The shell command exited with a non-zero return code when not in
+            an if statement where the RC is being explicitly checked
+
+    Returns:
+        Union[None, str, int]: Default None, stdout contents if get_stdout is True and
+            return code if get_rc is True
+    """
+
+    # asyncio is slow to import and only scripts that await shell calls need it
+    import asyncio  # pylint: disable=C0415
+
+    decoded = decode_command(cmd, format_dict)
+
+    sent, environ = get_call_environ()
+
+    changes = None
+    cwd_path = None
+    script = get_script(decoded, may_change_environ(decoded, sent))
+    call = new_call(decoded, "async")
+
+    await process_slots.acquire_async()
+    try:
+        # the script is passed as an argument like it is for one-off shell calls, so
+        # commands that read stdin get nothing instead of the rest of the script
+        proc = await asyncio.create_subprocess_exec(
+            "bash",
+            "-c",
+            script,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            env=environ,
+            limit=1 << 30,
+        )
+        try:
+            if call is not None:
+                call.begin(proc.pid)
+            stdout, finished = await aread_output(proc.stdout, silent)
+            if finished:
+                _, cwd_path, report = await aread_status(proc.stdout)
+                changes = environ_sync.changes(sent, report)
+            return_code = await proc.wait()
+        except BaseException:
+            # the call was cancelled or failed, so don't leave the command running
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    finally:
+        process_slots.release()
+
+    try:
+        apply_status(return_code, changes, cwd_path, check=not get_rc)
+    finally:
+        if call is not None:
+            call.end(return_code, stdout, changes or {})
+
+    if get_stdout:
+        return "\n".join(stdout)
+    if get_rc:
+        return return_code
+    return None
+
+
+class Job:
+    """A shell command running in the background"""
+
+    def __init__(self, cmd: str, silent: bool = False) -> None:
+        """Start the command and collect its output on a separate thread
+
+        Args:
+            cmd (str): The command to run
+            silent (bool, optional): Should the output to stdout be suppressed when it
+                is printed on wait. Defaults to False.
+        """
+
+        self.cmd = cmd
+        self.silent = silent
+        self.sent = environ_snapshot()
+        self.rc = None
+        self.stdout = None
+        self.changes = None
+        self.call = new_call(cmd, "background")
+        # the script decides when to wait on the job, so only hold a slot to start it
+        with process_slots:
+            self.proc = spawn(cmd, None, None, may_change_environ(cmd, self.sent))
+        self.pid = self.proc.pid
+        if self.call is not None:
+            self.call.begin(self.pid)
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+
+    def collect(self) -> None:
+        """Read the output and status of the command until it exits"""
+
+        stdout, finished = read_output(self.proc.stdout, True, get_spill_size())
+        if finished:
+            _, _, report = read_status(self.proc.stdout)
+            self.changes = environ_sync.changes(self.sent, report)
+        self.proc.stdout.close()
+        self.stdout = join_output(stdout)
+        self.rc = self.proc.wait()
+        if self.call is not None:
+            self.call.end(self.rc, self.stdout, self.changes or {}, applied=False)
+
+    def done(self) -> bool:
+        """Check if the command has finished
+
+        Returns:
+            bool: Has the command exited and its output been collected
+        """
+
+        return not self.thread.is_alive()
+
+    def wait(self) -> int:
+        """Block until the command has finished
+
+        Returns:
+            int: Return code of the command
+        """
+
+        self.thread.join()
+        return self.rc
+
+
+# Jobs started by `shell_async` that haven't been waited on yet
+background_jobs = []
+
+
+def shell_async(cmd: str, silent: bool = False, format_dict: dict = None) -> Job:
+    """Start a shell call in the background and return a handle to it
+
+    Args:
+        cmd (str): The command to run
+        silent (bool, optional): Should the output to stdout be suppressed when it
+            is printed on wait. Defaults to False.
+        format_dict (dict, optional): Values of the names used by the format fields
+            of the command. Defaults to using the command as it is.
+
+    Returns:
+        Job: Handle to the running command, also tracked in `background_jobs` until
+            waited on
+    """
+
+    decoded = decode_command(cmd, format_dict)
+
+    job = Job(decoded, silent)
+    background_jobs.append(job)
+    return job
+
+
+def jobs() -> list:
+    """Get the background shell calls that haven't been waited on yet
+
+    Returns:
+        list: Handles of the jobs in the order they were started, including those
+            that have finished but weren't waited on
+    """
+
+    return list(background_jobs)
+
+
+def wait(*handles: Job, apply_env: bool = True) -> list:
+    """Wait for background shell calls to finish
+
+    Jobs are joined in the order given (or the order they were started if none are
+    given), printing their output and applying their environment changes in that order.
+    Changes to the working directory made by background calls are not applied.
+
+    Args:
+        handles (Job): Jobs to wait for. Defaults to all jobs not yet waited on.
+        apply_env (bool, optional): Should environment changes made by the jobs be
+            applied. Defaults to True.
+
+    Raises:
+        RuntimeError: A job exited with a non-zero return code while `shellopts.e` is
+            set
+
+    Returns:
+        list: Return codes of the jobs
+    """
+
+    if not handles:
+        handles = tuple(background_jobs)
+
+    for job in handles:
+        job.wait()
+        if job in background_jobs:
+            background_jobs.remove(job)
+        if not job.silent and job.stdout:
+            print(job.stdout)
+        if apply_env and job.changes is not None:
+            apply_environment(job.changes)
+        set_rc(job.rc)
+
+    if shellopts.e:
+        for job in handles:
+            if job.rc != 0:
+                raise RuntimeError(
+                    f"The background shell command failed with return code {job.rc}"
+                )
+
+    return [job.rc for job in handles]
+
+
+class ThreadOutput:
+    """Stand-in for stdout that buffers writes made by `parallel for` iterations"""
+
+    def __init__(self, stream) -> None:
+        """Wrap the stream that unbuffered writes go to
+
+        Args:
+            stream (TextIO): Stream to write to outside of parallel iterations
+        """
+
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        """Write text to the buffer of the current iteration or the wrapped stream
+
+        Args:
+            text (str): Text to write
+
+        Returns:
+            int: Number of characters written
+        """
+
+        buffer = getattr(thread_state, "output", None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+
+def run_isolated(func: types.FunctionType, *args) -> tuple:
+    """Run a function against its own copy of the script globals with buffered output
+
+    Args:
+        func (FunctionType): Function to run
+        args (Any): Arguments to call the function with
+
+    Returns:
+        tuple: Return value of the function, the output it printed and the exception it
+            raised if any
+    """
+
+    namespace = dict(func.__globals__)
+    namespace["RC"] = 0
+    isolated = type(func)(
+        func.__code__, namespace, func.__name__, func.__defaults__, func.__closure__
+    )
+    thread_state.namespace = namespace
+    thread_state.output = []
+    try:
+        value = isolated(*args)
+        error = None
+    except Exception as exc:  # pylint: disable=W0703
+        value = None
+        error = exc
+    finally:
+        output = "".join(thread_state.output)
+        thread_state.namespace = None
+        thread_state.output = None
+    return value, output, error
+
+
+def parallel_for(iterable, jobs: int = None, unpack: bool = False):
+    """Run the decorated loop body for every item on a pool of threads
+
+    Each iteration runs against its own copy of the script globals so `RC` and names
+    assigned by the body don't leak between iterations. Output printed by an iteration
+    is buffered and written out in the order of the items once it has finished.
+
+    Args:
+        iterable (Iterable): Items to loop over
+        jobs (int, optional): Number of iterations to run at once. Defaults to the
+            number of CPUs.
+        unpack (bool, optional): Should each item be unpacked into the arguments of the
+            body. Defaults to False.
+
+    Returns:
+        Callable: Decorator that runs the loop and returns the values of the iterations
+    """
+
+    def run_loop(body: types.FunctionType) -> list:
+        # imported here so that scripts without parallel loops start faster
+        from concurrent.futures import ThreadPoolExecutor  # pylint: disable=C0415
+
+        def run_iteration(item) -> tuple:
+            if unpack:
+                return run_isolated(body, *item)
+            return run_isolated(body, item)
+
+        stdout = sys.stdout
+        # nested loops write into the buffers set up by the outermost one
+        if not isinstance(stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(stdout)
+        values = []
+        try:
+            with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+                for value, output, error in pool.map(run_iteration, iterable):
+                    stdout.write(output)
+                    if error is not None:
+                        raise error
+                    values.append(value)
+        finally:
+            sys.stdout = stdout
+        return values
+
+    return run_loop
+
+
+class Task:
+    """A script function registered as a node of the task graph"""
+
+    def __init__(self, func: types.FunctionType, deps: list, inputs: list) -> None:
+        """Record the function and what it depends on
+
+        Args:
+            func (FunctionType): Function that performs the task
+            deps (list): Tasks or names of tasks that have to finish first
+            inputs (list): Glob patterns of the files the task reads
+        """
+
+        self.func = func
+        self.name = func.__name__
+        self.deps = [dep if isinstance(dep, str) else dep.__name__ for dep in deps]
+        # tasks may change directory, so inputs are found from where they're declared
+        self.inputs = [os.path.abspath(pattern) for pattern in inputs]
+
+    def stamp(self) -> str:
+        """Get a fingerprint of the input files of the task
+
+        Returns:
+            str: Hash of the paths, sizes and modification times of the inputs
+        """
+
+        digest = hashlib.sha256()
+        for pattern in self.inputs:
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+        return digest.hexdigest()
+
+
+tasks = {}
+
+
+def task(func: types.FunctionType = None, deps: list = (), inputs: list = ()):
+    """Register a function as a task that can be run with `run_tasks`
+
+    Can be used bare as `@task` or with arguments as `@task(deps=[clean])`.
+
+    Args:
+        func (FunctionType, optional): Function being decorated when used bare
+        deps (list, optional): Tasks or names of tasks that have to finish first.
+            Defaults to none.
+        inputs (list, optional): Glob patterns of the files the task reads. When set,
+            the task is skipped if they are unchanged since it last succeeded and none
+            of its dependencies ran. Defaults to none.
+
+    Returns:
+        Callable: The function unchanged or a decorator that registers it
+    """
+
+    def register(func: types.FunctionType) -> types.FunctionType:
+        tasks[func.__name__] = Task(func, deps, inputs)
+        return func
+
+    if func is not None:
+        return register(func)
+    return register
+
+
+def order_tasks(targets: tuple) -> list:
+    """Get the targets and everything they depend on with dependencies first
+
+    Args:
+        targets (tuple): Names of the tasks to run
+
+    Raises:
+        ValueError: A task is unknown or the dependencies form a cycle
+
+    Returns:
+        list: Names of the tasks to run in dependency order
+    """
+
+    order = []
+    visiting = []
+
+    def visit(name: str) -> None:
+        if name in order:
+            return
+        if name in visiting:
+            cycle = " -> ".join(visiting[visiting.index(name) :] + [name])
+            raise ValueError(f"Task dependencies form a cycle: {cycle}")
+        if name not in tasks:
+            raise ValueError(f"Unknown task '{name}'")
+        visiting.append(name)
+        for dep in tasks[name].deps:
+            visit(dep)
+        visiting.pop()
+        order.append(name)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+class TaskRun:
+    """The state of a single `run_tasks` call"""
+
+    def __init__(self, order: list, stamps: dict) -> None:
+        """Initialize the TaskRun object
+
+        Args:
+            order (list): Names of the tasks to run in dependency order
+            stamps (dict): Stamps of the inputs of each task when it last succeeded,
+                updated as tasks succeed
+        """
+
+        self.order = order
+        self.stamps = stamps
+        # seconds taken by each task that has finished, None for skipped tasks
+        self.timings = {}
+        self.ran = set()
+        self.failed = []
+        self.error = None
+
+    def check(self, name: str) -> Union[None, str]:
+        """Check if a task has to run
+
+        Args:
+            name (str): Name of the task
+
+        Returns:
+            Union[None, str]: Stamp to record for the task once it succeeds or None if
+                it was skipped
+        """
+
+        node = tasks[name]
+        if not node.inputs:
+            return ""
+        stamp = node.stamp()
+        if self.stamps.get(name) == stamp and not any(
+            dep in self.ran for dep in node.deps
+        ):
+            self.timings[name] = None
+            return None
+        return stamp
+
+    def ready(self, name: str) -> bool:
+        """Check if every dependency of a task has finished without failing
+
+        Args:
+            name (str): Name of the task
+
+        Returns:
+            bool: Can the task be started
+        """
+
+        deps = tasks[name].deps
+        return all(dep in self.timings for dep in deps) and not any(
+            dep in self.failed for dep in deps
+        )
+
+    def finish(self, name: str, stamp: str, seconds: float, exc: Exception) -> None:
+        """Record the outcome of a task
+
+        Args:
+            name (str): Name of the task
+            stamp (str): Stamp of the inputs of the task
+            seconds (float): Time the task took
+            exc (Exception): Error raised by the task, None if it succeeded
+        """
+
+        self.timings[name] = seconds
+        if exc is not None:
+            self.failed.append(name)
+            self.error = self.error or exc
+            return
+        self.ran.add(name)
+        if stamp:
+            self.stamps[name] = stamp
+
+    def run_serial(self, stdout) -> None:
+        """Run the tasks one at a time on the current thread until one fails
+
+        Args:
+            stdout (TextIO): Stream to write the output of each task to once it is done
+        """
+
+        for name in self.order:
+            stamp = self.check(name)
+            if stamp is None:
+                continue
+            start = time.perf_counter()
+            _, output, exc = run_isolated(tasks[name].func)
+            stdout.write(output)
+            self.finish(name, stamp, time.perf_counter() - start, exc)
+            if self.error is not None:
+                break
+
+    def run_concurrent(self, max_workers: int, stdout) -> None:
+        """Run independent tasks at the same time on a pool of threads
+
+        Args:
+            max_workers (int): Number of tasks to run at once
+            stdout (TextIO): Stream to write the output of each task to once it is done
+        """
+
+        # imported here so that scripts without tasks start faster
+        from concurrent.futures import (  # pylint: disable=C0415
+            FIRST_COMPLETED,
+            ThreadPoolExecutor,
+        )
+        from concurrent.futures import wait as wait_futures  # pylint: disable=C0415
+
+        pending = list(self.order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while True:
+                # keep starting tasks until none are ready, skipped ones free others
+                progress = self.error is None
+                while progress:
+                    progress = False
+                    for name in [name for name in pending if self.ready(name)]:
+                        pending.remove(name)
+                        stamp = self.check(name)
+                        if stamp is None:
+                            progress = True
+                            continue
+                        future = pool.submit(run_isolated, tasks[name].func)
+                        running[future] = (name, stamp, time.perf_counter())
+                if not running:
+                    break
+                finished, _ = wait_futures(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, stamp, start = running.pop(future)
+                    _, output, exc = future.result()
+                    stdout.write(output)
+                    self.finish(name, stamp, time.perf_counter() - start, exc)
+
+    def summary(self) -> str:
+        """Describe how long each task took
+
+        Returns:
+            str: Timings of the tasks in the order they were meant to run
+        """
+
+        width = max((len(name) for name in self.order), default=0)
+        summary = ["Task timings:"]
+        for name in self.order:
+            if name not in self.timings:
+                result = "not run"
+            elif self.timings[name] is None:
+                result = "skipped"
+            elif name in self.failed:
+                result = f"failed after {self.timings[name]:.2f}s"
+            else:
+                result = f"{self.timings[name]:.2f}s"
+            summary.append(f"  {name.ljust(width)}  {result}")
+        return "\n".join(summary)
+
+
+def run_tasks(*targets: str, jobs: int = 1) -> dict:
+    """Run tasks and their dependencies, with independent tasks run concurrently
+
+    Tasks run the same way as iterations of parallel loops whatever the number of jobs:
+    each gets its own copy of the script globals and its output is printed once it has
+    finished. Timings are printed to stderr once the run is over.
+
+    Args:
+        targets (str): Names of the tasks to run
+        jobs (int, optional): Number of tasks to run at once. Defaults to 1.
+
+    Raises:
+        Exception: The first error raised by a task, once running tasks have finished
+
+    Returns:
+        dict: Seconds taken by each task run, None for tasks that were skipped
+    """
+
+    order = order_tasks(targets)
+    # resolved up front so tasks that change directory don't move the state file
+    state_path = os.path.abspath(
+        os.getenv("CALLIGRAPHY_TASK_STATE", ".calligraphy_tasks.json")
+    )
+    try:
+        with open(state_path, encoding="utf-8") as state_file:
+            stamps = json.load(state_file)
+    except (OSError, ValueError):
+        stamps = {}
+    run = TaskRun(order, stamps)
+
+    stdout = sys.stdout
+    if not isinstance(stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(stdout)
+    try:
+        if jobs <= 1:
+            run.run_serial(stdout)
+        else:
+            run.run_concurrent(jobs, stdout)
+    finally:
+        sys.stdout = stdout
+        if any(tasks[name].inputs for name in order):
+            try:
+                with open(state_path, "w", encoding="utf-8") as state_file:
+                    json.dump(stamps, state_file)
+            except OSError:
+                pass
+        print(run.summary(), file=sys.stderr)
+
+    if run.error is not None:
+        raise run.error
+    return run.timings
+
+
+def reset() -> None:
+    """Put the runtime back into its starting state before running a new script
+
+    Objects that scripts import from the runtime are cleared in place, so sourced
+    modules that are reused from an earlier run share them with the new script.
+    """
+
+    global RC
+    global session
+    global process_slots
+
+    RC = 0
+    namespaces.clear()
+    vars(shellopts).update(vars(Options()))
+    close_session()
+    session = Session() if os.getenv("CALLIGRAPHY_SESSION") == "1" else None
+    for hooks in shell_hooks.values():
+        hooks.clear()
+    command_paths.clear()
+    environ_sync.clear()
+    background_jobs.clear()
+    # the cap may differ in the environment of the new script
+    process_slots = ProcessSlots(get_max_procs())
+    tasks.clear()
@@ -0,0 +1,359 @@
+# pylint: disable=W0212, W0703, C0103, C0415, R0915, R1732
+"""Module to run Calligraphy scripts from a warm process on behalf of thin clients
+
+The server listens on a unix socket. Each client sends the arguments it was given, its
+working directory and environment along with its stdin, stdout and stderr. The server
+forks a child that runs the CLI straight onto the streams of the client, then compiles
+the script in its own process so that the result stays in memory for later requests.
+The child starts with every module and compiled script of the server already loaded,
+while anything the script changes stays in the child.
+"""
+
+from __future__ import annotations
+import array
+import atexit
+import fcntl
+import importlib
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import traceback
+import types
+from calligraphy_scripting import ipc
+
+# Size of the first read of a request, which carries the streams of the client
+REQUEST_CHUNK_SIZE = 1 << 16
+# Options of the CLI that are followed by a value
+VALUE_OPTIONS = ("--trace", "-t", "--target", "-j", "--jobs")
+# Options of the CLI that don't run the script, so there is nothing to compile
+SKIP_OPTIONS = ("--no-cache", "-e", "--explain", "-i", "--intermediate")
+
+
+def send_reply(conn: socket.socket, reply: dict) -> None:
+    """Send a reply to a client, ignoring clients that have gone away
+
+    Args:
+        conn (socket.socket): Connection to the client
+        reply (dict): Reply to send
+    """
+
+    try:
+        conn.sendall(json.dumps(reply).encode("utf-8") + b"\n")
+    except OSError:
+        pass
+
+
+def receive_request(conn: socket.socket) -> tuple:
+    """Read a request and the streams passed along with it
+
+    Args:
+        conn (socket.socket): Connection to the client
+
+    Raises:
+        ConnectionError: The client didn't send a whole request
+
+    Returns:
+        tuple: The request and the file descriptors of the stdin, stdout and stderr of
+            the client
+    """
+
+    fds = array.array("i")
+    data, ancdata, _, _ = conn.recvmsg(
+        REQUEST_CHUNK_SIZE, socket.CMSG_SPACE(len(ipc.STREAMS) * fds.itemsize)
+    )
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+
+    try:
+        while not data.endswith(b"\n"):
+            chunk = conn.recv(REQUEST_CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError("The client closed the connection mid request")
+            data += chunk
+        if len(fds) != len(ipc.STREAMS):
+            raise ConnectionError("The client didn't send its standard streams")
+        return json.loads(data), list(fds)
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def get_program_path(args: list) -> str:
+    """Find the script in the arguments of the CLI
+
+    Args:
+        args (list): Arguments to the CLI
+
+    Returns:
+        str: Path of the script or an empty string if there isn't one
+    """
+
+    arg_iter = iter(args)
+    for arg in arg_iter:
+        if arg in VALUE_OPTIONS:
+            next(arg_iter, None)
+        elif arg == "-" or not arg.startswith("-"):
+            return arg
+    return ""
+
+
+def warm(request: dict) -> None:
+    """Compile the script of a request so that it stays in memory for later requests
+
+    Any errors are left for the child to report when it runs the script.
+
+    Args:
+        request (dict): Request from a client
+    """
+
+    from calligraphy_scripting import runner
+
+    args = request["argv"]
+    path = get_program_path(args)
+    if path in ("", "-") or any(arg in SKIP_OPTIONS for arg in args):
+        return
+
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    try:
+        # sourced scripts and the cache are found relative to the client
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        with open(path, encoding="utf-8") as code_file:
+            contents = code_file.read()
+        runner.compile_script(contents)
+    except Exception:
+        pass
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def run_child(request: dict, fds: list, cli: types.ModuleType) -> int:
+    """Run the CLI for a request in a forked child with the streams of the client
+
+    Args:
+        request (dict): Request from a client
+        fds (list): File descriptors of the stdin, stdout and stderr of the client
+        cli (types.ModuleType): Module of the CLI that started the server
+
+    Returns:
+        int: Exit code of the CLI
+    """
+
+    # Leave the session of the server so the client can signal the script's group
+    os.setsid()
+
+    # Move the streams out of the way first in case any of them landed on 0 to 2
+    moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, 3) for fd in fds]
+    for fd in fds:
+        os.close(fd)
+    for target, fd in zip(ipc.STREAMS, moved):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = open(0, encoding="utf-8", closefd=False)
+    sys.stdout = open(1, "w", encoding="utf-8", closefd=False)
+    sys.stderr = open(
+        2, "w", encoding="utf-8", errors="backslashreplace", buffering=1, closefd=False
+    )
+
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    # jobs and process slots of the runtime the server loaded follow the client too
+    from calligraphy_scripting import runtime
+
+    runtime.reset()
+    sys.argv = ["calligraphy"] + request["argv"]
+    # the CLI picks its colors from the arguments when it is loaded
+    importlib.reload(cli)
+
+    try:
+        cli.cli()
+        return_code = 0
+    except SystemExit as exc:
+        if exc.code is None:
+            return_code = 0
+        elif isinstance(exc.code, int):
+            return_code = exc.code
+        else:
+            print(exc.code, file=sys.stderr)
+            return_code = 1
+    except BaseException:
+        traceback.print_exc()
+        return_code = 1
+
+    # The child never returns to the interpreter, so run what it would on exit
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return return_code
+
+
+def bind(path: str) -> socket.socket:
+    """Listen on the socket of the server, only the current user may connect to it
+
+    The socket is created without permissions for other users, while the directory
+    it's in and the user of each connection are checked by `serve`.
+
+    Args:
+        path (str): Path of the socket
+
+    Raises:
+        FileExistsError: Another server is already listening on the socket
+
+    Returns:
+        socket.socket: Listening socket
+    """
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # left behind by a server that didn't get to clean up
+            os.remove(path)
+        else:
+            raise FileExistsError(
+                f"A Calligraphy server is already listening on {path}"
+            )
+        finally:
+            probe.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen()
+    return listener
+
+
+def get_return_code(status: int) -> int:
+    """Get the return code of a child the way a shell reports it
+
+    Args:
+        status (int): Status of the child from `os.waitpid`
+
+    Returns:
+        int: Exit code of the child or 128 plus the signal that killed it
+    """
+
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def serve(cli: types.ModuleType, path: str = "") -> None:
+    """Run requests from clients until the server is interrupted or terminated
+
+    Requests are accepted one at a time. Each script is compiled once its child has
+    been started, so a new script holds up the requests after it while it compiles,
+    but not the run that brought it in.
+
+    Args:
+        cli (types.ModuleType): Module of the CLI that started the server, which is
+            passed in rather than imported as it imports this module
+        path (str, optional): Path of the socket to listen on. Defaults to the path
+            the client connects to.
+    """
+
+    # Load everything a script may need so that children don't have to
+    from calligraphy_scripting import parser  # pylint: disable=W0611
+    from calligraphy_scripting import runner  # pylint: disable=W0611
+    from calligraphy_scripting import transpiler  # pylint: disable=W0611
+
+    if not path and not os.getenv("CALLIGRAPHY_SOCKET"):
+        # the default socket lives in a directory that only the current user can use
+        os.makedirs(ipc.get_socket_dir(), 0o700, exist_ok=True)
+        ipc.check_private_dir(ipc.get_socket_dir())
+    path = path or ipc.get_socket_path()
+    listener = bind(path)
+    children = {}
+
+    # Wake the loop up whenever a child exits
+    wake_read, wake_write = os.pipe()
+    os.set_blocking(wake_read, False)
+    os.set_blocking(wake_write, False)
+    signal.set_wakeup_fd(wake_write)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wake_read, selectors.EVENT_READ)
+    print(f"Serving Calligraphy scripts on {path}", file=sys.stderr)
+
+    def accept() -> None:
+        conn, _ = listener.accept()
+        try:
+            # the script would run as us, so turn away any other user
+            ipc.check_peer(conn)
+            request, fds = receive_request(conn)
+        except (OSError, ValueError):
+            conn.close()
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            return_code = 1
+            try:
+                selector.close()
+                listener.close()
+                conn.close()
+                for other in children.values():
+                    other.close()
+                signal.set_wakeup_fd(-1)
+                os.close(wake_read)
+                os.close(wake_write)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                return_code = run_child(request, fds, cli)
+            finally:
+                os._exit(return_code)
+
+        for fd in fds:
+            os.close(fd)
+        children[pid] = conn
+        send_reply(conn, {"pid": pid})
+        # the child compiles the script itself if it has to, this keeps it for later
+        warm(request)
+
+    def reap() -> None:
+        while True:
+            try:
+                os.read(wake_read, REQUEST_CHUNK_SIZE)
+            except BlockingIOError:
+                break
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            conn = children.pop(pid, None)
+            if conn is not None:
+                send_reply(conn, {"rc": get_return_code(status)})
+                conn.close()
+
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is listener:
+                    accept()
+                else:
+                    reap()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        selector.close()
+        listener.close()
+        os.remove(path)
@@ -0,0 +1,145 @@
+"""Module to map lines of compiled Calligraphy scripts back to the original script"""
+
+from __future__ import annotations
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    # only needed for annotations, it's imported when a traceback is formatted
+    import traceback
+
+# File name that compiled Calligraphy scripts are given
+COMPILED_NAME = "<string>"
+# Start of every compiled script, which runs on the shared runtime module
+RUNTIME_PRELUDE = "from calligraphy_scripting.runtime import *\nattach(globals())\n"
+
+
+class SourceMap:
+    """Line numbers of the original script that each line of compiled code came from
+
+    The compiled code is the import of the runtime followed by the transpiled script,
+    so lines of the import don't map to the script.
+    """
+
+    def __init__(self, offset: int, numbers: list[int], path: str, contents: str):
+        """Initialize the SourceMap object
+
+        Args:
+            offset (int): Number of lines before the transpiled script
+            numbers (list[int]): Script line number of each transpiled line
+            path (str): Path of the script to show in place of the compiled code
+            contents (str): Contents of the script
+        """
+
+        self.offset = offset
+        self.numbers = numbers
+        self.path = path
+        self.script_lines = contents.split("\n")
+
+    def lookup(self, lineno: int) -> Union[None, int]:
+        """Get the script line that a line of the compiled code came from
+
+        Args:
+            lineno (int): Line number in the compiled code, starting from 1
+
+        Returns:
+            Union[None, int]: Line number in the script or None for other lines
+        """
+
+        idx = lineno - self.offset - 1
+        if 0 <= idx < len(self.numbers):
+            return self.numbers[idx]
+        return None
+
+    def get_text(self, number: int) -> str:
+        """Get the text of a line of the script
+
+        Args:
+            number (int): Line number in the script, starting from 1
+
+        Returns:
+            str: Stripped contents of the line
+        """
+
+        if 0 < number <= len(self.script_lines):
+            return self.script_lines[number - 1].strip()
+        return ""
+
+    def map_stack(self, stack: traceback.StackSummary) -> traceback.StackSummary:
+        """Point the frames of a traceback that are in the script at its lines
+
+        Args:
+            stack (traceback.StackSummary): Frames of the traceback
+
+        Returns:
+            traceback.StackSummary: Frames from the compiled code onwards with the
+                frames of the transpiled script replaced
+        """
+
+        # only needed once a script fails, so kept off the startup path
+        import traceback  # pylint: disable=C0415
+
+        frames = list(stack)
+        # Drop the frames that ran the compiled code in the first place
+        for idx, frame in enumerate(frames):
+            if frame.filename == COMPILED_NAME:
+                frames = frames[idx:]
+                break
+
+        mapped = []
+        for frame in frames:
+            number = None
+            if frame.filename == COMPILED_NAME:
+                number = self.lookup(frame.lineno)
+            if number is not None:
+                frame = traceback.FrameSummary(
+                    self.path,
+                    number,
+                    frame.name,
+                    lookup_line=False,
+                    line=self.get_text(number),
+                )
+            mapped.append(frame)
+        return traceback.StackSummary.from_list(mapped)
+
+    def map_syntax_error(self, error: SyntaxError) -> SyntaxError:
+        """Point a syntax error in the compiled code at the line of the script
+
+        Args:
+            error (SyntaxError): Error raised while compiling the script
+
+        Returns:
+            SyntaxError: Error for the line of the script, or the error itself if it
+                isn't in the transpiled script
+        """
+
+        number = None
+        if error.filename == COMPILED_NAME and error.lineno is not None:
+            number = self.lookup(error.lineno)
+        if number is None:
+            return error
+        # columns of the transpiled line don't match the script, so leave them out
+        return SyntaxError(error.msg, (self.path, number, None, self.get_text(number)))
+
+    def format_exception(self, exception: BaseException) -> str:
+        """Format the traceback of an exception raised by the script
+
+        Args:
+            exception (BaseException): Exception raised while running the script
+
+        Returns:
+            str: Traceback pointing at the lines of the script
+        """
+
+        import traceback  # pylint: disable=C0415
+
+        trace = traceback.TracebackException.from_exception(exception)
+        pending = [trace]
+        while pending:
+            current = pending.pop()
+            current.stack = self.map_stack(current.stack)
+            pending.extend(
+                chained
+                for chained in (current.__cause__, current.__context__)
+                if chained is not None
+            )
+        return "".join(trace.format())
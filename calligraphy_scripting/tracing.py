@@ -0,0 +1,126 @@
+"""Module to record the shell calls of a Calligraphy script as a timeline"""
+
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+
+# Longest command text used as the name of an event, the full command is in its args
+EVENT_NAME_LENGTH = 80
+
+
+class TraceRecorder:
+    """Collects shell calls in the Chrome trace event format
+
+    The trace can be opened in Perfetto or `chrome://tracing`. Calls made on the same
+    thread share a track, while background and async calls each get their own track
+    since they overlap with the calls around them.
+    """
+
+    def __init__(self, name: str) -> None:
+        """Initialize the TraceRecorder object
+
+        Args:
+            name (str): Name of the script being traced
+        """
+
+        self.name = name
+        self.pid = os.getpid()
+        self.main_thread = threading.get_ident()
+        self.start = time.time()
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def get_track(self, key: tuple, label: str) -> int:
+        """Get the id of a track, naming it the first time it is used
+
+        Args:
+            key (tuple): What the track is for, a thread or the process of a call
+            label (str): Name to show for the track
+
+        Returns:
+            int: Id of the track
+        """
+
+        track = self.tracks.get(key)
+        if track is None:
+            track = len(self.tracks)
+            self.tracks[key] = track
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": track,
+                    "args": {"name": label},
+                }
+            )
+        return track
+
+    def get_call_track(self, call) -> int:
+        """Get the id of the track a shell call is shown on
+
+        Args:
+            call (ShellCall): Call to place
+
+        Returns:
+            int: Id of the track
+        """
+
+        if call.kind in ("background", "async"):
+            return self.get_track((call.kind, call.pid), f"{call.kind} {call.pid}")
+        if call.thread == self.main_thread:
+            return self.get_track(("thread", call.thread), "main")
+        return self.get_track(("thread", call.thread), f"thread {len(self.tracks)}")
+
+    def record(self, call) -> None:
+        """Add a finished shell call to the trace, meant to be an end hook
+
+        Args:
+            call (ShellCall): Call that finished
+        """
+
+        with self.lock:
+            self.events.append(
+                {
+                    "name": call.cmd[:EVENT_NAME_LENGTH],
+                    "cat": call.kind,
+                    "ph": "X",
+                    "ts": call.start * 1e6,
+                    "dur": call.duration * 1e6,
+                    "pid": self.pid,
+                    "tid": self.get_call_track(call),
+                    "args": {
+                        "cmd": call.cmd,
+                        "pid": call.pid,
+                        "rc": call.rc,
+                        "stdout_bytes": call.stdout_bytes,
+                        "env_changed": call.env_changed,
+                        "new_cwd": call.new_cwd,
+                    },
+                }
+            )
+
+    def write(self, path: str) -> None:
+        """Write the trace to a file, covering the whole script run so far
+
+        Args:
+            path (str): Path of the JSON file to write
+        """
+
+        with self.lock:
+            main = self.get_track(("thread", self.main_thread), "main")
+            script = {
+                "name": self.name,
+                "cat": "script",
+                "ph": "X",
+                "ts": self.start * 1e6,
+                "dur": (time.time() - self.start) * 1e6,
+                "pid": self.pid,
+                "tid": main,
+            }
+            trace = {"traceEvents": [script] + self.events, "displayTimeUnit": "ms"}
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump(trace, trace_file)
@@ -1,9 +1,17 @@
-# pylint: disable=C0301, R1702, R0912, R0914, W1401
+# pylint: disable=C0301, R1702, R0912, R0914, R0915, W1401
 """Module to convert bash code inside of Calligraphy scripts to Python"""
 
 from __future__ import annotations
 import re
 import base64
+import keyword
+import string
+from typing import Union
+from calligraphy_scripting.runtime import (
+    BASH_BUILTINS,
+    IN_PROCESS_BUILTINS,
+    SIMPLE_COMMAND_PATTERN,
+)
 
 ANSI_GREEN = "\033[32m"
 ANSI_BLUE = "\033[34m"
@@ -12,6 +20,148 @@ ANSI_MAGENTA = "\033[35m"
 ANSI_GREY = "\033[90m"
 ANSI_RESET = "\033[0m"
 
+BASH_RC_PATTERN = re.compile(r"\$\?(?=([^'\\]*(\\.|'([^'\\]*\\.)*[^'\\]*'))*[^']*$)")
+RC_PATTERN = re.compile(r'\$\?(?=([^"\\]*(\\.|"([^"\\]*\\.)*[^"\\]*"))*[^"]*$)')
+ARG_PATTERN = re.compile(r'\$([0-9]+)(?=([^"\\]*(\\.|"([^"\\]*\\.)*[^"\\]*"))*[^"]*$)')
+ENV_PATTERN = re.compile(r"env\.((?:[a-zA-Z0-9]|_)*)")
+BACKGROUND_PATTERN = re.compile(r"(?<![&|>\\])&[ \t]*$")
+AWAIT_PATTERN = re.compile(r"(?<![a-zA-Z0-9_])await[ \t]*$")
+STREAM_PATTERN = re.compile(r"(?<![a-zA-Z0-9_.])lines$")
+PIPE_PATTERN = re.compile(r"(?<!\|)\|[ \t]*$")
+FORMAT_FIELD_PATTERN = re.compile(r"\{[^{}]*\}")
+# Name a format field looks up, the rest of the field indexes into it
+FIELD_NAME_PATTERN = re.compile(r"[^.\[]*")
+# Argument for commands whose fields can't be resolved at transpile time, these
+# format against the whole namespace and fail at run time like before
+NAMESPACE_FORMAT_ARG = ", format_dict={**globals(), **locals()}"
+
+
+def get_inline_map(inline_indices: list[str]) -> dict[int, list[tuple[int, int]]]:
+    """Group the inline bash indices by the line they appear on
+
+    Args:
+        inline_indices (list[str]): Indices of inline bash elements of the script
+
+    Returns:
+        dict[int, list[tuple[int, int]]]: Start and end of each inline bash element
+            keyed by line index, nested elements are dropped
+    """
+
+    inline_map = {}
+    for line_idx, start, end in inline_indices:
+        spans = inline_map.setdefault(line_idx, [])
+        if spans and (spans[-1][1] is None or start < spans[-1][1]):
+            continue
+        spans.append((start, end))
+    return inline_map
+
+
+def get_format_names(cmd: str) -> Union[None, list[str]]:
+    """Find the names that the format fields of a bash command look up
+
+    Args:
+        cmd (str): Bash command with references already converted
+
+    Returns:
+        Union[None, list[str]]: Names in the order they are first used, None if a field
+            isn't a plain name or the command isn't a valid format string
+    """
+
+    try:
+        fields = list(string.Formatter().parse(cmd))
+    except ValueError:
+        return None
+
+    names = []
+    for _, field, spec, _ in fields:
+        if field is None:
+            continue
+        name = FIELD_NAME_PATTERN.match(field).group()
+        if not name.isidentifier() or keyword.iskeyword(name):
+            return None
+        nested = get_format_names(spec) if spec else []
+        if nested is None:
+            return None
+        for found in [name] + nested:
+            if found not in names:
+                names.append(found)
+    return names
+
+
+def encode_call(cmd: str) -> tuple[str, str]:
+    """Convert Calligraphy references in a bash command and base64 encode it
+
+    Only the names used by the format fields of the command are passed to the runtime.
+    Commands without format fields are formatted here and passed without the argument.
+
+    Args:
+        cmd (str): Bash command to encode
+
+    Returns:
+        tuple[str, str]: Base64 encoded command and the `format_dict` keyword argument
+    """
+
+    cmd = ENV_PATTERN.sub(r"${{\g<1>}}", cmd)
+    cmd = BASH_RC_PATTERN.sub("$CALLIGRAPHY_RC", cmd)
+    names = get_format_names(cmd)
+    if names is None:
+        fmt = NAMESPACE_FORMAT_ARG
+    elif names:
+        fields = ", ".join(f'"{name}": {name}' for name in names)
+        fmt = f", format_dict={{{fields}}}"
+    else:
+        cmd = cmd.format()
+        fmt = ""
+    cmd_bytes = cmd.encode("utf-8")
+    base64_cmd_bytes = base64.b64encode(cmd_bytes)
+    return base64_cmd_bytes.decode("utf8"), fmt
+
+
+def get_direct_arg(cmd: str, call: str = "shell") -> str:
+    """Get the argument that lets the runtime run a simple command without bash
+
+    This covers running the program directly as well as the commands the runtime
+    implements in-process.
+
+    Args:
+        cmd (str): Bash command being transpiled
+        call (str, optional): Runtime function the command is passed to.
+            Defaults to "shell".
+
+    Returns:
+        str: The `direct` keyword argument or an empty string
+    """
+
+    if call == "ashell":
+        return ""
+    words = cmd.split()
+    if not words or "=" in words[0]:
+        return ""
+    if words[0] in BASH_BUILTINS and words[0] not in IN_PROCESS_BUILTINS:
+        return ""
+    if not SIMPLE_COMMAND_PATTERN.fullmatch(FORMAT_FIELD_PATTERN.sub("x", cmd)):
+        return ""
+    return ", direct=True"
+
+
+def get_shell_call(prefix: str, stream: bool = False) -> str:
+    """Get the runtime function an inline Bash call should be transpiled to
+
+    Args:
+        prefix (str): Text of the line before the inline Bash call
+        stream (bool, optional): Is the output of the call streamed. Defaults to False.
+
+    Returns:
+        str: `ShellPipe` if Python data is piped into the call, `ashell` if the call is
+            awaited, otherwise `shell`
+    """
+
+    if PIPE_PATTERN.search(prefix):
+        return "ShellPipe"
+    if not stream and AWAIT_PATTERN.search(prefix):
+        return "ashell"
+    return "shell"
+
 
 def explain(lines: list[str], langs: list[str], inline_indices: list[str]) -> str:
     """Get the language annotations for a script
@@ -25,28 +175,37 @@ def explain(lines: list[str], langs: list[str], inline_indices: list[str]) -> st
         str: Text of annotated script
     """
 
-    output = ""
+    output = []
+    inline_map = get_inline_map(inline_indices)
 
     # Generate language annotations
     for idx, line in enumerate(lines):
         if langs[idx] == "COMMENT":
-            output += (
+            output.append(
                 f"{ANSI_GREY}COMMENT{ANSI_RESET}     | {ANSI_GREY}{line}{ANSI_RESET}\n"
             )
         elif langs[idx] == "BASH":
-            output += (
+            output.append(
                 f"{ANSI_BLUE}BASH{ANSI_RESET}        | {ANSI_BLUE}{line}{ANSI_RESET}\n"
             )
         elif langs[idx] == "PYTHON":
-            output += f"{ANSI_GREEN}PYTHON{ANSI_RESET}      | {ANSI_GREEN}{line}{ANSI_RESET}\n"
+            output.append(
+                f"{ANSI_GREEN}PYTHON{ANSI_RESET}      | {ANSI_GREEN}{line}{ANSI_RESET}\n"
+            )
         elif langs[idx] == "CALLIGRAPHY":
-            output += f"{ANSI_MAGENTA}CALLIGRAPHY{ANSI_RESET} | {ANSI_MAGENTA}{line}{ANSI_RESET}\n"
+            output.append(
+                f"{ANSI_MAGENTA}CALLIGRAPHY{ANSI_RESET} | {ANSI_MAGENTA}{line}{ANSI_RESET}\n"
+            )
         else:
-            inline_idx = [i for i in inline_indices if i[0] == idx][0]
-            output += f"{ANSI_CYAN}MIX{ANSI_RESET}         | {ANSI_GREEN}{line[:inline_idx[1]]}{ANSI_RESET}{ANSI_BLUE}{line[inline_idx[1]:inline_idx[2]+1]}{ANSI_RESET}{ANSI_GREEN}{line[inline_idx[2] + 1:]}{ANSI_RESET}\n"
+            output.append(f"{ANSI_CYAN}MIX{ANSI_RESET}         | ")
+            position = 0
+            for start, end in inline_map.get(idx, []):
+                output.append(f"{ANSI_GREEN}{line[position:start]}{ANSI_RESET}")
+                output.append(f"{ANSI_BLUE}{line[start:end]}{ANSI_RESET}")
+                position = len(line) if end is None else end
+            output.append(f"{ANSI_GREEN}{line[position:]}{ANSI_RESET}\n")
 
-    output = output.replace("<CALLIGRAPHY_NEWLINE>", "\n")
-    return output
+    return "".join(output).replace("<CALLIGRAPHY_NEWLINE>", "\n")
 
 
 def transpile(lines: list[str], langs: list[str], inline_indices: list[str]) -> str:
@@ -61,44 +220,94 @@ def transpile(lines: list[str], langs: list[str], inline_indices: list[str]) ->
         str: Transpiled Python script
     """
 
-    bash_rc_pattern = r"\$\?(?=([^'\\]*(\\.|'([^'\\]*\\.)*[^'\\]*'))*[^']*$)"
-    rc_pattern = r'\$\?(?=([^"\\]*(\\.|"([^"\\]*\\.)*[^"\\]*"))*[^"]*$)'
-    arg_pattern = r'\$([0-9]+)(?=([^"\\]*(\\.|"([^"\\]*\\.)*[^"\\]*"))*[^"]*$)'
-    env_pattern = r"env\.((?:[a-zA-Z0-9]|_)*)"
+    return transpile_with_map(lines, langs, inline_indices)[0]
+
+
+def transpile_with_map(
+    lines: list[str], langs: list[str], inline_indices: list[str]
+) -> tuple[str, list[int]]:
+    """Convert Calligraphy script into a purely Python script and map its lines back
+
+    Args:
+        lines (list[str]): Lines that make up the script
+        langs (list[str]): Detected languages for the lines
+        inline_indices (list[str]): Indices of inline bash elements of the script
+
+    Returns:
+        tuple[str, list[int]]: Transpiled Python script and the index into `lines` that
+            each of its lines was generated from
+    """
 
-    output = ""
+    output = []
+    starts = []
+    inline_map = get_inline_map(inline_indices)
 
     # Generate language annotations
     for idx, line in enumerate(lines):
+        starts.append(len(output))
         if langs[idx] == "COMMENT":
-            output += f"{line}\n"
+            output.append(f"{line}\n")
         elif langs[idx] == "BASH":
             indent = " " * (len(line) - len(line.lstrip()))
             cmd = line.lstrip()
-            cmd = re.sub(env_pattern, r"${{\g<1>}}", cmd)
-            cmd = re.sub(bash_rc_pattern, "$CALLIGRAPHY_RC", cmd)
-            cmd_bytes = cmd.encode("utf-8")
-            base64_cmd_bytes = base64.b64encode(cmd_bytes)
-            base64_cmd = base64_cmd_bytes.decode("utf8")
-            output += f'{indent}shell("{base64_cmd}", format_dict={{**globals(), **locals()}})\n'
+            if cmd.rstrip() == "wait":
+                output.append(f"{indent}wait()\n")
+            elif BACKGROUND_PATTERN.search(cmd):
+                base64_cmd, fmt = encode_call(BACKGROUND_PATTERN.sub("", cmd))
+                output.append(f'{indent}shell_async("{base64_cmd}"{fmt})\n')
+            else:
+                base64_cmd, fmt = encode_call(cmd)
+                direct = get_direct_arg(cmd)
+                output.append(f'{indent}shell("{base64_cmd}"{direct}{fmt})\n')
         elif langs[idx] == "PYTHON":
-            line = re.sub(rc_pattern, "RC", line)
-            line = re.sub(arg_pattern, r"sys.argv[\g<1>]", line)
-            output += f"{line}\n"
+            line = RC_PATTERN.sub("RC", line)
+            line = ARG_PATTERN.sub(r"sys.argv[\g<1>]", line)
+            output.append(f"{line}\n")
         else:
-            inline_idx = [i for i in inline_indices if i[0] == idx][0]
-            raw = line[inline_idx[1] : inline_idx[2]]
-            cmd = raw[2:-1]
-            cmd = re.sub(env_pattern, r"${{\g<1>}}", cmd)
-            cmd = re.sub(bash_rc_pattern, "$CALLIGRAPHY_RC", cmd)
-            cmd_bytes = cmd.encode("utf-8")
-            base64_cmd_bytes = base64.b64encode(cmd_bytes)
-            base64_cmd = base64_cmd_bytes.decode("utf8")
-            if "if" in line[: inline_idx[1]].split(" "):
-                output += f'{line[:inline_idx[1]]}shell("{base64_cmd}", get_rc=True, silent={raw[0]=="?"}, format_dict={{**globals(), **locals()}}){line[inline_idx[2]:]}\n'
-            else:
-                output += f'{line[:inline_idx[1]]}shell("{base64_cmd}", get_stdout=True, silent={raw[0]=="?"}, format_dict={{**globals(), **locals()}}){line[inline_idx[2]:]}\n'
+            position = 0
+            for start, end in inline_map.get(idx, []):
+                end = len(line) if end is None else end
+                raw = line[start:end]
+                cmd = raw[2:-1]
+                prefix = line[position:start]
+                streamed = STREAM_PATTERN.search(prefix)
+                if streamed:
+                    prefix = prefix[: streamed.start()]
+                output.append(prefix)
+                if streamed:
+                    base64_cmd, fmt = encode_call(cmd)
+                    call = get_shell_call(prefix, stream=True)
+                    output.append(
+                        f'{call}("{base64_cmd}", stream=True, silent={raw[0]=="?"}{fmt})'
+                    )
+                elif BACKGROUND_PATTERN.search(cmd):
+                    base64_cmd, fmt = encode_call(BACKGROUND_PATTERN.sub("", cmd))
+                    output.append(
+                        f'shell_async("{base64_cmd}", silent={raw[0]=="?"}{fmt})'
+                    )
+                elif "if" in line[:start].split(" "):
+                    base64_cmd, fmt = encode_call(cmd)
+                    call = get_shell_call(prefix)
+                    direct = get_direct_arg(cmd, call)
+                    output.append(
+                        f'{call}("{base64_cmd}", get_rc=True, silent={raw[0]=="?"}{direct}{fmt})'
+                    )
+                else:
+                    base64_cmd, fmt = encode_call(cmd)
+                    call = get_shell_call(prefix)
+                    direct = get_direct_arg(cmd, call)
+                    output.append(
+                        f'{call}("{base64_cmd}", get_stdout=True, silent={raw[0]=="?"}{direct}{fmt})'
+                    )
+                position = end
+            output.append(f"{line[position:]}\n")
 
-    output = output.replace("<CALLIGRAPHY_NEWLINE>", "\n")
+    # Lines broken up in the script come out as several lines of Python
+    source_map = []
+    starts.append(len(output))
+    for idx in range(len(lines)):
+        chunk = "".join(output[starts[idx] : starts[idx + 1]])
+        count = chunk.count("\n") + chunk.count("<CALLIGRAPHY_NEWLINE>")
+        source_map.extend([idx] * count)
 
-    return output
+    return "".join(output).replace("<CALLIGRAPHY_NEWLINE>", "\n"), source_map
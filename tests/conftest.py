@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(monkeypatch, tmp_path):
+    # Keep the script cache of every test, and of the processes it starts, out of the
+    # real cache directory
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
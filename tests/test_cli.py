@@ -1,10 +1,16 @@
 from calligraphy_scripting.cli import __version__
 from calligraphy_scripting import cli
+from calligraphy_scripting import runtime
+import asyncio
+import base64
 import os
 import pytest
 import io
 import sys
 import re
+import json
+import tempfile
+import subprocess
 
 class MockIO():
     def __init__(self, stdin=''):
@@ -320,6 +326,27 @@ def test_shellopts(capfd):
     assert escape_ansi(out) == shellopts_out
     assert escape_ansi(err) == shellopts_err
 
+
+def test_shellopts_string():
+    options = runtime.Options()
+    default = options.bash_string()
+
+    # Test the set command being kept while the options are unchanged
+    assert options.bash_string() is default
+
+    # Test toggling an option changing the set command that is sent
+    options.x = True
+    assert options.bash_string() != default
+    assert options.bash_string().startswith('set -ehxBH ')
+
+    options.x = False
+    assert options.bash_string() == default
+
+    # Test options set to truthy values that aren't bools still applying
+    options.x = 1
+    assert options.bash_string().startswith('set -ehxBH ')
+    assert 'x' in options.restore_string()
+
 def test_formatting(capfd):
     with open(os.path.join(here, 'data', 'cli.formatting.out')) as out_file:
         formatting_out = out_file.read()
@@ -337,10 +364,461 @@ def test_exception(capfd):
     with open(os.path.join(here, 'data', 'cli.exception.out')) as out_file:
         formatting_out = out_file.read()
     formatting_out = formatting_out.replace('<FILE_PATH>', file_path)
+    formatting_out = formatting_out.replace('<RUNTIME_PATH>', runtime.__file__)
 
     # Test help flag passing
     sys.argv = ['foobar', os.path.join(here, 'data', 'test6.script')]
     cli.cli()
     out, _ = capfd.readouterr()
+    # Lines of the runtime move whenever it changes, so only the frames are compared
+    out = re.sub(f'(File "{re.escape(runtime.__file__)}", line )[0-9]+', r'\g<1><LINE>', out)
 
     assert escape_ansi(out) == formatting_out
+
+def test_syntax_error(capfd):
+    file_path = os.path.join(here, 'data', 'test23.script')
+
+    # Test a script that isn't valid Python reporting the line of the script
+    sys.argv = ['foobar', file_path]
+    cli.cli()
+    out, _ = capfd.readouterr()
+    lines = escape_ansi(out).splitlines()
+
+    assert lines[:2] == [f'  File "{file_path}", line 6', '    if x == "one two"']
+    assert lines[2].startswith('SyntaxError: ')
+    assert 'before' not in out
+    assert lines[-1] == f'Use `calligraphy -i {file_path}` to see the intermediate Python for debugging'
+
+def test_session(capfd):
+    with open(os.path.join(here, 'data', 'cli.session.out')) as out_file:
+        session_out = out_file.read()
+
+    # Test state being kept between Bash lines
+    sys.argv = ['foobar', '-s', os.path.join(here, 'data', 'test8.script')]
+    try:
+        cli.cli()
+    finally:
+        os.environ.pop('CALLIGRAPHY_SESSION', None)
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == session_out
+
+def test_environment(capfd):
+    with open(os.path.join(here, 'data', 'cli.environment.out')) as out_file:
+        environment_out = out_file.read()
+
+    # Test values with separators, newlines and unset variables
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test9.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == environment_out
+
+def test_jobs(capfd):
+    with open(os.path.join(here, 'data', 'cli.jobs.out')) as out_file:
+        jobs_out = out_file.read()
+
+    # Test running commands in the background and waiting on them
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test10.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == jobs_out
+
+
+def test_parallel(capfd):
+    with open(os.path.join(here, 'data', 'cli.parallel.out')) as out_file:
+        parallel_out = out_file.read()
+
+    # Test running loop iterations on a thread pool with their output kept in order
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test11.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == parallel_out
+
+
+def test_tasks(capfd, monkeypatch, tmp_path):
+    monkeypatch.setenv('CALLIGRAPHY_TASK_STATE', str(tmp_path / 'tasks.json'))
+    script_path = os.path.join(here, 'data', 'test12.script')
+
+    # Test independent tasks running at the same time after their dependencies
+    sys.argv = ['foobar', '--target', 'package', '-j', '2', script_path]
+    cli.cli()
+    out, err = capfd.readouterr()
+
+    lines = out.splitlines()
+    assert lines[0] == 'clean' and lines[3:] == ['package']
+    assert sorted(lines[1:3]) == ['docker', 'local']
+    assert err.startswith('Task timings:\n  clean ')
+
+    # Test tasks being skipped when their inputs are unchanged
+    sys.argv = ['foobar', '-t', 'checksum', script_path]
+    cli.cli()
+    out, err = capfd.readouterr()
+
+    assert out == 'checksum\n'
+
+    sys.argv = ['foobar', '-t', 'checksum', script_path]
+    cli.cli()
+    out, err = capfd.readouterr()
+
+    assert out == ''
+    assert err == 'Task timings:\n  checksum  skipped\n'
+
+
+def test_tasks_cwd(capfd, monkeypatch, tmp_path):
+    monkeypatch.delenv('CALLIGRAPHY_TASK_STATE', raising=False)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'inputs').mkdir()
+    (tmp_path / 'inputs' / 'a.txt').write_text('a')
+    script_path = os.path.join(here, 'data', 'test24.script')
+
+    # Test a task changing directory not moving the inputs or the state of the tasks
+    sys.argv = ['foobar', '-t', 'leave', '-t', 'build', script_path]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert out == 'leave\nbuild\n'
+    assert (tmp_path / '.calligraphy_tasks.json').exists()
+
+    os.chdir(tmp_path)
+    sys.argv = ['foobar', '-t', 'leave', '-t', 'build', script_path]
+    cli.cli()
+    out, err = capfd.readouterr()
+
+    assert out == ''
+    assert err == 'Task timings:\n  leave  skipped\n  build  skipped\n'
+
+
+def test_tasks_isolated(capfd):
+    script_path = os.path.join(here, 'data', 'test25.script')
+
+    # Test tasks getting their own globals whatever the number of jobs
+    for jobs in ('1', '2'):
+        sys.argv = ['foobar', '-t', 'show', '-j', jobs, script_path]
+        cli.cli()
+        out, _ = capfd.readouterr()
+
+        assert out == 'bump 1\nshow 0\n'
+
+
+def test_async(capfd):
+    with open(os.path.join(here, 'data', 'cli.async.out')) as out_file:
+        async_out = out_file.read()
+
+    # Test awaiting inline Bash calls from coroutines running at the same time
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test13.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == async_out
+
+
+def test_async_cancel(monkeypatch, tmp_path):
+    monkeypatch.setattr(runtime, 'process_slots', runtime.ProcessSlots(1))
+    pid_path = tmp_path / 'pid'
+    command = base64.b64encode(f'echo $$ > {pid_path}; exec sleep 30'.encode()).decode()
+
+    async def cancel():
+        running = asyncio.create_task(runtime.ashell(command))
+        waiting = asyncio.create_task(runtime.ashell(command))
+        while not pid_path.exists() or not pid_path.read_text():
+            await asyncio.sleep(0.01)
+        for task in (waiting, running):
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    # Test cancelling calls waiting for a slot and running a command
+    asyncio.run(asyncio.wait_for(cancel(), 30))
+
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
+    assert runtime.process_slots.waiters == []
+    assert runtime.process_slots.acquire(blocking=False)
+
+
+def test_stream(capfd):
+    with open(os.path.join(here, 'data', 'cli.stream.out')) as out_file:
+        stream_out = out_file.read()
+
+    # Test iterating over the output of commands while they are still running
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test14.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == stream_out
+
+
+NESTED_STREAM_SCRIPT = """for outer in lines?(printf 'a\\nb\\n'):
+    for inner in lines?(printf '1\\n2\\n'):
+        echo "{outer}{inner}" &
+        wait
+    parallel for item in [outer]:
+        echo "parallel {item}"
+"""
+
+
+def test_stream_slots(tmp_path):
+    script = tmp_path / 'nested.script'
+    script.write_text(NESTED_STREAM_SCRIPT)
+
+    # Test commands started while streams are open not waiting on the slots they hold
+    result = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            f'import sys; sys.argv = ["calligraphy", {str(script)!r}]; '
+            'from calligraphy_scripting import cli; cli.cli()',
+        ],
+        env={**os.environ, 'CALLIGRAPHY_MAX_PROCS': '1', 'PYTHONPATH': os.path.dirname(here)},
+        capture_output=True,
+        text=True,
+        timeout=30,
+    )
+
+    assert result.stdout == 'a1\na2\nparallel a\nb1\nb2\nparallel b\n'
+
+
+def test_stdin(capfd):
+    with open(os.path.join(here, 'data', 'cli.stdin.out')) as out_file:
+        stdin_out = out_file.read()
+
+    # Test piping Python data into the stdin of commands
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test15.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == stdin_out
+
+
+def test_stdin_errors():
+    command = base64.b64encode(b'cat').decode()
+
+    def broken():
+        yield 'first'
+        raise ValueError('broken data')
+
+    # Test data that can't be piped failing before the command starts
+    with pytest.raises(TypeError, match="Can't pipe a 'int'"):
+        runtime.shell(command, stdin=5, get_stdout=True)
+
+    # Test errors hit while feeding the data being raised in the caller
+    for direct in (False, True):
+        with pytest.raises(ValueError, match='broken data'):
+            runtime.shell(command, stdin=broken(), get_stdout=True, direct=direct)
+
+
+def test_builtin_cd_fallback(monkeypatch, tmp_path):
+    def denied(path):
+        raise PermissionError(13, 'Permission denied', path)
+
+    # Test directories that can't be entered being left to bash to fail on
+    monkeypatch.setattr(runtime.os, 'chdir', denied)
+    assert runtime.builtin_cd((str(tmp_path),)) is None
+    monkeypatch.undo()
+
+    # Test physical cd being left to bash
+    monkeypatch.setattr(runtime.shellopts, 'P', True)
+    assert runtime.builtin_cd((str(tmp_path),)) is None
+
+
+def test_direct(capfd):
+    with open(os.path.join(here, 'data', 'cli.direct.out')) as out_file:
+        direct_out = out_file.read()
+
+    # Test simple commands running without bash and others falling back to it
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test16.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == direct_out
+
+def test_builtins(capfd):
+    with open(os.path.join(here, 'data', 'cli.builtins.out')) as out_file:
+        builtins_out = out_file.read()
+
+    # Test cd, export, echo and the file commands running in-process
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test17.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == builtins_out
+
+
+# Echo commands that run in-process or fall back to bash, written as bash would see them
+ECHO_COMMANDS = [
+    "echo plain words",
+    "echo -n 'no newline'",
+    "echo -e 'tab\\tand\\nnewline'",
+    "echo 'kept\\tescape'",
+    "echo -nE 'raw\\n'",
+    "echo -eE 'raw\\n'",
+    "echo -Ee 'cooked\\n'",
+    "echo -ne 'stop\\chere'",
+    "echo -- -e",
+]
+
+
+def test_echo_escapes(capfd, tmp_path):
+    script = tmp_path / 'echo.script'
+    script.write_text('\n'.join(ECHO_COMMANDS) + '\n')
+    expected = ''
+    for command in ECHO_COMMANDS:
+        result = subprocess.run(['bash', '-c', command], capture_output=True, text=True, check=True)
+        # Calligraphy writes the output of commands as whole lines
+        expected += result.stdout if result.stdout.endswith('\n') else result.stdout + '\n'
+
+    # Test echo writing the same output as bash with and without escapes
+    sys.argv = ['foobar', str(script)]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert out == expected
+
+
+def test_profile(capfd):
+    path = os.path.join(here, 'data', 'test18.script')
+
+    # Test timing each line of the script and reporting it on stderr
+    sys.argv = ['foobar', '--profile', path]
+    cli.cli()
+    out, err = capfd.readouterr()
+    rows = escape_ansi(err).strip().split('\n')
+
+    assert out == 'run 0\nrun 1\n42\n'
+    assert rows[0] == f'Profile of {path}, top 6 of 6 lines by wall time in seconds:'
+    assert rows[1].split() == [
+        'Line', 'Calls', 'Wall', 'Python', 'Spawn', 'Command', 'Sync', 'ChildCPU', 'Source'
+    ]
+    calls = {}
+    spawns = {}
+    for row in rows[2:]:
+        fields = row.split(None, 8)
+        calls[int(fields[0])] = (int(fields[1]), fields[8])
+        spawns[int(fields[0])] = float(fields[4])
+        assert all(float(field) >= 0 for field in fields[2:8])
+    assert calls == {
+        3: (1, 'def double(value):'),
+        4: (1, 'return value * 2'),
+        6: (3, 'for idx in range(2):'),
+        7: (2, 'echo "run {idx}"'),
+        9: (1, 'ls / > /dev/null'),
+        10: (1, 'print(double(21))'),
+    }
+    assert spawns[9] > 0
+
+def test_hooks(capfd):
+    with open(os.path.join(here, 'data', 'cli.hooks.out')) as out_file:
+        hooks_out = out_file.read()
+
+    # Test functions registered to run around every shell call
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test19.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == hooks_out
+
+
+def test_trace(capfd):
+    path = os.path.join(here, 'data', 'test19.script')
+    with tempfile.TemporaryDirectory() as root:
+        trace_path = os.path.join(root, 'trace.json')
+
+        # Test writing the shell calls of a script as Chrome trace events
+        sys.argv = ['foobar', '--trace', trace_path, path]
+        cli.cli()
+        capfd.readouterr()
+        with open(trace_path) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+
+    tracks = {
+        event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'
+    }
+    calls = [event for event in events if event['ph'] == 'X']
+
+    assert calls[0]['name'] == path and calls[0]['cat'] == 'script'
+    assert [call['cat'] for call in calls[1:]] == [
+        'shell', 'shell', 'shell', 'shell', 'stream', 'background', 'shell', 'shell', 'shell'
+    ]
+    assert all(call['dur'] >= 0 for call in calls)
+    assert calls[2]['args']['stdout_bytes'] == 5
+    assert 'HOOK_B' in calls[2]['args']['env_changed']
+    assert calls[4]['args']['rc'] == 1
+    background = calls[6]
+    assert tracks[background['tid']] == f"background {background['args']['pid']}"
+    assert tracks[calls[1]['tid']] == 'main'
+
+    # A path to write the trace to is required
+    sys.argv = ['foobar', '--trace']
+    with pytest.raises(SystemExit):
+        cli.cli()
+
+
+def test_lazy_source(capfd):
+    with open(os.path.join(here, 'data', 'cli.lazy.out')) as out_file:
+        lazy_out = out_file.read()
+
+    # Test that a lazily sourced script only runs once one of its names is used
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test20.script')]
+    cli.cli()
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == lazy_out
+
+
+def test_spill(capfd):
+    with open(os.path.join(here, 'data', 'cli.spill.out')) as out_file:
+        spill_out = out_file.read()
+
+    # Test captures past the spill size being read from a memory mapped file
+    sys.argv = ['foobar', os.path.join(here, 'data', 'test22.script')]
+    try:
+        cli.cli()
+    finally:
+        os.environ.pop('CALLIGRAPHY_SPILL_SIZE', None)
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == spill_out
+
+
+def imported_modules(args, environ):
+    code = (
+        f'import sys; sys.argv = {["calligraphy"] + args!r}\n'
+        'try:\n'
+        '    from calligraphy_scripting import cli; cli.cli()\n'
+        'finally:\n'
+        '    print(*sorted(sys.modules), sep="\\n", file=sys.stderr)\n'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True,
+        text=True,
+        env=environ,
+        check=True,
+    )
+    return result.stderr.splitlines()
+
+
+def test_imports(tmp_path):
+    environ = dict(os.environ)
+    environ['PYTHONPATH'] = os.path.dirname(here)
+    environ['XDG_CACHE_HOME'] = str(tmp_path / 'cache')
+    script = tmp_path / 'hello.script'
+    script.write_text('name = "world"\necho "hello {name}"\n')
+
+    # Test printing the version importing nothing but the CLI
+    modules = imported_modules(['-v'], environ)
+
+    assert [name for name in modules if name.startswith('calligraphy_scripting')] == [
+        'calligraphy_scripting', 'calligraphy_scripting.cli'
+    ]
+
+    # Test a cached script running without the parser or transpiler
+    imported_modules([str(script)], environ)
+    modules = imported_modules([str(script)], environ)
+
+    assert 'calligraphy_scripting.runtime' in modules
+    for name in ('calligraphy_scripting.parser', 'calligraphy_scripting.transpiler', 'asyncio', 'concurrent.futures'):
+        assert name not in modules
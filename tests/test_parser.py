@@ -0,0 +1,150 @@
+from calligraphy_scripting import parser
+import os
+import pytest
+import tempfile
+import time
+
+class CountingStr(str):
+    """String that counts the characters read from it by indexing and slicing"""
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.reads = getattr(self, 'reads', 0) + len(value)
+        return value
+
+def test_handle_line_breaks():
+    code = 'x = [\n    1\n]\necho "a\nb" \\\n    c\n\nif $(echo (1)) == 0:\n    y = ?(ls)\n'
+    contents, inline_indices = parser.handle_line_breaks(code)
+
+    assert contents == 'x = [<CALLIGRAPHY_NEWLINE>    1<CALLIGRAPHY_NEWLINE>]\necho "a<CALLIGRAPHY_NEWLINE>b" \\<CALLIGRAPHY_NEWLINE>    c\n\nif $(echo (1)) == 0:\n    y = ?(ls)\n'
+    assert inline_indices == [[2, 3, 14], [3, 8, 13]]
+
+def test_handle_line_breaks_scaling():
+    line = 'x = $(echo "{i}") + str([1, 2])\necho "line" | grep (line)\n'
+    small = CountingStr(line * 500)
+    large = CountingStr(line * 5000)
+
+    parser.handle_line_breaks(small)
+    parser.handle_line_breaks(large)
+
+    # Each character should be copied over once, with a look behind for each
+    # character that can change the parsing state, however long the script is
+    for code in (small, large):
+        tokens = len(parser.LINE_BREAK_TOKEN_PATTERN.findall(code))
+        assert code.reads <= len(code) + tokens
+
+def test_determine_language():
+    code = '\n'.join([
+        'import os as osmod',
+        '# comment',
+        'def build(name):',
+        '    version = $(cat VERSION)',
+        '    echo "{version}"',
+        'items, count = [], 0',
+        'items.append(build("foo"))',
+        'count = len(items)',
+        'osmod.getcwd()',
+        'source lib/helpers.script',
+        'docker build .',
+    ])
+    lines, langs = parser.determine_language(code)
+
+    assert len(lines) == 11
+    assert langs == ['PYTHON', 'COMMENT', 'PYTHON', 'MIX', 'BASH', 'PYTHON', 'PYTHON', 'PYTHON', 'PYTHON', 'CALLIGRAPHY', 'BASH']
+
+def test_handle_parallel():
+    code = '\n'.join([
+        'parallel(jobs=8) for pod in pods:',
+        '    kubectl get pod {pod}',
+        'if True:',
+        '    parallel for (name, value) in dict(a=1).items():',
+        '        echo "{name}"',
+        'parallel for x in pick(jobs=3):',
+        '    echo "{x}"',
+    ])
+    contents = parser.handle_parallel(code)
+
+    assert contents.split('\n') == [
+        '@parallel_for(pods, jobs=8, unpack=False)',
+        'def __calligraphy_parallel_1(pod):',
+        '    kubectl get pod {pod}',
+        'if True:',
+        '    @parallel_for(dict(a=1).items(), jobs=None, unpack=True)',
+        '    def __calligraphy_parallel_2(name, value):',
+        '        echo "{name}"',
+        # keyword arguments of the iterable aren't the option of the loop
+        '@parallel_for(pick(jobs=3), jobs=None, unpack=False)',
+        'def __calligraphy_parallel_3(x):',
+        '    echo "{x}"',
+    ]
+    _, langs = parser.determine_language(contents)
+    assert langs == ['PYTHON', 'PYTHON', 'BASH', 'PYTHON', 'PYTHON', 'PYTHON', 'BASH', 'PYTHON', 'PYTHON', 'BASH']
+
+def test_get_line_numbers():
+    code = '\n'.join([
+        'x = [',
+        '    1,',
+        ']',
+        '',
+        'parallel for item in x:',
+        '    echo "{item}" \\',
+        '        | cat',
+        '',
+        '',
+        'print(x)',
+    ])
+    contents = parser.handle_parallel(code)
+    contents, _ = parser.handle_line_breaks(contents)
+    lines, _ = parser.determine_language(contents)
+    numbers = parser.get_line_numbers(contents)
+
+    assert len(numbers) == len(lines)
+    assert numbers == [1, 5, 5, 6, 10]
+
+def test_compile_sourced():
+    start = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        try:
+            os.makedirs('lib')
+            scripts = {
+                'lib/a.script': 'source lib/b.script\nsource lib/c.script as c\nA = b.B',
+                'lib/b.script': 'source lib/c.script\nB = c.C + 1',
+                'lib/c.script': 'C = 1',
+            }
+            for path, contents in scripts.items():
+                with open(path, 'w') as script_file:
+                    script_file.write(contents)
+
+            # Scripts sourced by sourced scripts come first
+            sources = parser.load_sourced(['lib/a.script'])
+            assert list(sources) == ['lib/c.script', 'lib/b.script', 'lib/a.script']
+
+            parser.compile_sourced(sources)
+            with open('lib/.b.py') as compiled_file:
+                assert 'c = source_import(' in compiled_file.read()
+            assert parser.replace_sourcing('source lib/c.script as helpers lazy') == (
+                'helpers = source_import(os.path.join("lib", "c"+"."+"script"), "helpers", lazy=True)'
+            )
+            assert parser.get_sourced('source lib/c.script lazy') == ['lib/c.script']
+            mtimes = {path: os.stat(path).st_mtime_ns for path in ('lib/.a.py', 'lib/.b.py', 'lib/.c.py')}
+
+            # Modules are written in the order the scripts were read
+            assert mtimes['lib/.c.py'] <= mtimes['lib/.b.py'] <= mtimes['lib/.a.py']
+
+            # Only the script that changed is compiled again
+            time.sleep(0.01)
+            with open('lib/c.script', 'w') as script_file:
+                script_file.write('C = 2')
+            parser.compile_sourced(parser.load_sourced(['lib/a.script']))
+            assert os.stat('lib/.a.py').st_mtime_ns == mtimes['lib/.a.py']
+            assert os.stat('lib/.b.py').st_mtime_ns == mtimes['lib/.b.py']
+            assert os.stat('lib/.c.py').st_mtime_ns != mtimes['lib/.c.py']
+
+            # Cycles are reported instead of recursing forever
+            with open('lib/c.script', 'w') as script_file:
+                script_file.write('source lib/a.script')
+            with pytest.raises(ImportError, match='lib/a.script -> lib/b.script -> lib/c.script -> lib/a.script'):
+                parser.load_sourced(['lib/a.script'])
+        finally:
+            os.chdir(start)
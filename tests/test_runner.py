@@ -1,5 +1,6 @@
 from calligraphy_scripting.cli import __version__
 from calligraphy_scripting import runner
+from calligraphy_scripting import parser
 import os
 import pytest
 import io
@@ -53,3 +54,63 @@ def test_execute(capfd):
     out, _ = capfd.readouterr()
 
     assert escape_ansi(out) == execute_out
+
+def test_cache(capfd, monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+
+    with open(os.path.join(here, 'data', 'runner.execute.out')) as out_file:
+        execute_out = out_file.read()
+
+    with open(os.path.join(here, 'data', 'test7.script')) as script_file:
+        script = script_file.read()
+
+    # Test skipping the cache
+    runner.execute(script, [], use_cache=False)
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == execute_out
+    assert not os.path.exists(os.path.join(tmp_path, 'calligraphy'))
+
+    # Test a cold run populating the cache
+    runner.execute(script, [])
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == execute_out
+    assert len(os.listdir(os.path.join(tmp_path, 'calligraphy'))) == 1
+
+    # Test a warm run not touching the parser
+    def fail(*_):
+        raise AssertionError('parser should not be used on a warm run')
+
+    monkeypatch.setattr(parser, 'handle_line_breaks', fail)
+    runner.execute(script, [])
+    out, _ = capfd.readouterr()
+
+    assert escape_ansi(out) == execute_out
+
+    # Test eviction down to the size limit
+    monkeypatch.setenv('CALLIGRAPHY_CACHE_SIZE', '0')
+    runner.cache.evict()
+
+    assert os.listdir(os.path.join(tmp_path, 'calligraphy')) == []
+
+def test_cache_eviction(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    cache_dir = os.path.join(tmp_path, 'calligraphy')
+    keys = [runner.cache.get_key(f'print({idx})', '') for idx in range(3)]
+    for idx, key in enumerate(keys):
+        runner.cache.store(key, 'x' * 1000, compile('pass', '<test>', 'exec'), [], [])
+        path = os.path.join(cache_dir, f'{key}.bin')
+        os.utime(path, ns=(idx * 10**9, idx * 10**9))
+    size = os.path.getsize(os.path.join(cache_dir, f'{keys[0]}.bin'))
+
+    # Test the least recently used entry going first once the cache is over its limit
+    runner.cache.memory.clear()
+    assert runner.cache.load(keys[0])[0] is not None
+    monkeypatch.setenv('CALLIGRAPHY_CACHE_SIZE', str(size * 2))
+    runner.cache.evict()
+
+    remaining = sorted(os.listdir(cache_dir))
+    assert remaining == sorted([f'{keys[0]}.bin', f'{keys[2]}.bin'])
+    total = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in remaining)
+    assert total <= size * 2
@@ -0,0 +1,166 @@
+import os
+import pytest
+import socket
+import subprocess
+import sys
+import time
+
+from calligraphy_scripting import client
+from calligraphy_scripting import ipc
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+# Seconds to wait for the server to start listening
+START_TIMEOUT = 10
+
+SCRIPT = """import os
+import sys
+
+name = $1
+echo "hello {name}"
+line = input()
+print(os.getcwd(), env.GREETING, line)
+code = $2
+sys.exit(int(code))
+"""
+
+
+def run_client(args, environ, cwd):
+    return subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            'from calligraphy_scripting import client; client.main()',
+            *args,
+        ],
+        env={**environ, 'GREETING': 'hi'},
+        cwd=cwd,
+        input='from stdin\n',
+        capture_output=True,
+        text=True,
+    )
+
+
+def start_server(environ, socket_path):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            '-c',
+            'import sys; sys.argv = ["calligraphy", "--serve"]; '
+            'from calligraphy_scripting import cli; cli.cli()',
+        ],
+        env=environ,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + START_TIMEOUT
+    while not socket_path.exists():
+        if time.monotonic() >= deadline or server.poll() is not None:
+            server.terminate()
+            server.wait(START_TIMEOUT)
+            pytest.fail('server did not start listening')
+        time.sleep(0.05)
+    return server
+
+
+def test_serve(tmp_path):
+    socket_path = tmp_path / 'calligraphy.sock'
+    script = tmp_path / 'hello.script'
+    script.write_text(SCRIPT)
+    environ = {
+        **os.environ,
+        'CALLIGRAPHY_SOCKET': str(socket_path),
+        'XDG_CACHE_HOME': str(tmp_path / 'cache'),
+        'PYTHONPATH': root,
+    }
+    cwd = os.path.realpath(tmp_path)
+    expected = f'hello world\n{cwd} hi from stdin\n'
+
+    server = start_server(environ, socket_path)
+    try:
+        # The script runs in the server on the streams, directory and env of the client
+        for _ in range(2):
+            result = run_client([str(script), 'world', '3'], environ, cwd)
+            assert result.stdout == expected
+            assert result.returncode == 3
+
+        # Only one server can listen on a socket
+        second = subprocess.run(
+            [
+                sys.executable,
+                '-c',
+                'import sys; sys.argv = ["calligraphy", "--serve"]; '
+                'from calligraphy_scripting import cli; cli.cli()',
+            ],
+            env=environ,
+            capture_output=True,
+            text=True,
+        )
+        assert second.returncode == 1
+        assert 'already listening' in second.stdout
+    finally:
+        server.terminate()
+        server.wait(START_TIMEOUT)
+    assert not socket_path.exists()
+
+    # Without a server the client runs the script itself
+    result = run_client([str(script), 'world', '0'], environ, cwd)
+    assert result.stdout == expected
+    assert result.returncode == 0
+
+
+def test_serve_state(tmp_path):
+    socket_path = tmp_path / 'calligraphy.sock'
+    script = tmp_path / 'state.script'
+    script.write_text(
+        'from calligraphy_scripting.runtime import process_slots\n'
+        'print(process_slots.count, len(jobs()))\n'
+        'sleep 0.1 &\n'
+    )
+    environ = {
+        **os.environ,
+        'CALLIGRAPHY_SOCKET': str(socket_path),
+        'XDG_CACHE_HOME': str(tmp_path / 'cache'),
+        'PYTHONPATH': root,
+        'CALLIGRAPHY_MAX_PROCS': '7',
+    }
+
+    server = start_server(environ, socket_path)
+    try:
+        # Each request gets no jobs and the process cap of its own environment
+        for procs in ('1', '2'):
+            result = run_client(
+                [str(script)], {**environ, 'CALLIGRAPHY_MAX_PROCS': procs}, tmp_path
+            )
+            assert result.stdout == f'{procs} 0\n'
+    finally:
+        server.terminate()
+        server.wait(START_TIMEOUT)
+
+
+def test_socket_permissions(monkeypatch, tmp_path):
+    monkeypatch.delenv('CALLIGRAPHY_SOCKET', raising=False)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+
+    # The default socket is in a directory of its own for the current user
+    directory = ipc.get_socket_dir()
+    assert ipc.get_socket_path() == os.path.join(directory, 'server.sock')
+
+    # Directories other users can get into, or links to them, are refused
+    os.mkdir(directory, 0o755)
+    os.chmod(directory, 0o755)
+    with pytest.raises(PermissionError):
+        ipc.check_private_dir(directory)
+    with pytest.raises(PermissionError):
+        client.connect()
+    os.chmod(directory, 0o700)
+    ipc.check_private_dir(directory)
+    os.symlink(directory, tmp_path / 'link')
+    with pytest.raises(PermissionError):
+        ipc.check_private_dir(str(tmp_path / 'link'))
+
+    # Connections from the current user are accepted
+    first, second = socket.socketpair()
+    with first, second:
+        ipc.check_peer(first)
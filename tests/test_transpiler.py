@@ -0,0 +1,131 @@
+from calligraphy_scripting import parser
+from calligraphy_scripting import transpiler
+import base64
+
+def encode(cmd):
+    return base64.b64encode(cmd.encode('utf-8')).decode('utf-8')
+
+class CountingList(list):
+    """List that counts the items read from it"""
+
+    reads = 0
+
+    def __iter__(self):
+        for item in super().__iter__():
+            self.reads += 1
+            yield item
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return super().__getitem__(key)
+
+def test_transpile_multiple_inline():
+    code = 'a = $(echo x) + ?(echo $(echo y)) + "!"'
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    transpiled = transpiler.transpile(lines, langs, inline_indices)
+
+    first = f'shell("{encode("echo x")}", get_stdout=True, silent=False, direct=True)'
+    second = f'shell("{encode("echo $(echo y)")}", get_stdout=True, silent=True)'
+    assert transpiled == f'a = {first} + {second} + "!"\n'
+
+def test_transpile_await():
+    code = 'async def main():\n    a = await $(echo x)\n    if await ?(true):\n        b = $(echo y)'
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    transpiled = transpiler.transpile(lines, langs, inline_indices)
+
+    first = f'ashell("{encode("echo x")}", get_stdout=True, silent=False)'
+    second = f'ashell("{encode("true")}", get_rc=True, silent=True)'
+    third = f'shell("{encode("echo y")}", get_stdout=True, silent=False, direct=True)'
+    assert transpiled == f'async def main():\n    a = await {first}\n    if await {second}:\n        b = {third}\n'
+
+def test_transpile_stream():
+    code = 'for line in lines?(find .):\n    total = len(lines) + sum(1 for _ in lines$(ls))'
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    transpiled = transpiler.transpile(lines, langs, inline_indices)
+
+    first = f'shell("{encode("find .")}", stream=True, silent=True)'
+    second = f'shell("{encode("ls")}", stream=True, silent=False)'
+    assert transpiled == f'for line in {first}:\n    total = len(lines) + sum(1 for _ in {second})\n'
+
+def test_transpile_pipe():
+    code = 'x = data | ?(sort) | $(uniq) or $(true) || 1'
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    transpiled = transpiler.transpile(lines, langs, inline_indices)
+
+    first = f'ShellPipe("{encode("sort")}", get_stdout=True, silent=True, direct=True)'
+    second = f'ShellPipe("{encode("uniq")}", get_stdout=True, silent=False, direct=True)'
+    third = f'shell("{encode("true")}", get_stdout=True, silent=False, direct=True)'
+    assert transpiled == f'x = data | {first} | {second} or {third} || 1\n'
+
+def test_transpile_direct():
+    code = '\n'.join([
+        'mkdir -p dist/{name}',
+        'chmod +x "build script.sh" \'it\'\'s\'',
+        'ls *.py',
+        'cat file | grep x',
+        'echo "$HOME"',
+        'cd dist',
+        'FOO=1 make',
+        'x = ?(git rev-parse HEAD)',
+    ])
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    transpiled = transpiler.transpile(lines, langs, inline_indices)
+
+    assert [', direct=True' in line for line in transpiled.split('\n')[:-1]] == [
+        True, True, False, False, False, True, False, True
+    ]
+
+def test_transpile_format_names():
+    code = '\n'.join([
+        'echo "{service.name}" {hosts[0]} {count:>{width}} {service} ${{HOME}}',
+        "awk '{print $1}' file",
+        'x = $(echo {0})',
+    ])
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    transpiled = transpiler.transpile(lines, langs, inline_indices).split('\n')
+
+    names = '{"service": service, "hosts": hosts, "count": count, "width": width}'
+    assert transpiled[0].endswith(f'format_dict={names})')
+    # fields that aren't names are left to fail at run time as before
+    assert transpiled[1].endswith('format_dict={**globals(), **locals()})')
+    assert transpiled[2].endswith('format_dict={**globals(), **locals()})')
+
+def test_transpile_scaling():
+    line = 'x = $(echo a) + ?(echo b)\nif $(true) == 0:\n    echo "c"\n'
+    small = parser.handle_line_breaks(line * 1000)
+    large = parser.handle_line_breaks(line * 10000)
+    small_lines, small_langs = parser.determine_language(small[0])
+    large_lines, large_langs = parser.determine_language(large[0])
+
+    small_indices = CountingList(small[1])
+    large_indices = CountingList(large[1])
+
+    transpiler.transpile(small_lines, small_langs, small_indices)
+    transpiler.transpile(large_lines, large_langs, large_indices)
+
+    # The inline indices should be read once rather than once per line
+    assert small_indices.reads == len(small_indices)
+    assert large_indices.reads == len(large_indices)
+
+def test_transpile_with_map():
+    code = '\n'.join([
+        'x = [',
+        '    $(echo a),',
+        ']',
+        'echo "b" \\',
+        '    "c"',
+        'print(x)',
+    ])
+    contents, inline_indices = parser.handle_line_breaks(code)
+    lines, langs = parser.determine_language(contents)
+    transpiled, source_map = transpiler.transpile_with_map(lines, langs, inline_indices)
+
+    assert transpiled == transpiler.transpile(lines, langs, inline_indices)
+    assert len(source_map) == len(transpiled.split('\n')) - 1
+    assert source_map == [0, 0, 0, 1, 2]